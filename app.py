@@ -1,4 +1,4 @@
-import os, ssl, socket, threading, time, sqlite3, hashlib, binascii, secrets, urllib.parse
+import os, ssl, socket, threading, time, sqlite3, hashlib, binascii, secrets, functools, urllib.parse
 from datetime import datetime, timedelta
 from email.message import EmailMessage
 import smtplib
@@ -6,6 +6,10 @@ import json
 import urllib.request
 import re
 import urllib.error
+import jsonlog
+import jointoken
+import telemetry
+import uploads
 
 
 # ------------ Config ------------
@@ -26,6 +30,25 @@ CF_TURN_KEY_ID = os.environ.get("CLOUDFLARE_TURN_KEY_ID")
 CF_TURN_API_TOKEN = os.environ.get("CLOUDFLARE_TURN_KEY_API_TOKEN")
 CF_TURN_TTL = int(os.environ.get("CLOUDFLARE_TURN_TTL"))
 
+SMTP_DEBUG = os.environ.get("SMTP_DEBUG", "0") == "1"  # smtplib protocol trace (blocking stderr writes)
+ICE_LOG_SAMPLE = float(os.environ.get("ICE_LOG_SAMPLE", "0.1"))
+SIGNAL_TOKEN_TTL = int(os.environ.get("SIGNAL_TOKEN_TTL", "120"))  # join tokens for signaling.py
+SIGNAL_SAME_ORIGIN = False  # True under combined.py: the room page's websocket goes to this host:port
+TELEMETRY_MAX_BODY = 64 * 1024
+TELEMETRY_API_TOKEN = os.environ.get("TELEMETRY_API_TOKEN")  # bearer token for /api/telemetry/summary of any room
+TFJS_RUNTIME = "vendor/tf.min.js"  # under STATIC_DIR; fetch_vendor.py downloads it, see check_static()
+BG_MODEL_VARIANTS = {  # quantize_model.py writes the float16/uint8 copies
+    "float32": "tfjs_unet/model.json",
+    "float16": "tfjs_unet/float16/model.json",
+    "uint8": "tfjs_unet/uint8/model.json",
+}
+BG_MODEL_VARIANT = os.environ.get("BG_MODEL_VARIANT", "auto")  # auto: float16, uint8 for constrained clients
+CLIENT_HINTS = "Device-Memory, ECT, Save-Data"  # what "auto" looks at
+
+log = jsonlog.get_logger("app")
+email_log = jsonlog.get_logger("app.email")
+ice_log = jsonlog.get_logger("app.ice")
+
 # ------------ DB setup ------------
 
 def init_db():
@@ -239,11 +262,11 @@ def mark_verified(token: str) -> bool:
 
 def send_verification_email(email: str, username: str, verify_url: str) -> bool:
     if not email or "@" not in email:
-        print("[EMAIL ERROR] Bad recipient:", repr(email))
+        email_log.error("bad recipient", to=email)
         return False
 
     if not SMTP_USER or not SMTP_PASS:
-        print("[EMAIL ERROR] Missing SMTP_USER/SMTP_PASS; not sending. URL:", verify_url)
+        email_log.error("missing SMTP_USER/SMTP_PASS; not sending", url=verify_url)
         return False
 
     em = EmailMessage()
@@ -256,39 +279,41 @@ def send_verification_email(email: str, username: str, verify_url: str) -> bool:
     )
 
     try:
-        print(f"[EMAIL] Trying SMTPS {SMTP_HOST}:{SMTP_PORT} as {SMTP_USER} → {email}")
+        email_log.debug("trying SMTPS", host=SMTP_HOST, port=SMTP_PORT, to=email)
         context = ssl.create_default_context()
         with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=20) as smtp:
-            smtp.set_debuglevel(1)  # << see protocol and errors in console
+            if SMTP_DEBUG:
+                smtp.set_debuglevel(1)
             smtp.login(SMTP_USER, SMTP_PASS)
             smtp.send_message(em)
-        print("[EMAIL] Sent via SMTPS 465")
+        email_log.info("verification sent", via="smtps", to=email)
         return True
     except Exception as e1:
-        print("[EMAIL WARN] SMTPS failed:", e1)
+        email_log.warning("SMTPS failed", error=repr(e1))
 
     try:
-        print(f"[EMAIL] Trying STARTTLS {SMTP_HOST}:587 as {SMTP_USER} → {email}")
+        email_log.debug("trying STARTTLS", host=SMTP_HOST, port=587, to=email)
         with smtplib.SMTP(SMTP_HOST, 587, timeout=20) as smtp:
-            smtp.set_debuglevel(1)
+            if SMTP_DEBUG:
+                smtp.set_debuglevel(1)
             smtp.ehlo()
             smtp.starttls(context=ssl.create_default_context())
             smtp.ehlo()
             smtp.login(SMTP_USER, SMTP_PASS)
             smtp.send_message(em)
-        print("[EMAIL] Sent via STARTTLS 587")
+        email_log.info("verification sent", via="starttls", to=email)
         return True
     except Exception as e2:
-        print("[EMAIL ERROR] STARTTLS failed:", e2)
+        email_log.error("STARTTLS failed", error=repr(e2))
         return False
 
 def send_password_reset_email(email: str, username: str, reset_url: str) -> bool:
     if not email or "@" not in email:
-        print("[EMAIL ERROR] Bad recipient:", repr(email))
+        email_log.error("bad recipient", to=email)
         return False
 
     if not SMTP_USER or not SMTP_PASS:
-        print("[EMAIL ERROR] Missing SMTP creds; not sending. URL:", reset_url)
+        email_log.error("missing SMTP creds; not sending", url=reset_url)
         return False
 
     em = EmailMessage()
@@ -303,26 +328,28 @@ def send_password_reset_email(email: str, username: str, reset_url: str) -> bool
     )
 
     try:
-        print(f"[EMAIL] Sending reset → {email}")
+        email_log.debug("sending reset", to=email)
         context = ssl.create_default_context()
         with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=20) as smtp:
             smtp.login(SMTP_USER, SMTP_PASS)
             smtp.send_message(em)
+        email_log.info("reset sent", via="smtps", to=email)
         return True
     except Exception as e1:
-        print("[EMAIL WARN] SMTPS failed:", e1)
+        email_log.warning("SMTPS failed", error=repr(e1))
 
     try:
-        print(f"[EMAIL] Trying STARTTLS {SMTP_HOST}:587 → {email}")
+        email_log.debug("trying STARTTLS", host=SMTP_HOST, port=587, to=email)
         with smtplib.SMTP(SMTP_HOST, 587, timeout=20) as smtp:
             smtp.ehlo()
             smtp.starttls(context=ssl.create_default_context())
             smtp.ehlo()
             smtp.login(SMTP_USER, SMTP_PASS)
             smtp.send_message(em)
+        email_log.info("reset sent", via="starttls", to=email)
         return True
     except Exception as e2:
-        print("[EMAIL ERROR] STARTTLS failed:", e2)
+        email_log.error("STARTTLS failed", error=repr(e2))
         return False
 
 
@@ -362,6 +389,9 @@ def cf_generate_ice_servers(ttl_seconds: int):
 
 # ------------ In-memory state ------------
 
+TELEMETRY = telemetry.Store(DB_PATH)  # call-quality samples; writes on its own thread
+BACKGROUNDS = uploads.Processor(STATIC_DIR)  # uploaded backgrounds; decoded/re-encoded by a worker pool
+
 ROOMS = {}  # room_id -> {"key": str, "owner": username, "created_at": iso}
 SESSIONS = {}  # sid -> {"data": { ... }, "expires": epoch}
 
@@ -382,6 +412,13 @@ def check_room_key(room_id: str, key: str) -> bool:
     return bool(room and room["key"] == key)
 
 
+def may_enter_room(sess: dict, room_id: str) -> bool:
+    """Owner of the room, or joined it with the key in this session."""
+    room = ROOMS.get(room_id)
+    user = sess.get("user")
+    return bool(room and user and (room["owner"] == user or room_id in sess.get("rooms_joined", [])))
+
+
 # ------------ HTTP primitives ------------
 
 class HTTPRequest:
@@ -456,9 +493,13 @@ class HTTPResponse:
             400: "Bad Request",
             401: "Unauthorized",
             403: "Forbidden",
+            204: "No Content",
+            304: "Not Modified",
             404: "Not Found",
             405: "Method Not Allowed",
+            413: "Payload Too Large",
             500: "Internal Server Error",
+            503: "Service Unavailable",
         }.get(self.status, "OK")
         lines = [f"HTTP/1.1 {self.status} {reason}"]
         body = self.body
@@ -584,6 +625,14 @@ def get_session(request: HTTPRequest):
     return sid, SESSIONS[sid]["data"], ck
 
 
+def session_data(sid: str):
+    """Data of a live session, or None. Unlike get_session() never creates one."""
+    entry = SESSIONS.get(sid) if sid else None
+    if entry and entry["expires"] > int(time.time()):
+        return entry["data"]
+    return None
+
+
 def touch_session(sid: str):
     if sid in SESSIONS:
         SESSIONS[sid]["expires"] = int(time.time()) + SESSION_TTL_SECONDS
@@ -631,6 +680,102 @@ class Router:
 
 router = Router()
 
+# ------------ Static assets ------------
+# /static/<name>.<hash><ext> is <name><ext> with a content hash in the
+# name: cached for a year and never revalidated. Plain /static/ URLs
+# revalidate by ETag.
+
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+_FINGERPRINTED = re.compile(r"^(.+)\.([0-9a-f]{12})(\.[A-Za-z0-9]+)$")
+_asset_hashes = {}  # path -> (mtime_ns, size, hash)
+_STATIC_MIME = {
+    ".css": "text/css", ".js": "application/javascript", ".json": "application/json",
+    ".bin": "application/octet-stream", ".wasm": "application/wasm",
+    ".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp", ".gif": "image/gif",
+}
+
+
+def asset_hash(path):
+    """Content hash of a file under STATIC_DIR, recomputed only when it changes."""
+    st = os.stat(path)
+    cached = _asset_hashes.get(path)
+    if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+        return cached[2]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    _asset_hashes[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def static_url(rel):
+    """Fingerprinted URL of static/<rel>, or None if the file is not there."""
+    path = os.path.join(STATIC_DIR, *rel.split("/"))
+    if not os.path.isfile(path):
+        return None
+    stem, ext = os.path.splitext(rel)
+    return f"/static/{stem}.{asset_hash(path)}{ext}"
+
+
+def model_assets(rel):
+    """Fingerprinted URLs of a TF.js graph model: {"model": url, "weights": {shard name: url}}."""
+    model = static_url(rel)
+    if model is None:
+        return {}
+    with open(os.path.join(STATIC_DIR, *rel.split("/")), "r", encoding="utf-8") as f:
+        manifest = json.load(f).get("weightsManifest", [])
+    base = rel.rsplit("/", 1)[0] + "/" if "/" in rel else ""
+    weights = {}
+    for group in manifest:
+        for name in group.get("paths", []):
+            url = static_url(base + name)
+            if url:  # a missing shard is left to the loader's default URL (and its 404)
+                weights[name] = url
+    return {"model": model, "weights": weights}
+
+
+def bg_model_variant(req):
+    """The background model variant for this client; falls back to the float32 model if a copy is missing."""
+    variant = BG_MODEL_VARIANT
+    if variant not in BG_MODEL_VARIANTS:
+        try:
+            memory = float(req.headers.get("device-memory") or 8)
+        except ValueError:
+            memory = 8
+        constrained = (req.headers.get("save-data", "").lower() == "on" or memory <= 2
+                       or req.headers.get("ect") in ("slow-2g", "2g", "3g"))
+        variant = "uint8" if constrained else "float16"
+    if not os.path.isfile(os.path.join(STATIC_DIR, *BG_MODEL_VARIANTS[variant].split("/"))):
+        variant = "float32"
+    return variant
+
+
+def room_assets(req, bg_mode):
+    """Filter runtime/model URLs for the room page, and preload hints when a background filter is on."""
+    # not fetched (or removed): the plain path, so the page fails on a 404 rather than quietly
+    assets = {"tfjs": static_url(TFJS_RUNTIME) or "/static/" + TFJS_RUNTIME, "variant": bg_model_variant(req)}
+    assets.update(model_assets(BG_MODEL_VARIANTS[assets["variant"]]))
+    links = []
+    if bg_mode != "none":
+        # fetch() from TF.js is a CORS-mode, same-origin-credentials request: crossorigin matches it
+        links.append(f'<link rel="preload" href="{assets["tfjs"]}" as="script">')
+        for url in [assets.get("model")] + list(assets.get("weights", {}).values()):
+            if url:
+                links.append(f'<link rel="preload" href="{url}" as="fetch" crossorigin>')
+    return assets, "\n  ".join(links)
+
+
+def check_static():
+    """Say so at startup if the vendored TF.js runtime is missing. The room page
+    loads no third-party script, so until `python fetch_vendor.py` has run,
+    calls work but background filters do not. Returns True if it is there."""
+    if static_url(TFJS_RUNTIME) is None:
+        path = os.path.join(STATIC_DIR, *TFJS_RUNTIME.split("/"))
+        log.error("tfjs runtime missing: background filters are off until `python fetch_vendor.py` runs",
+                  path=path)
+        return False
+    return True
+
+
 # ------------ Handlers ------------
 
 def handle_favicon(req: HTTPRequest):
@@ -643,16 +788,27 @@ def handle_favicon(req: HTTPRequest):
 
 
 def serve_static(req: HTTPRequest, file_path: str):
-    path = os.path.join(STATIC_DIR, *file_path.split("/"))
-    if not os.path.isfile(path):
+    parts = file_path.split("/")
+    if any(not p or p.startswith(".") for p in parts):
         return HTTPResponse(404, {"Content-Type": "text/plain"}, b"not found")
-    mime = "text/plain"
-    if path.endswith(".css"): mime = "text/css"
-    if path.endswith(".js"): mime = "application/javascript"
-    if path.endswith(".png"): mime = "image/png"
-    if path.endswith(".jpg") or path.endswith(".jpeg"): mime = "image/jpeg"
+    path = os.path.join(STATIC_DIR, *parts)
+    wanted = None
+    if not os.path.isfile(path):
+        m = _FINGERPRINTED.match(parts[-1])
+        if m:
+            path = os.path.join(STATIC_DIR, *parts[:-1], m.group(1) + m.group(3))
+            wanted = m.group(2)
+        if not os.path.isfile(path):
+            return HTTPResponse(404, {"Content-Type": "text/plain"}, b"not found")
+    digest = asset_hash(path)
+    hdrs = {"Content-Type": _STATIC_MIME.get(os.path.splitext(path)[1].lower(), "text/plain"),
+            "ETag": f'"{digest}"'}
+    # an old hash (page rendered before a deploy) still gets the file, just not cached for good
+    hdrs["Cache-Control"] = STATIC_IMMUTABLE if wanted == digest else "no-cache"
+    if req.headers.get("if-none-match") == hdrs["ETag"]:
+        return HTTPResponse(304, hdrs)
     with open(path, "rb") as f:
-        return HTTPResponse(200, {"Content-Type": mime}, f.read())
+        return HTTPResponse(200, hdrs, f.read())
 
 
 def home(req: HTTPRequest):
@@ -666,6 +822,46 @@ def home(req: HTTPRequest):
         hdrs["Set-Cookie"] = set_ck
     return HTTPResponse(200, hdrs, body)
 
+_prefs_locks = {}  # user id -> Lock around read-modify-write of prefs_json (request threads + upload workers)
+_prefs_locks_guard = threading.Lock()
+
+def prefs_lock(user_id):
+    with _prefs_locks_guard:
+        return _prefs_locks.setdefault(user_id, threading.Lock())
+
+
+def load_prefs(user_id):
+    """get_user_prefs with the defaults settings() works with."""
+    prefs = get_user_prefs(user_id)
+    prefs.setdefault("auto_cam", False)
+    prefs.setdefault("auto_mic", False)
+    prefs.setdefault("sound", True)
+    filters = prefs.setdefault("filters", {})
+    filters.setdefault("bg_mode", "none")
+    filters.setdefault("blur_strength", 12)
+    filters.setdefault("face_filter", "off")
+    filters.setdefault("bg_src", "")
+    filters.setdefault("bg_color", "#1f1f1f")
+    return prefs
+
+
+def _background_ready(user_id, token, rel):
+    """Upload worker callback (rel None: the upload failed): point the user's filters at the
+    processed image and clear bg_pending, unless a newer upload replaced this one meanwhile."""
+    with prefs_lock(user_id):
+        prefs = load_prefs(user_id)
+        filters = prefs["filters"]
+        if filters.get("bg_pending") == token:
+            del filters["bg_pending"]
+            if rel:
+                filters["bg_src"] = static_url(rel)  # written once: fingerprinted, cached for good
+                filters["bg_rev"] = filters.get("bg_rev", 0) + 1
+            set_user_prefs(user_id, prefs)
+            return
+    if rel:
+        os.remove(os.path.join(STATIC_DIR, *rel.split("/")))
+
+
 def settings(req: HTTPRequest):
     sid, sess, set_ck = get_session(req)
     if not sess.get("user"):
@@ -683,70 +879,59 @@ def settings(req: HTTPRequest):
     if not return_to.startswith("/"):
         return_to = "/lobby"
 
-    prefs = get_user_prefs(user["id"])
-    prefs.setdefault("auto_cam", False)
-    prefs.setdefault("auto_mic", False)
-    prefs.setdefault("sound", True)
-
-    prefs.setdefault("filters", {})
-    prefs["filters"].setdefault("bg_mode", "none")
-    prefs["filters"].setdefault("blur_strength", 12)
-    prefs["filters"].setdefault("face_filter", "off")
-    prefs["filters"].setdefault("bg_src", "")
-    prefs["filters"].setdefault("bg_color", "#1f1f1f")
+    prefs = load_prefs(user["id"])
 
     if req.method == "POST":
         action = (req.form.get("action") or "").strip()
 
         if action == "save_prefs":
-            prefs["auto_cam"] = ("pref_auto_cam" in req.form)
-            prefs["auto_mic"] = ("pref_auto_mic" in req.form)
-            prefs["sound"] = ("pref_sound" in req.form)
+            with prefs_lock(user["id"]):
+                prefs = load_prefs(user["id"])  # fresh: an upload worker may have written since
+                prefs["auto_cam"] = ("pref_auto_cam" in req.form)
+                prefs["auto_mic"] = ("pref_auto_mic" in req.form)
+                prefs["sound"] = ("pref_sound" in req.form)
 
-            ok = set_user_prefs(user["id"], prefs)
+                ok = set_user_prefs(user["id"], prefs)
             return redirect(return_to, set_ck)
         
         elif action == "save_filters":
-            prefs.setdefault("filters", {})
-            filters = prefs["filters"]
-
-            filters["bg_mode"] = (req.form.get("bg_mode") or "none").strip()
-
-            saved_upload_path = None
-
             upload = getattr(req, "files", {}).get("bg_upload")
-            if upload and upload.get("data"):
-                user_folder = os.path.join(STATIC_DIR, "uploads", user["username"])
-                os.makedirs(user_folder, exist_ok=True)
-
-                orig = upload.get("filename", "upload.png")
-                ext = os.path.splitext(orig)[1].lower()
-                if ext not in [".png", ".jpg", ".jpeg", ".webp"]:
-                    ext = ".png"
-
-                fname = f"bg_{secrets.token_hex(8)}{ext}"
-                out_path = os.path.join(user_folder, fname)
-
-                MAX_BYTES = 3 * 1024 * 1024
-                data = upload["data"]
-                if len(data) <= MAX_BYTES:
-                    with open(out_path, "wb") as f:
-                        f.write(data)
-                    saved_upload_path = f"/static/uploads/{user['username']}/{fname}"
-                    filters["bg_src"] = saved_upload_path
+            pending = None
+            MAX_BYTES = 3 * 1024 * 1024
+            if upload and upload.get("data") and len(upload["data"]) <= MAX_BYTES:
+                # decoded, scaled and re-encoded by a worker; bg_src switches over when it is done
+                pending = secrets.token_hex(8)
 
-            try:
-                filters["blur_strength"] = int(req.form.get("blur_strength") or "12")
-            except:
-                filters["blur_strength"] = 12
-
-            filters["face_filter"] = (req.form.get("face_filter") or "off").strip()
-            filters["bg_color"] = (req.form.get("bg_color") or "#1f1f1f").strip()
+            with prefs_lock(user["id"]):
+                prefs = load_prefs(user["id"])  # fresh: an upload worker may have written since
+                filters = prefs["filters"]
 
-            if not saved_upload_path:
-                filters["bg_src"] = (req.form.get("bg_src") or "").strip()
+                filters["bg_mode"] = (req.form.get("bg_mode") or "none").strip()
 
-            set_user_prefs(user["id"], prefs)
+                try:
+                    filters["blur_strength"] = int(req.form.get("blur_strength") or "12")
+                except:
+                    filters["blur_strength"] = 12
+
+                filters["face_filter"] = (req.form.get("face_filter") or "off").strip()
+                filters["bg_color"] = (req.form.get("bg_color") or "#1f1f1f").strip()
+
+                # the form's bg_src is only current if the page was rendered at this bg_rev with
+                # nothing pending: otherwise it would undo a processed upload
+                bg_src = (req.form.get("bg_src") or "").strip()
+                if (not filters.get("bg_pending") and not pending
+                        and req.form.get("bg_rev", "0") == str(filters.get("bg_rev", 0))
+                        and bg_src != filters["bg_src"]):
+                    filters["bg_src"] = bg_src
+                    filters["bg_rev"] = filters.get("bg_rev", 0) + 1
+                if pending:
+                    filters["bg_pending"] = pending  # a newer upload replaces one still in the works
+
+                set_user_prefs(user["id"], prefs)
+            # queued after the save, so the worker's update cannot be overwritten by it
+            if pending and not BACKGROUNDS.submit(user["username"], upload["data"],
+                                                  functools.partial(_background_ready, user["id"], pending)):
+                _background_ready(user["id"], pending, None)
             return redirect(return_to, set_ck)
 
     # extract for template
@@ -756,7 +941,12 @@ def settings(req: HTTPRequest):
     face_filter = filters.get("face_filter", "off")
     bg_src = filters.get("bg_src", "")
     bg_color = filters.get("bg_color", "#1f1f1f")
-
+    if filters.get("bg_pending"):
+        msg_html = (
+            '<div class="panel" style="border-color:#2e6a48;background:#113020;color:#bdf2d3;">'
+            'Your background image is being prepared; it will be used as soon as it is ready.'
+            '</div>'
+        )
 
     body = render(
         "settings.html",
@@ -771,6 +961,7 @@ def settings(req: HTTPRequest):
         blur_strength=blur_strength,
         face_filter=face_filter,
         bg_src=bg_src,
+        bg_rev=str(filters.get("bg_rev", 0)),
         bg_color=bg_color,
         return_to=return_to,
     )
@@ -1019,8 +1210,7 @@ def api_ice(req: HTTPRequest):
     sid, sess, set_ck = get_session(req)
 
     room_id = (req.query.get("room") or "").strip()
-    print("[ICE] HIT room_id=", room_id, "user=", sess.get("user"),
-          "key_id=", CF_TURN_KEY_ID, "ttl=", CF_TURN_TTL, flush=True)
+    ice_log.debug("ice request", room=room_id, user=sess.get("user"), ttl=CF_TURN_TTL)
 
     if not sess.get("user"):
         return HTTPResponse(401, {"Content-Type": "application/json"}, b'{"error":"unauthorized"}')
@@ -1037,9 +1227,9 @@ def api_ice(req: HTTPRequest):
 
     try:
         ice_servers = cf_generate_ice_servers(CF_TURN_TTL)
-        print("[ICE] Cloudflare OK servers=", len(ice_servers), flush=True)
+        ice_log.info("cloudflare ok", room=room_id, servers=len(ice_servers), sample=ICE_LOG_SAMPLE)
     except Exception as e:
-        print("[ICE] Cloudflare FAIL:", repr(e), flush=True)
+        ice_log.error("cloudflare failed", room=room_id, error=repr(e))
         return HTTPResponse(500, {"Content-Type": "application/json"}, b'{"error":"ice_failed"}')
 
     out = json.dumps({"iceServers": ice_servers}).encode("utf-8")
@@ -1048,12 +1238,66 @@ def api_ice(req: HTTPRequest):
         hdrs["Set-Cookie"] = set_ck
     return HTTPResponse(200, hdrs, out)
 
+def api_signal_token(req: HTTPRequest):
+    """A fresh signaling join token, for websocket reconnects after the page's one was used."""
+    sid, sess, set_ck = get_session(req)
+    room_id = (req.query.get("room") or "").strip()
+    if not sess.get("user"):
+        return HTTPResponse(401, {"Content-Type": "application/json"}, b'{"error":"unauthorized"}')
+    if not may_enter_room(sess, room_id):
+        return HTTPResponse(403, {"Content-Type": "application/json"}, b'{"error":"forbidden"}')
+    touch_session(sid)
+    out = json.dumps({"token": jointoken.issue(SECRET_KEY, room_id, sess["user"], SIGNAL_TOKEN_TTL)})
+    hdrs = {"Content-Type": "application/json", "Cache-Control": "no-store"}
+    if set_ck:
+        hdrs["Set-Cookie"] = set_ck
+    return HTTPResponse(200, hdrs, out)
+
+def api_telemetry(req: HTTPRequest):
+    """A batch of call-quality samples from the room page: {room, samples:[...]}. Queued, not written here."""
+    sid, sess, set_ck = get_session(req)
+    if not sess.get("user"):
+        return HTTPResponse(401, {"Content-Type": "application/json"}, b'{"error":"unauthorized"}')
+    if len(req.body) > TELEMETRY_MAX_BODY:
+        return HTTPResponse(413, {"Content-Type": "application/json"}, b'{"error":"too_large"}')
+    try:
+        batch = json.loads(req.body)
+        room_id, samples = batch["room"], batch["samples"]
+    except (ValueError, TypeError, KeyError):
+        return HTTPResponse(400, {"Content-Type": "application/json"}, b'{"error":"bad_request"}')
+    if not isinstance(room_id, str) or not isinstance(samples, list) or len(samples) > telemetry.MAX_SAMPLES:
+        return HTTPResponse(400, {"Content-Type": "application/json"}, b'{"error":"bad_request"}')
+    if not may_enter_room(sess, room_id):
+        return HTTPResponse(403, {"Content-Type": "application/json"}, b'{"error":"forbidden"}')
+    if not TELEMETRY.submit(room_id, sess["user"], samples):
+        return HTTPResponse(503, {"Content-Type": "application/json", "Retry-After": "30"}, b'{"error":"busy"}')
+    return HTTPResponse(204)
+
+def api_telemetry_summary(req: HTTPRequest):
+    """Call quality of ?room= over the last ?minutes= (default 60): p95 RTT, loss, ..., per user too."""
+    room_id = (req.query.get("room") or "").strip()
+    auth = req.headers.get("authorization", "")
+    # bytes: compare_digest refuses non-ASCII str (headers are latin-1 decoded)
+    if not (TELEMETRY_API_TOKEN and secrets.compare_digest(auth.encode("latin-1"),
+                                                           f"Bearer {TELEMETRY_API_TOKEN}".encode("utf-8"))):
+        sid, sess, set_ck = get_session(req)
+        if not sess.get("user"):
+            return HTTPResponse(401, {"Content-Type": "application/json"}, b'{"error":"unauthorized"}')
+        if not may_enter_room(sess, room_id):
+            return HTTPResponse(403, {"Content-Type": "application/json"}, b'{"error":"forbidden"}')
+    try:
+        minutes = min(max(float(req.query.get("minutes") or 60), 1), 90 * 24 * 60)
+    except ValueError:
+        return HTTPResponse(400, {"Content-Type": "application/json"}, b'{"error":"bad_request"}')
+    out = json.dumps(TELEMETRY.summary(room_id, time.time() - minutes * 60)).encode("utf-8")
+    return HTTPResponse(200, {"Content-Type": "application/json", "Cache-Control": "no-store"}, out)
+
 def lobby(req: HTTPRequest):
     sid, sess, set_ck = get_session(req)
     if not sess.get("user"):
         return redirect("/", set_ck)
     body = render("lobby.html", username=sess["user"])
-    hdrs = {"Content-Type": "text/html; charset=utf-8"}
+    hdrs = {"Content-Type": "text/html; charset=utf-8", "Accept-CH": CLIENT_HINTS}  # for the room page
     if set_ck: hdrs["Set-Cookie"] = set_ck
     return HTTPResponse(200, hdrs, body)
 
@@ -1144,6 +1388,7 @@ def room(req: HTTPRequest, room_id: str):
     bg_mode = filters.get("bg_mode", "none")
     blur_strength = filters.get("blur_strength", 12)
     face_filter = filters.get("face_filter", "off")
+    assets, preload = room_assets(req, bg_mode)
 
     body = render(
         "room.html",
@@ -1160,9 +1405,13 @@ def room(req: HTTPRequest, room_id: str):
         pref_face_filter=face_filter,
         pref_bg_src=filters.get("bg_src", ""),
         pref_bg_color=filters.get("bg_color", "#1f1f1f"),
+        signal_same_origin=str(SIGNAL_SAME_ORIGIN).lower(),
+        signal_token=jointoken.issue(SECRET_KEY, room_id, sess["user"], SIGNAL_TOKEN_TTL),
+        asset_preload=preload,
+        assets_json=json.dumps(assets).replace("<", "\\u003c"),
     )
 
-    hdrs = {"Content-Type": "text/html; charset=utf-8"}
+    hdrs = {"Content-Type": "text/html; charset=utf-8", "Accept-CH": CLIENT_HINTS}
     if set_ck: hdrs["Set-Cookie"] = set_ck
     return HTTPResponse(200, hdrs, body)
 
@@ -1187,6 +1436,9 @@ router.add("POST", "/reset-password", reset_password)
 router.add("GET", "/verify", verify)
 router.add("GET", "/logout", logout)
 router.add("GET", "/api/ice", api_ice)
+router.add("GET", "/api/signal-token", api_signal_token)
+router.add("POST", "/api/telemetry", api_telemetry)
+router.add("GET", "/api/telemetry/summary", api_telemetry_summary)
 router.add("GET", "/lobby", lobby)
 router.add("POST", "/create-room", create_room_route)
 router.add("GET", "/join/<room_id>", join_room)
@@ -1197,7 +1449,40 @@ router.add("GET", "/room/<room_id>", room)
 
 # ------------ Server core ------------
 
+def handle_request(data: bytes) -> bytes:
+    """Route one complete request (head + body) and return the raw response."""
+    req = HTTPRequest(data)
+    rid = req.headers.get("x-request-id", "")[:64]
+    rid = jsonlog.set_request_id(rid if re.fullmatch(r"[A-Za-z0-9._-]+", rid) else None)
+
+    # ---- routing ----
+    if req.path.startswith("/static/"):
+        resp = serve_static(req, req.path[len("/static/"):])
+    else:
+        handler, params = router.match(req.method, req.path)
+        if not handler:
+            resp = HTTPResponse(404, {"Content-Type": "text/plain"}, b"Not Found")
+        else:
+            try:
+                if params:
+                    if "path" in params and callable(handler):
+                        resp = handler(req, params["path"])
+                    elif "room_id" in params:
+                        resp = handler(req, params["room_id"])
+                    else:
+                        resp = handler(req, **params)
+                else:
+                    resp = handler(req)
+            except Exception:
+                log.exception("handler failed", method=req.method, path=req.path)
+                resp = HTTPResponse(500, {"Content-Type": "text/plain"}, b"Server error")
+
+    resp.headers.setdefault("X-Request-ID", rid)
+    return resp.to_bytes()
+
+
 def handle_client(conn):
+    jsonlog.set_request_id()
     try:
         conn.settimeout(5)
         data = b""
@@ -1206,7 +1491,7 @@ def handle_client(conn):
             try:
                 chunk = conn.recv(65536)
             except TimeoutError:
-                print("[TIMEOUT] No HTTP request received in 5s, closing client.")
+                log.info("no HTTP request received in 5s, closing client")
                 return
             if not chunk:
                 # client closed connection
@@ -1232,38 +1517,14 @@ def handle_client(conn):
             try:
                 chunk = conn.recv(65536)
             except TimeoutError:
-                print("[TIMEOUT] Body read timed out, closing client.")
+                log.info("body read timed out, closing client")
                 return
             if not chunk:
                 break
             data += chunk
             body_received += len(chunk)
 
-        req = HTTPRequest(data)
-
-        # ---- routing ----
-        if req.path.startswith("/static/"):
-            resp = serve_static(req, req.path[len("/static/"):])
-        else:
-            handler, params = router.match(req.method, req.path)
-            if not handler:
-                resp = HTTPResponse(404, {"Content-Type": "text/plain"}, b"Not Found")
-            else:
-                try:
-                    if params:
-                        if "path" in params and callable(handler):
-                            resp = handler(req, params["path"])
-                        elif "room_id" in params:
-                            resp = handler(req, params["room_id"])
-                        else:
-                            resp = handler(req, **params)
-                    else:
-                        resp = handler(req)
-                except Exception as e:
-                    print("[ERROR]", e)
-                    resp = HTTPResponse(500, {"Content-Type": "text/plain"}, b"Server error")
-
-        conn.sendall(resp.to_bytes())
+        conn.sendall(handle_request(data))
 
     finally:
         try:
@@ -1274,27 +1535,32 @@ def handle_client(conn):
 
 
 
-def serve(host: str, port: int, certfile: str, keyfile: str):
+def tls_context(certfile: str, keyfile: str) -> ssl.SSLContext:
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     context.load_cert_chain(certfile=certfile, keyfile=keyfile)
     context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
     context.set_ciphers("ECDHE+AESGCM:ECDHE+CHACHA20")
+    return context
+
+
+def serve(host: str, port: int, certfile: str, keyfile: str):
+    context = tls_context(certfile, keyfile)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind((host, port))
     sock.listen(128)
-    print(f"[SERVE] https://{host}:{port}")
+    log.info("serving", url=f"https://{host}:{port}")
 
     with context.wrap_socket(sock, server_side=True) as ssock:
         while True:
             try:
                 client, addr = ssock.accept()
             except ssl.SSLError as e:
-                print("[TLS HANDSHAKE WARN]", e)   # unknown CA, etc.
+                log.warning("tls handshake failed", error=str(e))   # unknown CA, etc.
                 continue
             except OSError as e:
-                print("[ACCEPT ERROR]", e)
+                log.warning("accept failed", error=str(e))
                 continue
 
             t = threading.Thread(target=handle_client, args=(client,), daemon=True)
@@ -1302,12 +1568,13 @@ def serve(host: str, port: int, certfile: str, keyfile: str):
 
 
 if __name__ == "__main__":
-    print("APP.PY STARTED SUCCESSFULLY", flush=True)
+    log.info("app.py started")
     HOST = os.environ.get("HOST", "0.0.0.0")
     PORT = int(os.environ.get("PORT", "34535"))
     CERT = os.environ.get("TLS_CERT", "crt/server.crt")
     KEY = os.environ.get("TLS_KEY", "crt/server.key")
 
     init_db()
+    check_static()
 
     serve(HOST, PORT, CERT, KEY)
@@ -0,0 +1,304 @@
+# bench_app.py
+import os, sys, ssl, json, math, time, socket, tempfile, threading, subprocess, argparse, platform, http.client
+import urllib.parse
+from datetime import datetime
+
+"""
+HTTP load test for app.py.
+
+Starts the real `serve()` on a free local port with a throwaway self-signed
+cert and a temp DB_PATH, seeds N verified users, and drives the flow
+
+  login -> lobby -> create-room -> room page -> /api/ice -> static assets
+
+from many concurrent TLS clients. SMTP and Cloudflare are replaced by local
+stand-ins so the numbers only measure app.py itself.
+
+  python bench_app.py --clients 32 --duration 30
+  python bench_app.py --clients 32 --duration 30 --compare bench_results/app_<old>.json
+
+Results (throughput + p50/p95/p99 per route) are written as JSON under
+bench_results/ so runs from different commits can be compared.
+"""
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+STATIC_ASSETS = [
+    "/static/app.css",
+    "/static/room.css",
+    "/static/Web_Rtc_connection.js",
+    "/static/filters_bg.js",
+]
+
+
+# ----------------- environment -----------------
+def make_self_signed_cert(folder):
+    crt = os.path.join(folder, "server.crt")
+    key = os.path.join(folder, "server.key")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key, "-out", crt],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return crt, key
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def load_app(workdir):
+    """Import app.py against a temp DB with the external services stubbed out."""
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ.setdefault("SESSION_COOKIE_NAME", "sid")
+    os.environ.setdefault("SESSION_TTL_SECONDS", "3600")
+    os.environ.setdefault("TEMPLATES_DIR", os.path.join(ROOT, "templates"))
+    os.environ.setdefault("STATIC_DIR", os.path.join(ROOT, "static"))
+    os.environ.setdefault("CLOUDFLARE_TURN_TTL", "600")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, ROOT)
+    import app
+
+    # Local stand-ins: no network, same shapes as the real responses.
+    def fake_ice(ttl_seconds):
+        return [
+            {"urls": ["stun:stun.cloudflare.com:3478"]},
+            {"urls": ["turn:turn.cloudflare.com:3478?transport=udp"],
+             "username": "bench", "credential": "bench"},
+        ]
+
+    def fake_mail(email, username, url):
+        return True
+
+    app.cf_generate_ice_servers = fake_ice
+    app.send_verification_email = fake_mail
+    app.send_password_reset_email = fake_mail
+    return app
+
+
+def seed_users(app, n):
+    users = []
+    for i in range(n):
+        name = f"bench{i}"
+        password = f"pw-{i}-bench"
+        ok, token = app.add_user(name, f"{name}@bench.local", password)
+        if ok:
+            app.mark_verified(token)
+        users.append((name, password))
+    return users
+
+
+def start_server(app, port, crt, key, ctx):
+    t = threading.Thread(target=app.serve, args=("127.0.0.1", port, crt, key), daemon=True)
+    t.start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            # full handshake, so the probe does not show up as a TLS warning
+            raw = socket.create_connection(("127.0.0.1", port), timeout=0.5)
+            ctx.wrap_socket(raw, server_hostname="localhost").close()
+            return t
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+
+# ----------------- client -----------------
+class Client:
+    def __init__(self, port, ctx, stats):
+        self.port = port
+        self.ctx = ctx
+        self.stats = stats
+        self.cookies = {}
+
+    def request(self, route, method, path, body=None):
+        headers = {"Host": f"localhost:{self.port}"}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        if body is not None:
+            body = urllib.parse.urlencode(body).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        t0 = time.perf_counter()
+        status, location = 0, None
+        try:
+            # app.py closes after each response, so every request pays a TLS handshake
+            conn = http.client.HTTPSConnection("127.0.0.1", self.port, context=self.ctx, timeout=30)
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+            location = resp.getheader("Location")
+            for v in resp.msg.get_all("Set-Cookie") or []:
+                k, _, rest = v.partition("=")
+                self.cookies[k.strip()] = rest.split(";", 1)[0]
+            conn.close()
+        except Exception:
+            status = 0
+        self.stats.record(route, time.perf_counter() - t0, status)
+        return status, location
+
+    def flow(self, username, password):
+        self.cookies = {}
+        self.request("POST /login", "POST", "/login", {"username": username, "password": password})
+        self.request("GET /lobby", "GET", "/lobby")
+        status, location = self.request("POST /create-room", "POST", "/create-room", {})
+        if status != 302 or not location or not location.startswith("/room/"):
+            return
+        room_id = location[len("/room/"):]
+        self.request("GET /room/<id>", "GET", location)
+        self.request("GET /api/ice", "GET", f"/api/ice?room={urllib.parse.quote(room_id)}")
+        for asset in STATIC_ASSETS:
+            self.request(f"GET {asset}", "GET", asset)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}  # route -> [seconds]
+        self.errors = {}   # route -> count
+
+    def record(self, route, seconds, status):
+        with self.lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if status == 0 or status >= 500:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    # nearest-rank
+    i = max(0, min(len(sorted_vals) - 1, math.ceil(p / 100.0 * len(sorted_vals)) - 1))
+    return sorted_vals[i]
+
+
+def summarize(stats, elapsed):
+    routes = {}
+    total = 0
+    for route, vals in sorted(stats.samples.items()):
+        vals = sorted(vals)
+        total += len(vals)
+        routes[route] = {
+            "count": len(vals),
+            "errors": stats.errors.get(route, 0),
+            "rps": round(len(vals) / elapsed, 2),
+            "mean_ms": round(1000 * sum(vals) / len(vals), 3),
+            "p50_ms": round(1000 * percentile(vals, 50), 3),
+            "p95_ms": round(1000 * percentile(vals, 95), 3),
+            "p99_ms": round(1000 * percentile(vals, 99), 3),
+            "max_ms": round(1000 * vals[-1], 3),
+        }
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "requests": total,
+        "errors": sum(stats.errors.values()),
+        "throughput_rps": round(total / elapsed, 2) if elapsed else 0,
+        "routes": routes,
+    }
+
+
+# ----------------- runner -----------------
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run(clients, users, duration, warmup):
+    workdir = tempfile.mkdtemp(prefix="bench_app_")
+    crt, key = make_self_signed_cert(workdir)
+    app = load_app(workdir)
+    accounts = seed_users(app, users)
+    port = free_port()
+
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    start_server(app, port, crt, key, ctx)
+
+    stats = Stats()
+    stop = threading.Event()
+    measuring = threading.Event()
+
+    def worker(i):
+        warm = Stats()
+        client = Client(port, ctx, warm)
+        n = 0
+        while not stop.is_set():
+            client.stats = stats if measuring.is_set() else warm
+            username, password = accounts[(i + n * clients) % len(accounts)]
+            client.flow(username, password)
+            n += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(warmup)
+    measuring.set()
+    t0 = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - t0
+    measuring.clear()
+    stop.set()
+    for t in threads:
+        t.join(timeout=30)
+
+    return {
+        "bench": "app",
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "params": {"clients": clients, "users": users, "duration": duration, "warmup": warmup},
+        "result": summarize(stats, elapsed),
+    }
+
+
+def print_report(report, baseline=None):
+    res = report["result"]
+    print(f"commit {report['commit']}  {res['requests']} requests in {res['elapsed_s']}s "
+          f"= {res['throughput_rps']} req/s  ({res['errors']} errors)")
+    base_routes = (baseline or {}).get("result", {}).get("routes", {})
+    print(f"{'route':36} {'count':>7} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}"
+          + ("  p95 vs base" if baseline else ""))
+    for route, r in res["routes"].items():
+        line = f"{route:36} {r['count']:>7} {r['rps']:>8} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9}"
+        b = base_routes.get(route)
+        if b and b.get("p95_ms"):
+            line += f"  {100.0 * (r['p95_ms'] - b['p95_ms']) / b['p95_ms']:+.1f}%"
+        print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Load-test app.py over TLS")
+    ap.add_argument("--clients", type=int, default=16, help="concurrent TLS clients")
+    ap.add_argument("--users", type=int, default=64, help="seeded accounts")
+    ap.add_argument("--duration", type=float, default=20.0, help="measured seconds")
+    ap.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds first")
+    ap.add_argument("--out", help="result JSON path (default bench_results/app_<commit>_<time>.json)")
+    ap.add_argument("--compare", help="earlier result JSON to diff against")
+    args = ap.parse_args()
+
+    report = run(args.clients, max(args.users, args.clients), args.duration, args.warmup)
+
+    out = args.out or os.path.join(
+        ROOT, "bench_results", f"app_{report['commit']}_{datetime.utcnow():%Y%m%d%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"saved {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+// bench_handshake.mjs
+/*
+Per-peer key setup cost of secure signaling, one side, v1 vs v2.
+
+  node bench_handshake.mjs                 # 200 handshakes each, after 20 warm-up
+  node bench_handshake.mjs --n 1000 --peers 6
+
+Node 20+ (globalThis.crypto is WebCrypto; V8 and BoringSSL-backed WebCrypto
+as in Chrome). Both versions are copied from static/Web_Rtc_connection.js:
+
+  v1  BigInt 2048-bit DH: modPow for our public and for the shared secret,
+      SHA-256 of the secret, AES-CBC importKey. Synchronous on the main
+      thread apart from the last two steps.
+  v2  ECDH P-256 generateKey + exportKey, importKey of the peer's point,
+      deriveBits, HKDF importKey + deriveKey to AES-256-GCM.
+
+Reports per-handshake median / p95 / mean in ms, and what a joiner spends
+on key setup with --peers - 1 others (handshakes run one after another, as
+the intro scheduler releases them). The peer's public value is made once,
+outside the timed part, so each sample is exactly one side.
+*/
+import { parseArgs } from "node:util";
+
+const { values: args } = parseArgs({
+  options: {
+    n: { type: "string", default: "200" },
+    warmup: { type: "string", default: "20" },
+    peers: { type: "string", default: "6" },
+  },
+});
+const N = Number(args.n), WARMUP = Number(args.warmup), PEERS = Number(args.peers);
+const subtle = globalThis.crypto.subtle;
+const te = new TextEncoder();
+
+// ---- v1 (removed in 85b4414) ----
+const PRIME = (2n ** 2048n) - 159n;
+const GENERATOR = 2n;
+
+function modPow(base, exponent, modulus) {
+  if (modulus === 1n) return 0n;
+  let result = 1n;
+  base %= modulus;
+  while (exponent > 0n) {
+    if (exponent & 1n) result = (result * base) % modulus;
+    exponent >>= 1n;
+    base = (base * base) % modulus;
+  }
+  return result;
+}
+
+function dhPrivate() {
+  const privBytes = globalThis.crypto.getRandomValues(new Uint8Array(32));
+  return BigInt("0x" + Array.from(privBytes).map(b => b.toString(16).padStart(2, "0")).join(""));
+}
+
+async function v1Side(peerPub) {
+  const priv = dhPrivate();
+  const pub = modPow(GENERATOR, priv, PRIME);
+  const shared = modPow(peerPub, priv, PRIME);
+  const digest = await subtle.digest("SHA-256", te.encode(shared.toString()));
+  await subtle.importKey("raw", new Uint8Array(digest).slice(0, 16), { name: "AES-CBC" }, false, ["encrypt", "decrypt"]);
+  return pub.toString();
+}
+
+// ---- v2 (current) ----
+const ECDH = { name: "ECDH", namedCurve: "P-256" };
+
+async function v2Side(peerPubRaw) {
+  const keyPair = await subtle.generateKey(ECDH, false, ["deriveBits"]);
+  const pub = await subtle.exportKey("raw", keyPair.publicKey);
+  const peerPub = await subtle.importKey("raw", peerPubRaw, ECDH, false, []);
+  const secret = await subtle.deriveBits({ name: "ECDH", public: peerPub }, keyPair.privateKey, 256);
+  const ikm = await subtle.importKey("raw", secret, "HKDF", false, ["deriveKey"]);
+  const info = te.encode("webrtc-signal v2 alice bob");
+  await subtle.deriveKey({ name: "HKDF", hash: "SHA-256", salt: new Uint8Array(32), info },
+                         ikm, { name: "AES-GCM", length: 256 }, false, ["encrypt", "decrypt"]);
+  return pub;
+}
+
+// ---- harness ----
+async function time(fn) {
+  for (let i = 0; i < WARMUP; i++) await fn();
+  const ms = [];
+  for (let i = 0; i < N; i++) {
+    const t0 = performance.now();
+    await fn();
+    ms.push(performance.now() - t0);
+  }
+  ms.sort((a, b) => a - b);
+  const at = (q) => ms[Math.min(ms.length - 1, Math.floor(q * ms.length))];
+  return { median: at(0.5), p95: at(0.95), mean: ms.reduce((a, b) => a + b, 0) / ms.length };
+}
+
+const v1Peer = modPow(GENERATOR, dhPrivate(), PRIME);
+const v2Peer = await subtle.exportKey("raw", (await subtle.generateKey(ECDH, true, ["deriveBits"])).publicKey);
+
+console.log(`node ${process.version}, ${N} handshakes each (${WARMUP} warm-up), joiner of a ${PEERS}-peer mesh`);
+for (const [name, fn] of [["v1 BigInt DH-2048 + SHA-256 + AES-CBC import", () => v1Side(v1Peer)],
+                          ["v2 ECDH P-256 + HKDF + AES-GCM deriveKey", () => v2Side(v2Peer)]]) {
+  const r = await time(fn);
+  console.log(`  ${name.padEnd(46)} median ${r.median.toFixed(2)} ms  p95 ${r.p95.toFixed(2)} ms  `
+              + `mean ${r.mean.toFixed(2)} ms  joiner ${(r.mean * (PEERS - 1)).toFixed(1)} ms`);
+}
@@ -0,0 +1,375 @@
+# bench_sfu.py
+import os, sys, ssl, json, math, time, asyncio, argparse, platform, fractions
+import multiprocessing as mp
+import tempfile
+from array import array
+from datetime import datetime
+
+import av
+import websockets
+from aiortc import (RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCBundlePolicy,
+                    MediaStreamTrack)
+from aiortc.mediastreams import MediaStreamError
+
+from bench_app import make_self_signed_cert, free_port, git_commit, ROOT
+from bench_signaling import _rss_bytes, JOIN_SECRET
+from sfu import _tap
+import jointoken
+
+"""
+Benchmark for the SFU mode of signaling.py (sfu.py).
+
+The real `signaling.main()` runs in a child process with SIGNAL_SFU=on and
+SIGNAL_SFU_AT set so that every room of the run is forwarded by the server. Clients are
+aiortc peers in this process that speak the browser's side of the protocol
+(join, answer the server's offers, attach their tracks to the "up" slots)
+and publish synthetic media: a moving test pattern (--width x --height at
+--fps) and a 440 Hz tone. No camera, browser or network beyond loopback is
+needed.
+
+  python bench_sfu.py --rooms 1 --peers 6 --duration 20
+  python bench_sfu.py --rooms 4 --peers 5 --width 640 --height 360
+
+Once every client receives every other client's video, the server's CPU
+time is sampled over --duration and reported per forwarded stream (one
+published track delivered to one subscriber, audio and video counted
+separately) and per published track, with the frame rate the clients
+actually got. Results go to bench_results/ as JSON. The clients encode
+and depacketize in one process: on a small machine they run out of CPU
+before the server does, which shows as a low received frame rate (compare
+"clients.cpu_percent").
+"""
+
+VIDEO_CLOCK = 90000
+AUDIO_RATE = 48000
+AUDIO_SAMPLES = 960  # 20 ms
+
+
+# ----------------- synthetic media -----------------
+class SyntheticVideo(MediaStreamTrack):
+    """A diagonal gradient moving 3 px per frame with a noisy corner, paced at fps."""
+    kind = "video"
+
+    def __init__(self, width, height, fps):
+        super().__init__()
+        self.width, self.height, self.fps = width, height, fps
+        self.tape = bytes(i & 255 for i in range(width + height + 256))
+        self.chroma = bytes([128]) * (width // 2 * height // 2)
+        self.start = None
+        self.n = 0
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self.start is None:
+            self.start = time.monotonic()
+        self.n += 1
+        await asyncio.sleep(max(0.0, self.start + self.n / self.fps - time.monotonic()))
+        w, h, shift = self.width, self.height, (3 * self.n) % 256
+        noise = os.urandom(32 * 32)
+        rows = [self.tape[r + shift:r + shift + w] for r in range(h)]
+        for r in range(min(32, h)):
+            rows[r] = noise[32 * r:32 * r + 32] + rows[r][32:]
+        frame = av.VideoFrame(w, h, "yuv420p")
+        frame.planes[0].update(b"".join(rows))
+        frame.planes[1].update(self.chroma)
+        frame.planes[2].update(self.chroma)
+        frame.pts = self.n * VIDEO_CLOCK // self.fps
+        frame.time_base = fractions.Fraction(1, VIDEO_CLOCK)
+        return frame
+
+
+class SyntheticAudio(MediaStreamTrack):
+    """A 440 Hz tone, mono s16, in 20 ms frames paced in real time."""
+    kind = "audio"
+
+    def __init__(self):
+        super().__init__()
+        tone = array("h", (int(8000 * math.sin(2 * math.pi * 440 * i / AUDIO_RATE)) for i in range(AUDIO_RATE)))
+        self.second = tone.tobytes()
+        self.start = None
+        self.n = 0
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self.start is None:
+            self.start = time.monotonic()
+        self.n += 1
+        await asyncio.sleep(max(0.0, self.start + self.n * AUDIO_SAMPLES / AUDIO_RATE - time.monotonic()))
+        frame = av.AudioFrame(format="s16", layout="mono", samples=AUDIO_SAMPLES)
+        off = (self.n * AUDIO_SAMPLES % AUDIO_RATE) * 2
+        frame.planes[0].update(self.second[off:off + AUDIO_SAMPLES * 2])
+        frame.sample_rate = AUDIO_RATE
+        frame.pts = self.n * AUDIO_SAMPLES
+        frame.time_base = fractions.Fraction(1, AUDIO_RATE)
+        return frame
+
+
+# ----------------- server process -----------------
+def _server_proc(port, crt, key, probe_q, interval, sfu_at):
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["SIGNAL_SFU"] = "on"
+    os.environ["SIGNAL_SFU_AT"] = str(sfu_at)
+    sys.path.insert(0, ROOT)
+    import signaling
+
+    async def probe():
+        while True:
+            probe_q.put({
+                "t": time.time(),
+                "cpu": time.process_time(),  # every thread: aiortc decoders and the encode pool too
+                "rss": _rss_bytes(),
+                "peers": sum(len(r["clients"]) for r in signaling.rooms.values()),
+                "sfu": signaling.sfu_report(),
+            })
+            await asyncio.sleep(interval)
+
+    async def run():
+        probe_task = asyncio.ensure_future(probe())  # keep a strong ref while serving
+        await signaling.main("127.0.0.1", port, crt, key)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+async def probe_sample(q, after=None, timeout=5.0):
+    after = after or time.time()
+    deadline = time.time() + timeout
+    last = None
+    while time.time() < deadline:
+        while not q.empty():
+            last = q.get_nowait()
+        if last and last["t"] >= after:
+            return last
+        await asyncio.sleep(0.1)
+    return last
+
+
+# ----------------- clients -----------------
+class FrameCounter:
+    """Takes a receiver's encoded frames (sfu._tap) and only counts them."""
+
+    def __init__(self, counts, key):
+        self.counts = counts
+        self.key = key
+        counts[key] = 0
+
+    def feed(self, data, timestamp, clock):
+        self.counts[self.key] += 1
+
+
+class SfuPeer:
+    """The browser's side of sfu.py: answer every offer, publish on the "up" slots."""
+
+    def __init__(self, port, ctx, room_id, user, args):
+        self.uri = f"wss://127.0.0.1:{port}/?room={room_id}&user={user}"
+        if JOIN_SECRET:
+            self.uri += "&token=" + jointoken.issue(JOIN_SECRET, room_id, user)
+        self.ctx = ctx
+        self.user = user
+        self.video = SyntheticVideo(args.width, args.height, args.fps)
+        self.audio = SyntheticAudio()
+        self.ws = None
+        self.pc = None
+        self.joined = False
+        self.slots = {}
+        self.frames = {}      # (user, kind) -> frames received
+        self.restarts = 0
+        self.tasks = []
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.uri, ssl=self.ctx, max_size=2**22)
+        self.tasks.append(asyncio.ensure_future(self.reader()))
+
+    async def send_sfu(self, data):
+        await self.ws.send(json.dumps({"type": "sfu", "data": data}))
+
+    async def reader(self):
+        try:
+            async for raw in self.ws:
+                msg = json.loads(raw)
+                mode = msg.get("media") if msg.get("type") == "peer_list" else msg.get("mode")
+                if mode == "sfu" and not self.joined:
+                    self.joined = True
+                    await self.send_sfu({"type": "join"})
+                elif msg.get("type") == "sfu" and msg["data"].get("type") == "offer":
+                    await self.on_offer(msg["data"])
+                elif msg.get("type") == "sfu" and msg["data"].get("type") == "closed":
+                    self.restarts += 1
+                    await self.pc.close()
+                    self.pc = None
+                    await self.send_sfu({"type": "join"})
+        except websockets.ConnectionClosed:
+            pass
+
+    async def on_offer(self, data):
+        if self.pc is None:
+            self.pc = RTCPeerConnection(RTCConfiguration(bundlePolicy=RTCBundlePolicy.MAX_BUNDLE))
+            self.pc.on("track", self.on_track)
+        self.slots = data["slots"]  # before: on_track fires inside setRemoteDescription
+        await self.pc.setRemoteDescription(RTCSessionDescription(data["sdp"], "offer"))
+        for t in self.pc.getTransceivers():
+            slot = self.slots.get(t.mid, {})
+            if slot.get("up"):
+                t.direction = "sendonly"
+                if slot["up"] == "camera":
+                    t.sender.replaceTrack(self.audio if t.kind == "audio" else self.video)
+            else:
+                t.direction = "recvonly" if slot.get("user") else "inactive"
+        await self.pc.setLocalDescription(await self.pc.createAnswer())
+        await self.send_sfu({"type": "answer", "sdp": self.pc.localDescription.sdp})
+
+    def on_track(self, track):
+        # count encoded frames instead of decoding them: a browser would, but
+        # here the clients share the machine with the server being measured
+        for t in self.pc.getTransceivers():
+            if t.receiver.track is track:
+                slot = self.slots.get(t.mid, {})
+                _tap(t.receiver, FrameCounter(self.frames, (slot.get("user"), track.kind)))
+
+    def receiving(self, others):
+        return all(self.frames.get((u, "video"), 0) > 0 for u in others)
+
+    async def close(self):
+        for t in self.tasks:
+            t.cancel()
+        if self.pc is not None:
+            await self.pc.close()
+        if self.ws is not None:
+            await self.ws.close()
+
+
+async def run_async(args, port, ctx, probe_q):
+    idle = await probe_sample(probe_q)
+    rooms = {f"sfu-{r}": [SfuPeer(port, ctx, f"sfu-{r}", f"p{i}", args) for i in range(args.peers)]
+             for r in range(args.rooms)}
+    peers = [p for room in rooms.values() for p in room]
+
+    t0 = time.perf_counter()
+    for p in peers:
+        await p.connect()
+    deadline = time.time() + args.setup_timeout
+    while time.time() < deadline:
+        if all(p.receiving([q.user for q in room if q is not p]) for room in rooms.values() for p in room):
+            break
+        await asyncio.sleep(0.1)
+    setup_s = time.perf_counter() - t0
+    complete = all(p.receiving([q.user for q in room if q is not p]) for room in rooms.values() for p in room)
+
+    await asyncio.sleep(1.0)  # past the first keyframes
+    start = await probe_sample(probe_q)
+    before = {id(p): dict(p.frames) for p in peers}
+    t1 = time.perf_counter()
+    c1 = time.process_time()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - t1
+    client_cpu = time.process_time() - c1
+    fps = [(n - before[id(p)].get(key, 0)) / elapsed
+           for p in peers for key, n in p.frames.items() if key[1] == "video"]
+    end = await probe_sample(probe_q)
+
+    for p in peers:
+        await p.close()
+
+    cpu_s = end["cpu"] - start["cpu"]
+    wall = max(end["t"] - start["t"], 1e-9)
+    sfu = end["sfu"]
+    forwarded = max(sfu["forwarded"], 1)
+    published = max(sfu["published"], 1)
+    return {
+        "peers_total": len(peers),
+        "setup": {"seconds": round(setup_s, 3), "all_receiving": complete},
+        "media": {"width": args.width, "height": args.height, "fps": args.fps},
+        "server": {
+            "cpu_percent": round(100 * cpu_s / wall, 1),
+            "published_tracks": sfu["published"],
+            "forwarded_streams": sfu["forwarded"],
+            "cpu_ms_per_forwarded_stream_s": round(1000 * cpu_s / wall / forwarded, 3),
+            "cpu_ms_per_published_track_s": round(1000 * cpu_s / wall / published, 3),
+            "rss_idle_mb": round(idle["rss"] / 2**20, 2),
+            "rss_loaded_mb": round(end["rss"] / 2**20, 2),
+            "counters": {k: v for k, v in sfu.items() if k not in ("enabled", "rooms", "sessions",
+                                                                  "published", "forwarded")},
+        },
+        "clients": {
+            "cpu_percent": round(100 * client_cpu / elapsed, 1),  # near 100 on one core: figures are skewed
+            "video_tracks_received": len(fps),
+            "restarts": sum(p.restarts for p in peers),
+            "received_fps_mean": round(sum(fps) / max(len(fps), 1), 2),
+            "received_fps_min": round(min(fps, default=0), 2),
+        },
+    }
+
+
+def save_report(args, result):
+    report = {
+        "bench": "sfu",
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "result": result,
+    }
+    out = args.out or os.path.join(
+        ROOT, "bench_results", f"sfu_{report['commit']}_{datetime.utcnow():%Y%m%d%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {out}")
+
+
+async def _with_server(args, port, ctx, probe_q):
+    deadline = time.time() + 10
+    while True:
+        try:
+            uri = f"wss://127.0.0.1:{port}/?room=_probe&user=_probe"
+            if JOIN_SECRET:
+                uri += "&token=" + jointoken.issue(JOIN_SECRET, "_probe", "_probe")
+            ws = await websockets.connect(uri, ssl=ctx)
+            await ws.close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+    return await run_async(args, port, ctx, probe_q)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the SFU mode of signaling.py")
+    ap.add_argument("--rooms", type=int, default=1)
+    ap.add_argument("--peers", type=int, default=6, help="peers per room")
+    ap.add_argument("--duration", type=float, default=20.0, help="measured seconds")
+    ap.add_argument("--width", type=int, default=320)
+    ap.add_argument("--height", type=int, default=240)
+    ap.add_argument("--fps", type=int, default=15)
+    ap.add_argument("--sfu-at", type=int, default=2, help="SIGNAL_SFU_AT for the server")
+    ap.add_argument("--setup-timeout", type=float, default=30.0)
+    ap.add_argument("--out", help="result JSON path")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_sfu_")
+    crt, key = make_self_signed_cert(workdir)
+    port = free_port()
+    probe_q = mp.Queue()
+    server = mp.Process(target=_server_proc, daemon=True, args=(port, crt, key, probe_q, 0.5, args.sfu_at))
+    server.start()
+
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    try:
+        result = asyncio.run(_with_server(args, port, ctx, probe_q))
+    finally:
+        server.terminate()
+        server.join(5)
+
+    print(json.dumps(result, indent=2))
+    save_report(args, result)
+
+
+if __name__ == "__main__":
+    main()
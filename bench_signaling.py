@@ -0,0 +1,641 @@
+# bench_signaling.py
+import os, sys, ssl, json, time, base64, random, asyncio, argparse, platform, resource
+import multiprocessing as mp
+import tempfile
+from datetime import datetime
+
+import websockets
+
+from bench_app import make_self_signed_cert, free_port, percentile, git_commit, ROOT
+import jointoken
+
+"""
+Benchmark / soak harness for signaling.py.
+
+The real `signaling.main()` runs in a child process (own core, own RSS) on a
+local port with a throwaway cert. The child also reports len(rooms), the peer
+count, its CPU time and RSS twice a second, which is how leaks in `rooms`
+show up.
+
+Clients behave like Web_Rtc_connection.js: every pair of peers handshakes
+(ecdh_public, ready, encrypted offer/answer, trickle ICE candidates) when the
+server introduces them (or, with SIGNAL_INTROS=client, every joiner does so
+with each peer already in the room), the offerer acks the pair once the
+answer is in, then the room chats, keeps trickling candidates and churns
+(peers leave and rejoin). The server's join-to-connected times are reported.
+
+  python bench_signaling.py --rooms 20 --peers 6 --duration 30
+  python bench_signaling.py --rooms 50 --peers 4 --soak 600 --wave 20
+  python bench_signaling.py --relay-cpu 200000
+  python bench_signaling.py --rooms 10 --peers 6 --nodes 2
+  SIGNAL_LIVENESS=websockets python bench_signaling.py --idle 5000 --duration 120
+
+Reports relay latency percentiles for directed signals and chat broadcasts,
+delivered messages/s, server CPU %, memory per connection and (soak) rooms /
+peers / RSS after every wave. --relay-cpu instead times the per-message CPU
+cost of relaying a signal frame: full json decode/encode vs the envelope fast
+path. --nodes N starts a pubsub.py broker and N signaling nodes on it and
+spreads every room's peers over the nodes, so signals between peers on
+different nodes are reported separately as cross-node relay latency (server
+CPU / RSS figures are then for node 0). --idle N only holds N connections
+open without traffic and reports server CPU and RSS per idle connection and
+the liveness pings sent; run it with SIGNAL_LIVENESS=wheel and =websockets,
+for longer than the ping intervals, to compare. Results go to bench_results/
+as JSON.
+"""
+
+JOIN_SECRET = os.environ.get("SECRET_KEY")  # the server then wants join tokens
+
+SDP_B64_BYTES = 5200       # encrypted offer/answer as sent by sendSecure()
+CANDIDATE_B64_BYTES = 420  # encrypted ICE candidate
+ECDH_PUBLIC_B64_BYTES = 88 # raw P-256 public point (65 bytes)
+CANDIDATES_PER_SIDE = 8
+
+
+def _blob(n):
+    return base64.b64encode(os.urandom(n * 3 // 4)).decode()
+
+
+# ----------------- server process -----------------
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _server_proc(port, crt, key, probe_q, interval, pubsub_spec=None, node_id=None):
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if pubsub_spec:
+        os.environ["SIGNAL_PUBSUB"] = pubsub_spec
+        os.environ["SIGNAL_NODE_ID"] = node_id
+    sys.path.insert(0, ROOT)
+    import signaling
+
+    async def probe():
+        while True:
+            probe_q.put({
+                "t": time.time(),
+                "rooms": len(signaling.rooms),
+                "peers": sum(len(r["clients"]) for r in signaling.rooms.values()),
+                "cpu": time.process_time(),
+                "rss": _rss_bytes(),
+                "intros": signaling.intro_summary(),
+                "liveness_pings": signaling.counters["liveness_pings"],
+            })
+            await asyncio.sleep(interval)
+
+    async def run():
+        probe_task = asyncio.ensure_future(probe()) if probe_q else None
+        try:
+            await signaling.main("127.0.0.1", port, crt, key)
+        finally:
+            if probe_task is not None:
+                probe_task.cancel()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+class ServerProbe:
+    def __init__(self, q):
+        self.q = q
+        self.last = None
+        self.samples = []
+
+    def drain(self):
+        while True:
+            try:
+                s = self.q.get_nowait()
+            except Exception:
+                break
+            self.last = s
+            self.samples.append(s)
+        return self.last
+
+    async def wait_fresh(self, after=None, timeout=5.0):
+        after = after or time.time()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            s = self.drain()
+            if s and s["t"] >= after:
+                return s
+            await asyncio.sleep(0.1)
+        return self.last
+
+    async def wait_quiet(self, timeout=10.0):
+        """Wait until the server reports no peers (or give up)."""
+        deadline = time.time() + timeout
+        s = None
+        while time.time() < deadline:
+            s = await self.wait_fresh()
+            if s and s["peers"] == 0 and s["rooms"] == 0:
+                return s
+        return s
+
+
+# ----------------- clients -----------------
+class Metrics:
+    def __init__(self):
+        self.lat = {"signal": [], "chat": [], "cross_node": []}
+        self.sent = {}
+        self.recv = {}
+        self.errors = 0
+        self.connects = 0
+
+    def count(self, table, kind):
+        table[kind] = table.get(kind, 0) + 1
+
+    def reset(self):
+        self.__init__()
+
+
+class BenchPeer:
+    def __init__(self, bench, room_id, user, node=0):
+        self.bench = bench
+        self.room_id = room_id
+        self.user = user
+        self.node = node  # index into bench.ports
+        self.ws = None
+        self.reader_task = None
+        self.known = set()
+        self.tasks = set()
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, obj, kind):
+        try:
+            await self.ws.send(json.dumps(obj, separators=(",", ":")))  # like JSON.stringify
+            self.bench.metrics.count(self.bench.metrics.sent, kind)
+        except Exception:
+            self.bench.metrics.errors += 1
+
+    async def signal(self, to, kind, size):
+        data = {"type": "encrypted", "b64": _blob(size), "k": kind, "bench_node": self.node,
+                "bench_t": time.perf_counter()}
+        if kind == "candidate":
+            data["ice"] = 1  # last key, as sendSecure() does
+        await self.send({"type": "signal", "to": to, "from": self.user, "data": data}, "signal")
+
+    async def handshake(self, other):
+        await self.send({"type": "signal", "to": other, "from": self.user,
+                         "data": {"type": "ecdh_public", "v": 2, "value": _blob(ECDH_PUBLIC_B64_BYTES),
+                                  "bench_t": time.perf_counter()}}, "signal")
+        await self.send({"type": "signal", "to": other, "from": self.user,
+                         "data": {"type": "ready", "bench_t": time.perf_counter()}}, "signal")
+        await self.signal(other, "offer", SDP_B64_BYTES)
+        for _ in range(CANDIDATES_PER_SIDE):
+            await self.signal(other, "candidate", CANDIDATE_B64_BYTES)
+
+    async def answer(self, other):
+        await self.send({"type": "signal", "to": other, "from": self.user,
+                         "data": {"type": "ecdh_public", "v": 2, "value": _blob(ECDH_PUBLIC_B64_BYTES), "seen_us": True,
+                                  "bench_t": time.perf_counter()}}, "signal")
+        await self.send({"type": "signal", "to": other, "from": self.user,
+                         "data": {"type": "ready", "bench_t": time.perf_counter()}}, "signal")
+        await self.signal(other, "answer", SDP_B64_BYTES)
+        for _ in range(CANDIDATES_PER_SIDE):
+            await self.signal(other, "candidate", CANDIDATE_B64_BYTES)
+
+    async def connect(self):
+        b = self.bench
+        uri = f"wss://127.0.0.1:{b.ports[self.node]}/?room={self.room_id}&user={self.user}"
+        if JOIN_SECRET:
+            uri += "&token=" + jointoken.issue(JOIN_SECRET, self.room_id, self.user)
+        async with b.connect_sem:
+            self.ws = await websockets.connect(uri, ssl=b.ctx, max_size=2**20, ping_interval=None)
+        b.metrics.connects += 1
+        self.reader_task = asyncio.ensure_future(self.reader())
+        await self.send({"type": "hello", "from": self.user}, "hello")
+
+    async def close(self):
+        try:
+            await self.ws.close()
+        except Exception:
+            pass
+        if self.reader_task:
+            try:
+                await asyncio.wait_for(self.reader_task, 5)
+            except Exception:
+                self.reader_task.cancel()
+
+    async def reader(self):
+        m = self.bench.metrics
+        try:
+            async for raw in self.ws:
+                now = time.perf_counter()
+                try:
+                    msg = json.loads(raw)
+                except Exception:
+                    m.count(m.recv, "non_json")
+                    continue
+                mtype = msg.get("type")
+                m.count(m.recv, mtype)
+                if mtype == "peer_list":
+                    others = [u for u in msg.get("users", []) if u != self.user]
+                    self.known.update(others)
+                    if msg.get("intros") != "server":
+                        # joiner drives one handshake per existing peer (like ensurePeer)
+                        for u in others:
+                            self.spawn(self.handshake(u))
+                elif mtype == "peer_joined":
+                    self.known.add(msg.get("user"))
+                elif mtype == "peer_left":
+                    self.known.discard(msg.get("user"))
+                elif mtype in ("signal", "signal_batch"):
+                    if mtype == "signal_batch":
+                        items = msg.get("items") or []
+                    else:
+                        items = [msg.get("data") or {}]
+                    for data in items:
+                        t = data.get("bench_t")
+                        if t is not None:
+                            m.lat["signal"].append(now - t)
+                            if data.get("bench_node", self.node) != self.node:
+                                m.lat["cross_node"].append(now - t)
+                        if data.get("k") == "offer" and msg.get("from"):
+                            self.spawn(self.answer(msg["from"]))
+                        elif data.get("k") == "answer" and msg.get("from"):
+                            # stands in for pc.connectionState == "connected"
+                            self.spawn(self.send({"type": "intro_ack", "peer": msg["from"], "ok": True}, "intro_ack"))
+                        elif data.get("type") == "intro" and data.get("other"):
+                            # both sides are introduced; the lower name offers (like the browser)
+                            if self.user < data["other"]:
+                                self.spawn(self.handshake(data["other"]))
+                elif mtype == "chat":
+                    text = msg.get("text", "")
+                    if text.startswith("bench:"):
+                        m.lat["chat"].append(now - float(text.split(":", 2)[1]))
+        except websockets.ConnectionClosed:
+            pass
+        except Exception:
+            m.errors += 1
+
+
+class Bench:
+    def __init__(self, ports, ctx, rooms, peers):
+        self.ports = ports
+        self.ctx = ctx
+        self.n_rooms = rooms
+        self.n_peers = peers
+        self.metrics = Metrics()
+        self.connect_sem = asyncio.Semaphore(64)
+        self.rooms = {}  # room_id -> [BenchPeer]
+        self.wave = 0
+
+    async def join_all(self):
+        self.wave += 1
+        joins = []
+        for r in range(self.n_rooms):
+            room_id = f"bench-{self.wave}-{r}"
+            self.rooms[room_id] = []
+            joins.append(self.join_room(room_id))
+        await asyncio.gather(*joins)
+
+    async def join_room(self, room_id):
+        # Peers of one room join one after another, like people entering a call.
+        for i in range(self.n_peers):
+            peer = BenchPeer(self, room_id, f"u{i}", i % len(self.ports))
+            await peer.connect()
+            self.rooms[room_id].append(peer)
+            await asyncio.sleep(0.01)
+
+    async def leave_all(self):
+        peers = [p for ps in self.rooms.values() for p in ps]
+        await asyncio.gather(*(p.close() for p in peers))
+        self.rooms = {}
+
+    async def steady(self, duration, chat_every, trickle_every, churn_every):
+        stop = time.perf_counter() + duration
+
+        async def pause(mean):
+            left = stop - time.perf_counter()
+            await asyncio.sleep(min(random.expovariate(1.0 / mean), max(left, 0)))
+            return time.perf_counter() < stop
+
+        async def chatter(peer):
+            while await pause(chat_every):
+                if peer.ws and peer.ws.open:
+                    await peer.send({"type": "chat", "text": f"bench:{time.perf_counter()}:hello"}, "chat")
+
+        async def trickler(peer):
+            while await pause(trickle_every):
+                targets = list(peer.known)
+                if targets and peer.ws and peer.ws.open:
+                    await peer.signal(random.choice(targets), "candidate", CANDIDATE_B64_BYTES)
+
+        async def churner(room_id):
+            while await pause(churn_every):
+                peers = self.rooms.get(room_id) or []
+                if not peers:
+                    continue
+                i = random.randrange(len(peers))
+                old = peers[i]
+                await old.close()
+                fresh = BenchPeer(self, room_id, old.user, old.node)
+                await fresh.connect()
+                peers[i] = fresh
+
+        tasks = []
+        for room_id, peers in self.rooms.items():
+            for p in peers:
+                tasks.append(chatter(p))
+                tasks.append(trickler(p))
+            if churn_every > 0:
+                tasks.append(churner(room_id))
+        await asyncio.gather(*tasks)
+
+
+# ----------------- relay CPU micro-benchmark -----------------
+def relay_cpu(n):
+    """CPU seconds per relayed signal frame, legacy full parse vs envelope fast path."""
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, ROOT)
+    import signaling
+
+    def frame(kind, size):
+        data = {"type": "encrypted", "b64": _blob(size)}
+        # JSON.stringify output: compact, keys in insertion order
+        return json.dumps({"type": "signal", "to": "bob", "from": "alice", "data": data},
+                          separators=(",", ":"))
+
+    mix = [frame("offer", SDP_B64_BYTES)] + [frame("candidate", CANDIDATE_B64_BYTES)] * CANDIDATES_PER_SIDE
+
+    def legacy(raw):
+        msg = json.loads(raw)
+        msg["from"] = "alice"
+        return msg["to"], json.dumps(msg)
+
+    def codec(raw):
+        msg = signaling.loads(raw)
+        msg["from"] = "alice"
+        return msg["to"], signaling.dumps(msg)
+
+    sender_json = signaling.dumps("alice")
+
+    def fast(raw):
+        return signaling.signal_target(raw), signaling.stamp_sender(raw, sender_json)
+
+    out = {"frames_per_run": n, "mix": f"1 offer : {CANDIDATES_PER_SIDE} candidates",
+           "codec": "orjson" if signaling.loads is not json.loads else "json"}
+    for name, fn in (("legacy_json", legacy), ("full_parse_codec", codec), ("envelope_fast_path", fast)):
+        t0 = time.process_time()
+        for i in range(n):
+            fn(mix[i % len(mix)])
+        out[name + "_us_per_msg"] = round(1e6 * (time.process_time() - t0) / n, 3)
+    out["speedup_vs_legacy"] = round(out["legacy_json_us_per_msg"] / max(out["envelope_fast_path_us_per_msg"], 1e-9), 1)
+    return out
+
+
+# ----------------- runner -----------------
+def lat_summary(vals):
+    vals = sorted(vals)
+    if not vals:
+        return {"count": 0}
+    return {
+        "count": len(vals),
+        "p50_ms": round(1000 * percentile(vals, 50), 3),
+        "p95_ms": round(1000 * percentile(vals, 95), 3),
+        "p99_ms": round(1000 * percentile(vals, 99), 3),
+        "max_ms": round(1000 * vals[-1], 3),
+    }
+
+
+def _raise_nofile():
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+async def run_async(args, ports, ctx, probe):
+    bench = Bench(ports, ctx, args.rooms, args.peers)
+    n = args.rooms * args.peers
+    idle = await probe.wait_fresh()
+
+    t0 = time.perf_counter()
+    await bench.join_all()
+    setup_s = time.perf_counter() - t0
+    await asyncio.sleep(1.0)  # let handshake replies drain
+    setup_lat = lat_summary(bench.metrics.lat["signal"])
+    bench.metrics.reset()
+
+    if args.soak:
+        return await soak(bench, args, probe, idle, setup_s, setup_lat)
+    if args.idle:
+        return await idle_connections(bench, args, probe, idle, setup_s)
+
+    start = await probe.wait_fresh()
+    t1 = time.perf_counter()
+    await bench.steady(args.duration, args.chat_every, args.trickle_every, args.churn_every)
+    elapsed = time.perf_counter() - t1
+    end = await probe.wait_fresh()
+
+    m = bench.metrics
+    await bench.leave_all()
+    quiet = await probe.wait_quiet()
+
+    delivered = sum(m.recv.values())
+    return {
+        "mode": "bench",
+        "peers_total": n,
+        "nodes": len(ports),
+        "setup": {"seconds": round(setup_s, 3), "signal_latency": setup_lat},
+        "steady": {
+            "seconds": round(elapsed, 3),
+            "sent": m.sent,
+            "received": m.recv,
+            "errors": m.errors,
+            "delivered_per_s": round(delivered / elapsed, 1),
+            "signal_latency": lat_summary(m.lat["signal"]),
+            "chat_latency": lat_summary(m.lat["chat"]),
+            "cross_node_signal_latency": lat_summary(m.lat["cross_node"]),
+        },
+        "server": {
+            "cpu_percent": round(100 * (end["cpu"] - start["cpu"]) / max(end["t"] - start["t"], 1e-9), 1),
+            "rss_idle_mb": round(idle["rss"] / 2**20, 2),
+            "rss_loaded_mb": round(end["rss"] / 2**20, 2),
+            "bytes_per_connection": int((end["rss"] - idle["rss"]) / max(end["peers"], 1)),
+            "after_leave": {"rooms": quiet["rooms"], "peers": quiet["peers"]},
+            "join_to_connected": quiet.get("intros"),
+            "leak_suspected": bool(quiet["rooms"] or quiet["peers"]),
+        },
+    }
+
+
+async def idle_connections(bench, args, probe, idle, setup_s):
+    """Hold every connection open and quiet: what does one cost the server?"""
+    await asyncio.sleep(2.0)  # intro handshakes settle
+    start = await probe.wait_fresh()
+    await asyncio.sleep(args.duration)
+    end = await probe.wait_fresh()
+    await bench.leave_all()
+    quiet = await probe.wait_quiet()
+
+    n = max(end["peers"], 1)
+    dt = max(end["t"] - start["t"], 1e-9)
+    cpu = end["cpu"] - start["cpu"]
+    return {
+        "mode": "idle",
+        "liveness": os.environ.get("SIGNAL_LIVENESS", "wheel"),
+        "connections": end["peers"],
+        "setup": {"seconds": round(setup_s, 3)},
+        "server": {
+            "seconds": round(dt, 3),
+            "cpu_percent": round(100 * cpu / dt, 2),
+            "cpu_us_per_connection_per_s": round(1e6 * cpu / dt / n, 3),
+            "rss_idle_mb": round(idle["rss"] / 2**20, 2),
+            "rss_loaded_mb": round(end["rss"] / 2**20, 2),
+            "bytes_per_connection": int((end["rss"] - idle["rss"]) / n),
+            "liveness_pings": end.get("liveness_pings", 0) - start.get("liveness_pings", 0),
+            "after_leave": {"rooms": quiet["rooms"], "peers": quiet["peers"]},
+        },
+    }
+
+
+async def soak(bench, args, probe, idle, setup_s, setup_lat):
+    waves = []
+    deadline = time.perf_counter() + args.soak
+    first = True
+    while time.perf_counter() < deadline:
+        if not first:
+            await bench.join_all()
+        first = False
+        await bench.steady(args.wave, args.chat_every, args.trickle_every, args.churn_every)
+        await bench.leave_all()
+        s = await probe.wait_quiet()
+        waves.append({"wave": bench.wave, "rooms": s["rooms"], "peers": s["peers"],
+                      "rss_mb": round(s["rss"] / 2**20, 2), "errors": bench.metrics.errors})
+        print(f"wave {bench.wave}: rooms={s['rooms']} peers={s['peers']} rss={s['rss'] / 2**20:.1f}MB")
+        bench.metrics.errors = 0
+
+    half = waves[len(waves) // 2:] or waves
+    growth = (half[-1]["rss_mb"] - half[0]["rss_mb"]) / max(half[0]["rss_mb"], 1e-9)
+    return {
+        "mode": "soak",
+        "peers_total": args.rooms * args.peers,
+        "setup": {"seconds": round(setup_s, 3), "signal_latency": setup_lat},
+        "waves": waves,
+        "server": {
+            "rss_idle_mb": round(idle["rss"] / 2**20, 2),
+            "rss_growth_second_half": round(growth, 4),
+            "rooms_left_behind": max(w["rooms"] for w in waves),
+            # RSS growth is only meaningful once allocator warm-up is behind us
+            "leak_suspected": any(w["rooms"] or w["peers"] for w in waves)
+                              or (len(waves) >= 4 and growth > args.leak_growth),
+        },
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark / soak signaling.py")
+    ap.add_argument("--rooms", type=int, default=10)
+    ap.add_argument("--peers", type=int, default=6, help="peers per room")
+    ap.add_argument("--duration", type=float, default=20.0, help="steady-state seconds")
+    ap.add_argument("--chat-every", type=float, default=2.0, help="mean seconds between chats per peer")
+    ap.add_argument("--trickle-every", type=float, default=0.5, help="mean seconds between candidates per peer")
+    ap.add_argument("--churn-every", type=float, default=5.0, help="mean seconds between leave/rejoin per room (0=off)")
+    ap.add_argument("--soak", type=float, default=0, help="run join/leave waves for this many seconds")
+    ap.add_argument("--wave", type=float, default=15.0, help="steady seconds per soak wave")
+    ap.add_argument("--leak-growth", type=float, default=0.10, help="soak RSS growth treated as a leak")
+    ap.add_argument("--nodes", type=int, default=1, help="signaling nodes behind a pubsub broker")
+    ap.add_argument("--relay-cpu", type=int, default=0, help="only time N relayed signal frames (no server)")
+    ap.add_argument("--idle", type=int, default=0,
+                    help="only hold N quiet connections (--peers per room) for --duration and report their cost")
+    ap.add_argument("--out", help="result JSON path")
+    args = ap.parse_args()
+
+    if args.relay_cpu:
+        result = relay_cpu(args.relay_cpu)
+        print(json.dumps(result, indent=2))
+        save_report(args, result)
+        return
+
+    _raise_nofile()
+    if args.idle:
+        args.rooms = max(1, -(-args.idle // args.peers))
+    workdir = tempfile.mkdtemp(prefix="bench_sig_")
+    crt, key = make_self_signed_cert(workdir)
+    ports = [free_port() for _ in range(args.nodes)]
+
+    broker = None
+    spec = None
+    if args.nodes > 1:
+        os.environ.setdefault("LOG_LEVEL", "WARNING")  # broker and nodes inherit it
+        import pubsub
+        sock = os.path.join(workdir, "broker.sock")
+        broker = pubsub.start_broker(sock)
+        spec = "broker:" + sock
+
+    probe_q = mp.Queue()
+    servers = []
+    for i, port in enumerate(ports):
+        servers.append(mp.Process(target=_server_proc, daemon=True, args=(
+            port, crt, key, probe_q if i == 0 else None, 0.5, spec, f"bench-node-{i}")))
+        servers[-1].start()
+
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+
+    probe = ServerProbe(probe_q)
+    try:
+        result = asyncio.run(_with_server(args, ports, ctx, probe))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.join(5)
+        if broker is not None:
+            broker.terminate()
+            broker.wait(5)
+
+    print(json.dumps(result, indent=2))
+    save_report(args, result)
+
+
+def save_report(args, result):
+    report = {
+        "bench": "signaling",
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "result": result,
+    }
+    out = args.out or os.path.join(
+        ROOT, "bench_results", f"signaling_{report['commit']}_{datetime.utcnow():%Y%m%d%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {out}")
+
+
+async def _with_server(args, ports, ctx, probe):
+    # wait for the children to accept TLS
+    deadline = time.time() + 10
+    for port in ports:
+        while True:
+            try:
+                uri = f"wss://127.0.0.1:{port}/?room=_probe&user=_probe"
+                if JOIN_SECRET:
+                    uri += "&token=" + jointoken.issue(JOIN_SECRET, "_probe", "_probe")
+                ws = await websockets.connect(uri, ssl=ctx)
+                await ws.close()
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+    await probe.wait_quiet()
+    return await run_async(args, ports, ctx, probe)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+# combined.py
+import os, time, http, signal, asyncio, argparse, functools, urllib.parse
+import concurrent.futures
+from urllib.parse import urlparse, parse_qs
+
+from websockets.legacy.server import WebSocketServer, WebSocketServerProtocol
+
+import jsonlog
+import app
+import signaling
+
+"""
+Single-process deployment of app.py and signaling.py.
+
+  python combined.py --port 34535
+
+One asyncio loop, one port and one TLS context serve both. A connection's
+request head is read here: websocket upgrades are handed to signaling.handler
+on the same TLS transport, everything else is routed by app.handle_request in
+a thread pool (its handlers block on SQLite, SMTP and Cloudflare).
+
+Both sides share one process and so one room registry: a websocket join is
+only accepted if it carries a join token signed with app.SECRET_KEY, the
+session cookie sent with the upgrade belongs to `user=` and app.ROOMS says
+that user may enter `room=` (owner, or joined with the key). Rooms of
+app.ROOMS with nobody connected to signaling for ROOM_TTL seconds are
+dropped. The room page connects its websocket back to the same
+host:port (app.SIGNAL_SAME_ORIGIN).
+
+/healthz and /metrics are signaling.py's; SIGTERM drains like signaling.py.
+"""
+
+MAX_HEAD = 16 * 1024
+MAX_BODY = int(os.environ.get("COMBINED_MAX_BODY", str(16 * 2**20)))  # uploads (backgrounds)
+READ_TIMEOUT = 5.0  # same as app.handle_client
+APP_THREADS = int(os.environ.get("COMBINED_APP_THREADS", "32"))
+ROOM_TTL = float(os.environ.get("COMBINED_ROOM_TTL", "3600"))  # seconds empty before a room is dropped
+SWEEP_INTERVAL = 60.0
+
+log = jsonlog.get_logger("combined")
+
+
+def _cookie(header, name):
+    for kv in (header or "").split(";"):
+        k, _, v = kv.strip().partition("=")
+        if k == name:
+            return urllib.parse.unquote(v)
+    return None
+
+
+def _plain(status, text):
+    body = text.encode()
+    return (status, [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))], body)
+
+
+class Runtime:
+    def __init__(self):
+        self.ws_server = WebSocketServer()
+        opts = {k: v for k, v in signaling.SERVE_OPTS.items() if k != "process_request"}
+        self.ws_factory = functools.partial(WebSocketServerProtocol, signaling.handler, self.ws_server,
+                                            process_request=self.authorize, **opts)
+        self.pool = concurrent.futures.ThreadPoolExecutor(APP_THREADS, thread_name_prefix="app")
+        self.empty_since = {}  # app room id -> monotonic time it was first seen without peers
+
+    # ---- websocket joins: in-memory checks against app's sessions and rooms ----
+    async def authorize(self, path, request_headers):
+        early = await signaling.process_request(path, request_headers)  # draining
+        if early is not None:
+            return early
+        query = parse_qs(urlparse(path).query)
+        room_id = query.get("room", [""])[0]
+        user = query.get("user", [""])[0]
+        sess = app.session_data(_cookie(request_headers.get("Cookie"), app.SESSION_COOKIE_NAME))
+        if sess is None or sess.get("user") != user or not app.may_enter_room(sess, room_id):
+            log.warning("signaling join refused", room=room_id, user=user, session=sess is not None)
+            return _plain(http.HTTPStatus.FORBIDDEN, "Forbidden\n")
+        return None
+
+    async def upgrade(self, writer, head):
+        # Hand the TLS transport over to a websockets protocol and replay the
+        # request head we already consumed; websockets does the handshake.
+        transport = writer.transport
+        proto = self.ws_factory()
+        transport.set_protocol(proto)
+        proto.connection_made(transport)
+        proto.data_received(head)
+        # a collected StreamWriter closes its transport: hold it until the websocket is done
+        await proto.wait_closed()
+
+    # ---- plain HTTP ----
+    async def handle(self, reader, writer):
+        jsonlog.set_request_id()
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        headers = {}
+        for line in head.decode("iso-8859-1").split("\r\n")[1:]:
+            k, sep, v = line.partition(":")
+            if sep:
+                headers[k.strip().lower()] = v.strip()
+
+        if headers.get("upgrade", "").lower() == "websocket":
+            await self.upgrade(writer, head)
+            return
+
+        try:
+            path = head.split(b"\r\n", 1)[0].split()[1].decode("iso-8859-1")
+            length = int(headers.get("content-length") or 0)
+        except (IndexError, ValueError):
+            writer.close()
+            return
+
+        try:
+            if urlparse(path).path in ("/healthz", "/metrics"):
+                status, hdrs, body = await signaling.process_request(path, headers)
+                writer.write(f"HTTP/1.1 {status.value} {status.phrase}\r\n".encode()
+                             + b"".join(f"{k}: {v}\r\n".encode() for k, v in hdrs)
+                             + b"Connection: close\r\n\r\n" + body)
+            elif length > MAX_BODY:
+                writer.write(b"HTTP/1.1 413 Payload Too Large\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            else:
+                body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT) if length else b""
+                loop = asyncio.get_running_loop()
+                writer.write(await loop.run_in_executor(self.pool, app.handle_request, head + body))
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    # ---- room cleanup ----
+    def sweep(self, now):
+        for room_id in list(app.ROOMS):
+            if room_id in signaling.rooms:
+                self.empty_since.pop(room_id, None)
+            elif now - self.empty_since.setdefault(room_id, now) >= ROOM_TTL:
+                app.ROOMS.pop(room_id, None)
+                del self.empty_since[room_id]
+                log.info("room expired", room=room_id, idle_s=ROOM_TTL)
+        for room_id in [r for r in self.empty_since if r not in app.ROOMS]:
+            del self.empty_since[room_id]
+
+    async def sweeper(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            self.sweep(time.monotonic())
+
+
+# ----------------- entrypoint -----------------
+async def main(host="0.0.0.0", port=34535, certfile="crt/server.crt", keyfile="crt/server.key"):
+    app.init_db()
+    app.check_static()
+    app.SIGNAL_SAME_ORIGIN = True
+    signaling.set_join_secret(app.SECRET_KEY)  # tokens from the page verify against the same key
+    await signaling.setup_bus()
+    signaling.start_monitor()
+
+    rt = Runtime()
+    server = await asyncio.start_server(rt.handle, host, port, ssl=app.tls_context(certfile, keyfile),
+                                        limit=MAX_HEAD, reuse_port=signaling.REUSE_PORT)
+    rt.ws_server.wrap(server)
+    signaling.spawn(rt.sweeper())
+    log.info("combined app + signaling server", url=f"https://{host}:{port}", pubsub=type(signaling.bus).__name__)
+
+    drained = asyncio.Event()
+
+    async def drain_and_stop():
+        await signaling.drain(rt.ws_server)
+        drained.set()
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: signaling.spawn(drain_and_stop()))
+    except NotImplementedError:
+        pass
+    try:
+        await drained.wait()
+    finally:
+        rt.ws_server.close()
+        await rt.ws_server.wait_closed()
+        rt.pool.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="app.py and signaling.py in one process")
+    ap.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    ap.add_argument("--port", type=int, default=int(os.environ.get("PORT", "34535")))
+    ap.add_argument("--cert", default=os.environ.get("TLS_CERT", "crt/server.crt"))
+    ap.add_argument("--key", default=os.environ.get("TLS_KEY", "crt/server.key"))
+    args = ap.parse_args()
+    try:
+        asyncio.run(main(args.host, args.port, args.cert, args.key))
+    except KeyboardInterrupt:
+        log.info("combined server stopped by user (Ctrl+C)")
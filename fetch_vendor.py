@@ -0,0 +1,124 @@
+# fetch_vendor.py
+import os, io, sys, json, base64, hashlib, tarfile, argparse, urllib.request
+
+"""
+Fetch the third-party browser code the room page serves from /static/vendor
+(it loads no script from a CDN):
+
+  python fetch_vendor.py           # download what is missing, verify it
+  python fetch_vendor.py --check   # only verify what is there (exit 1 if not ok)
+
+Today that is the TF.js runtime for background filters, static/vendor/tf.min.js,
+taken from the npm package @tensorflow/tfjs@4.20.0. The tarball is checked
+against the sha512 the registry publishes for that version (what npm itself
+checks). The extracted file is then checked against the SHA-256 recorded in
+static/vendor/tf.min.js.sha256: commit that file, and every later fetch (the
+Docker build, a fresh checkout) must produce the same bytes. The first fetch
+on a tree without it writes it.
+"""
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+VENDOR_DIR = os.path.join(ROOT, "static", "vendor")
+REGISTRY = "https://registry.npmjs.org"
+TIMEOUT = 60
+
+# (npm package, version, file in the tarball, file under static/vendor)
+ASSETS = [
+    ("@tensorflow/tfjs", "4.20.0", "package/dist/tf.min.js", "tf.min.js"),
+]
+
+
+def _get(url):
+    with urllib.request.urlopen(url, timeout=TIMEOUT) as r:
+        return r.read()
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def verify_integrity(data, integrity):
+    """npm's dist.integrity: "sha512-<base64 digest>"."""
+    algo, _, digest = integrity.partition("-")
+    if algo != "sha512":
+        raise ValueError(f"unsupported integrity {algo!r}")
+    if base64.b64decode(digest) != hashlib.sha512(data).digest():
+        raise ValueError("tarball does not match the registry's sha512")
+
+
+def fetch(package, version, member):
+    meta = json.loads(_get(f"{REGISTRY}/{package}/{version}"))
+    tarball = _get(meta["dist"]["tarball"])
+    verify_integrity(tarball, meta["dist"]["integrity"])
+    with tarfile.open(fileobj=io.BytesIO(tarball), mode="r:gz") as tar:
+        return tar.extractfile(member).read()
+
+
+def lock_path(name):
+    return os.path.join(VENDOR_DIR, name + ".sha256")
+
+
+def read_lock(name):
+    try:
+        with open(lock_path(name), "r", encoding="ascii") as f:
+            return f.read().split()[0]
+    except FileNotFoundError:
+        return None
+
+
+def check(name):
+    """None if static/vendor/<name> is there and matches its lock, else what is wrong."""
+    path = os.path.join(VENDOR_DIR, name)
+    if not os.path.isfile(path):
+        return "missing"
+    want = read_lock(name)
+    if want is None:
+        return "no checksum recorded"
+    with open(path, "rb") as f:
+        if _sha256(f.read()) != want:
+            return "checksum mismatch"
+    return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fetch and verify static/vendor")
+    ap.add_argument("--check", action="store_true", help="verify only, download nothing")
+    args = ap.parse_args()
+
+    failed = False
+    os.makedirs(VENDOR_DIR, exist_ok=True)
+    for package, version, member, name in ASSETS:
+        problem = check(name)
+        if problem is None:
+            print(f"{name}: ok")
+            continue
+        if args.check or problem == "checksum mismatch":
+            print(f"{name}: {problem}", file=sys.stderr)
+            failed = True
+            continue
+        try:
+            data = fetch(package, version, member)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"{name}: cannot fetch {package}@{version}: {e}", file=sys.stderr)
+            failed = True
+            continue
+        digest, want = _sha256(data), read_lock(name)
+        if want is not None and digest != want:
+            print(f"{name}: {package}@{version} does not match {lock_path(name)}", file=sys.stderr)
+            failed = True
+            continue
+        tmp = os.path.join(VENDOR_DIR, name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(VENDOR_DIR, name))
+        if want is None:
+            with open(lock_path(name), "w", encoding="ascii") as f:
+                f.write(f"{digest}  {name}  {package}@{version}\n")
+            print(f"{name}: fetched, recorded {digest} (commit {os.path.relpath(lock_path(name), ROOT)})")
+        else:
+            print(f"{name}: fetched, verified")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# jointoken.py
+import hmac, json, time, base64, hashlib, secrets, collections
+
+"""
+Short-lived signed tokens that let signaling.py admit a websocket without
+asking app.py anything.
+
+app.py issues one per room page (and per reconnect, /api/signal-token):
+
+  token = issue(SECRET_KEY, room_id, username, ttl=120)
+
+signaling.py, sharing SECRET_KEY, checks it against the room and user of
+the upgrade request:
+
+  verifier = Verifier(SECRET_KEY)
+  verifier.check(token, room_id, username)   # True once per token
+
+A token is "<expiry>.<nonce>.<mac>", mac = HMAC-SHA256 over the JSON array
+[room, user, expiry, nonce] (so no choice of room or user name can make two
+different tuples sign the same bytes). Checking is one HMAC and a set lookup, with no I/O; each
+nonce is accepted once (a replay cache remembers nonces until they
+expire). When the cache holds replay_max live nonces, new tokens are
+refused until some expire; forgetting a live nonce would allow a replay.
+"""
+
+
+def _mac(key, room_id, user, exp, nonce):
+    msg = json.dumps([room_id, user, exp, nonce], separators=(",", ":")).encode("ascii")
+    return base64.urlsafe_b64encode(hmac.new(key, msg, hashlib.sha256).digest()[:18]).decode()
+
+
+def _key(secret):
+    return secret.encode("utf-8") if isinstance(secret, str) else secret
+
+
+def issue(secret, room_id, user, ttl=120):
+    exp = int(time.time() + ttl)
+    nonce = secrets.token_urlsafe(9)
+    return f"{exp}.{nonce}.{_mac(_key(secret), room_id, user, exp, nonce)}"
+
+
+class Verifier:
+    def __init__(self, secret, replay_max=100_000):
+        self.key = _key(secret)
+        self.replay_max = replay_max
+        self.seen = set()                  # nonces used and not yet expired
+        self.order = collections.deque()   # (expiry, nonce), in use (roughly expiry) order
+
+    def _prune(self, now):
+        order = self.order
+        while order and order[0][0] <= now:
+            self.seen.discard(order.popleft()[1])
+
+    def check(self, token, room_id, user, now=None):
+        """True if token was issued for (room_id, user), is unexpired and unused."""
+        try:
+            exp_s, nonce, mac = token.split(".")
+            exp = int(exp_s)
+        except (AttributeError, ValueError):
+            return False
+        now = time.time() if now is None else now
+        if exp <= now:
+            return False
+        expected = _mac(self.key, room_id, user, exp, nonce)
+        if not hmac.compare_digest(mac.encode("utf-8"), expected.encode("ascii")):
+            return False
+        self._prune(now)
+        if nonce in self.seen:
+            return False
+        if len(self.order) >= self.replay_max:
+            return False  # full of live nonces: refuse rather than forget one that could be replayed
+        self.seen.add(nonce)
+        self.order.append((exp, nonce))
+        return True
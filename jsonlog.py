@@ -0,0 +1,202 @@
+# jsonlog.py
+import os, sys, json, copy, queue, random, atexit, secrets, logging, threading, contextvars
+import logging.handlers
+
+"""
+Structured logging shared by app.py and signaling.py.
+
+Every record is written as one JSON line by a background thread: callers only
+push the record onto a bounded queue, so request threads and the signaling
+event loop never block on stdout. If the queue is full the record is dropped
+(and counted) instead of waiting.
+
+Config (env):
+  LOG_LEVEL     default level for every logger           (INFO)
+  LOG_LEVELS    per-module overrides "app.ice=DEBUG,signaling=WARNING"
+  LOG_FILE      write to this file instead of stdout
+  LOG_QUEUE_MAX max records waiting for the writer thread (10000)
+
+Usage:
+  log = get_logger("app.ice")
+  log.info("ice servers issued", room=room_id, count=3, sample=0.1)
+
+Keyword arguments become JSON fields. `sample=` keeps only that fraction of
+the records (for high-volume events). The current request id (see
+`set_request_id`) is stamped on every record.
+"""
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+_lock = threading.Lock()
+_listener = None
+_queue = None
+DROPPED = 0  # records lost because the writer could not keep up
+
+
+# ----------------- request ids -----------------
+def new_request_id():
+    return secrets.token_hex(8)
+
+def get_request_id():
+    return _request_id.get()
+
+def set_request_id(rid=None):
+    """Bind a request id to the current thread / asyncio task. Returns the id."""
+    rid = rid or new_request_id()
+    _request_id.set(rid)
+    return rid
+
+
+# ----------------- records -----------------
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        rid = getattr(record, "request_id", None)
+        if rid:
+            out["request_id"] = rid
+        fields = getattr(record, "fields", None)
+        if fields:
+            for k, v in fields.items():
+                out.setdefault(k, v)
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        elif record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, default=str, ensure_ascii=False)
+
+
+class _ContextFilter(logging.Filter):
+    # Runs in the caller's thread/task, so the contextvar is still visible here.
+    def filter(self, record):
+        if getattr(record, "request_id", None) is None:
+            record.request_id = _request_id.get()
+        return True
+
+
+class _SamplingFilter(logging.Filter):
+    def filter(self, record):
+        rate = getattr(record, "sample", None)
+        if rate is None or rate >= 1:
+            return True
+        return random.random() < rate
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Keep the record structured: resolve args/exception here (they may not
+        # be picklable or stable later) but do not pre-format the line.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global DROPPED
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED += 1
+
+
+class EventLogger(logging.LoggerAdapter):
+    """Logger whose keyword arguments become JSON fields."""
+
+    _RESERVED = ("exc_info", "stack_info", "stacklevel", "extra")
+
+    def __init__(self, logger):
+        super().__init__(logger, {})
+
+    def process(self, msg, kwargs):
+        extra = dict(kwargs.pop("extra", None) or {})
+        sample = kwargs.pop("sample", None)
+        if sample is not None:
+            extra["sample"] = sample
+        fields = {k: kwargs.pop(k) for k in list(kwargs) if k not in self._RESERVED}
+        if fields:
+            extra["fields"] = fields
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+
+# ----------------- setup -----------------
+def _parse_levels(spec):
+    levels = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        name, level = item.split("=", 1)
+        name, level = name.strip(), level.strip().upper()
+        if name and level:
+            levels[name] = level
+    return levels
+
+
+def setup():
+    """Install the queue handler on the root logger (idempotent)."""
+    global _listener, _queue
+    with _lock:
+        if _listener is not None:
+            return
+
+        log_file = os.environ.get("LOG_FILE")
+        if log_file:
+            target = logging.FileHandler(log_file, encoding="utf-8")
+        else:
+            target = logging.StreamHandler(sys.stdout)
+        target.setFormatter(JSONFormatter())
+
+        _queue = queue.Queue(maxsize=int(os.environ.get("LOG_QUEUE_MAX", "10000")))
+        qh = _QueueHandler(_queue)
+        qh.addFilter(_SamplingFilter())
+        qh.addFilter(_ContextFilter())
+
+        root = logging.getLogger()
+        root.addHandler(qh)
+        root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        for name, level in _parse_levels(os.environ.get("LOG_LEVELS")).items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(_queue, target, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def _after_fork():
+    # The writer thread does not survive fork(); start a fresh one lazily in the child.
+    global _listener, _queue, _lock
+    _lock = threading.Lock()
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        if isinstance(h, _QueueHandler):
+            root.removeHandler(h)
+    _listener = None
+    _queue = None
+    setup()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def shutdown():
+    """Flush pending records and stop the writer thread."""
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name):
+    setup()
+    return EventLogger(logging.getLogger(name))
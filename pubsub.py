@@ -0,0 +1,377 @@
+# pubsub.py
+import os, sys, json, time, socket, asyncio, argparse, itertools, subprocess
+
+import jsonlog
+
+"""
+Room pub/sub for signaling.py, so the peers of one room can sit on different
+signaling nodes (one huge room, rolling deploys).
+
+Each node talks to a Hub. The Hub keeps, per room, which node holds which
+username and who the host is, and forwards frames between nodes:
+
+  join(room, user)               -> {"members": {user: node}, "host": ..., "version": v}
+  leave(room, user)
+  claim_host(room, expect, host) -> True if the host was `expect` and is now `host`
+  publish(room, data, key)       frame for every client of the room on other nodes
+  send(room, user, data, close)  frame for one username, wherever it is
+
+Events delivered back to a node's callback (dicts, "ev" says which). The
+roster events go to every node of the room, including the origin, in the
+order of their roster version `v`:
+
+  join   {room, user, node, v}           username now lives on `node`
+  leave  {room, user, node, lost, v}     lost=True: its node went away
+  host   {room, host, v}
+  msg    {room, data, key}               from publish()
+  to     {room, user, data, close}       from send()
+
+Every membership or host change bumps the room's roster version by one (a
+rejoin from the same node is announced again without a bump). The Hub is the
+only place the host changes, so every node sees the same host sequence:
+claim_host is a compare-and-set, and a host that leaves (or whose node is
+lost) is replaced by the alphabetically first remaining member.
+
+Backends:
+  LocalBus   the Hub lives in this process (default; single node)
+  BrokerBus  the Hub lives in `python pubsub.py --socket PATH`, reached over a
+             Unix socket with newline-delimited JSON. Writes are batched: all
+             frames queued during one event-loop pass go out as one write, in
+             both directions, so a broadcast costs one write per node.
+
+SIGNAL_PUBSUB selects the backend: "local" or "broker:/path/to/broker.sock".
+"""
+
+log = jsonlog.get_logger("signaling.pubsub")
+
+
+# ----------------- hub (room membership + routing) -----------------
+class Hub:
+    def __init__(self):
+        self.sinks = {}  # node -> callable(event)
+        # room_id -> {"members": {user: node}, "nodes": {node: member count},
+        #             "host": str|None, "version": int}
+        self.rooms = {}
+
+    def attach(self, node, sink):
+        self.sinks[node] = sink
+
+    def detach(self, node):
+        """Drop a node and everything it held (its peers are reported as lost)."""
+        self.sinks.pop(node, None)
+        for room_id in list(self.rooms):
+            room = self.rooms[room_id]
+            gone = [u for u, n in room["members"].items() if n == node]
+            for user in gone:
+                self._remove(room_id, room, user, node, lost=True)
+
+    def _emit(self, room, event, skip=None):
+        for node in room["nodes"]:
+            if node != skip:
+                sink = self.sinks.get(node)
+                if sink is not None:
+                    sink(event)
+
+    def join(self, node, room_id, user):
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = {"members": {}, "nodes": {}, "host": None, "version": 0}
+        prev = room["members"].get(user)
+        if prev != node:
+            if prev is not None:
+                self._uncount(room, prev)
+            room["members"][user] = node
+            room["nodes"][node] = room["nodes"].get(node, 0) + 1
+            room["version"] += 1
+        event = {"ev": "join", "room": room_id, "user": user, "node": node, "v": room["version"]}
+        self._emit(room, event)
+        if prev is not None and prev != node and prev not in room["nodes"]:
+            # the previous node lost its last member but still has to drop the old session
+            sink = self.sinks.get(prev)
+            if sink is not None:
+                sink(event)
+        # a single-node room needs no member list: the node has them all
+        members = dict(room["members"]) if len(room["nodes"]) > 1 else {}
+        return {"members": members, "host": room["host"], "version": room["version"]}
+
+    def leave(self, node, room_id, user):
+        room = self.rooms.get(room_id)
+        if room is not None and room["members"].get(user) == node:
+            self._remove(room_id, room, user, node, lost=False)
+
+    def _uncount(self, room, node):
+        left = room["nodes"].get(node, 0) - 1
+        if left > 0:
+            room["nodes"][node] = left
+        else:
+            room["nodes"].pop(node, None)
+
+    def _remove(self, room_id, room, user, node, lost):
+        del room["members"][user]
+        self._uncount(room, node)
+        room["version"] += 1
+        self._emit(room, {"ev": "leave", "room": room_id, "user": user, "node": node, "lost": lost,
+                          "v": room["version"]})
+        if room["host"] == user:
+            self._set_host(room_id, room, min(room["members"]) if room["members"] else None)
+        if not room["members"]:
+            del self.rooms[room_id]
+
+    def _set_host(self, room_id, room, host):
+        room["host"] = host
+        room["version"] += 1
+        self._emit(room, {"ev": "host", "room": room_id, "host": host, "v": room["version"]})
+
+    def claim_host(self, node, room_id, expect, host):
+        room = self.rooms.get(room_id)
+        if room is None or room["host"] != expect or host not in room["members"]:
+            return False
+        if expect != host:
+            self._set_host(room_id, room, host)
+        return True
+
+    def publish(self, node, room_id, data, key=None):
+        room = self.rooms.get(room_id)
+        if room is not None and len(room["nodes"]) > 1:
+            self._emit(room, {"ev": "msg", "room": room_id, "data": data, "key": key}, skip=node)
+
+    def send(self, node, room_id, user, data, close=False):
+        room = self.rooms.get(room_id)
+        if room is None:
+            return False
+        target = room["members"].get(user)
+        sink = self.sinks.get(target)
+        if sink is None:
+            return False
+        sink({"ev": "to", "room": room_id, "user": user, "data": data, "close": close})
+        return True
+
+
+def default_node_id():
+    return os.environ.get("SIGNAL_NODE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+
+# ----------------- in-process backend -----------------
+_local_hub = Hub()
+
+class LocalBus:
+    """Hub in this process. Several nodes may share one hub (tests)."""
+
+    def __init__(self, deliver, node=None, hub=None):
+        self.node = node or default_node_id()
+        self.hub = hub or _local_hub
+        self.hub.attach(self.node, deliver)
+
+    async def start(self):
+        return self
+
+    async def close(self):
+        self.hub.detach(self.node)
+
+    async def join(self, room_id, user):
+        return self.hub.join(self.node, room_id, user)
+
+    async def leave(self, room_id, user):
+        self.hub.leave(self.node, room_id, user)
+
+    async def claim_host(self, room_id, expect, host):
+        return self.hub.claim_host(self.node, room_id, expect, host)
+
+    def publish(self, room_id, data, key=None):
+        self.hub.publish(self.node, room_id, data, key)
+
+    def send(self, room_id, user, data, close=False):
+        self.hub.send(self.node, room_id, user, data, close)
+
+
+# ----------------- wire batching -----------------
+class _Batcher:
+    """Collects lines during one loop pass and writes them with a single write()."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.lines = []
+        self.scheduled = False
+        self.batches = 0
+        self.frames = 0
+
+    def put(self, obj):
+        self.lines.append(json.dumps(obj, separators=(",", ":")))
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        if not self.lines or self.writer.is_closing():
+            self.lines = []
+            return
+        self.batches += 1
+        self.frames += len(self.lines)
+        self.writer.write(("\n".join(self.lines) + "\n").encode("utf-8"))
+        self.lines = []
+
+
+async def _read_lines(reader, on_line):
+    while True:
+        try:
+            line = await reader.readline()
+        except (ConnectionError, ValueError):
+            return
+        if not line:
+            return
+        on_line(json.loads(line))
+
+
+# ----------------- broker backend (client) -----------------
+class BrokerBus:
+    def __init__(self, sock_path, deliver, node=None):
+        self.sock_path = sock_path
+        self.deliver = deliver
+        self.node = node or default_node_id()
+        self.out = None
+        self.pending = {}  # request id -> future
+        self.ids = itertools.count(1)
+        self.reader_task = None
+
+    async def start(self):
+        reader, writer = await asyncio.open_unix_connection(self.sock_path, limit=2**22)
+        self.out = _Batcher(writer)
+        self.out.put({"op": "hello", "node": self.node})
+        self.reader_task = asyncio.ensure_future(self._reader(reader))
+        log.info("pubsub broker connected", socket=self.sock_path, node=self.node)
+        return self
+
+    async def close(self):
+        if self.out is not None:
+            self.out.flush()
+            self.out.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+
+    async def _reader(self, reader):
+        def on_line(msg):
+            if msg.get("ev") == "reply":
+                fut = self.pending.pop(msg["id"], None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg.get("result"))
+            else:
+                self.deliver(msg)
+
+        await _read_lines(reader, on_line)
+        log.error("pubsub broker connection lost", socket=self.sock_path)
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError("pubsub broker connection lost"))
+        self.pending.clear()
+
+    async def _call(self, op, **kw):
+        if self.out is None or self.out.writer.is_closing():
+            raise ConnectionError("pubsub broker not connected")
+        rid = next(self.ids)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[rid] = fut
+        self.out.put({"op": op, "id": rid, **kw})
+        return await fut
+
+    async def join(self, room_id, user):
+        return await self._call("join", room=room_id, user=user)
+
+    async def leave(self, room_id, user):
+        await self._call("leave", room=room_id, user=user)
+
+    async def claim_host(self, room_id, expect, host):
+        return await self._call("claim_host", room=room_id, expect=expect, host=host)
+
+    def publish(self, room_id, data, key=None):
+        if self.out is not None:
+            self.out.put({"op": "publish", "room": room_id, "data": data, "key": key})
+
+    def send(self, room_id, user, data, close=False):
+        if self.out is not None:
+            self.out.put({"op": "send", "room": room_id, "user": user, "data": data, "close": close})
+
+
+async def connect(spec, deliver, node=None):
+    """Backend from a SIGNAL_PUBSUB spec: "local" or "broker:/path.sock"."""
+    spec = spec or "local"
+    if spec == "local":
+        return await LocalBus(deliver, node).start()
+    if spec.startswith("broker:"):
+        return await BrokerBus(spec[len("broker:"):], deliver, node).start()
+    raise ValueError(f"unknown SIGNAL_PUBSUB backend: {spec!r}")
+
+
+# ----------------- broker process -----------------
+async def serve_broker(sock_path):
+    hub = Hub()
+
+    async def on_conn(reader, writer):
+        out = _Batcher(writer)
+        node = None
+
+        def on_line(msg):
+            nonlocal node
+            op = msg.get("op")
+            if op == "hello":
+                node = msg["node"]
+                hub.attach(node, out.put)
+                log.info("pubsub node attached", node=node)
+                return
+            if node is None:
+                return
+            if op == "publish":
+                hub.publish(node, msg["room"], msg["data"], msg.get("key"))
+            elif op == "send":
+                hub.send(node, msg["room"], msg["user"], msg["data"], msg.get("close", False))
+            elif op == "join":
+                result = hub.join(node, msg["room"], msg["user"])
+                out.put({"ev": "reply", "id": msg["id"], "result": result})
+            elif op == "leave":
+                hub.leave(node, msg["room"], msg["user"])
+                out.put({"ev": "reply", "id": msg["id"], "result": None})
+            elif op == "claim_host":
+                ok = hub.claim_host(node, msg["room"], msg.get("expect"), msg.get("host"))
+                out.put({"ev": "reply", "id": msg["id"], "result": ok})
+
+        try:
+            await _read_lines(reader, on_line)
+        finally:
+            if node is not None and hub.sinks.get(node) == out.put:
+                log.warning("pubsub node detached", node=node)
+                hub.detach(node)
+            writer.close()
+
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    server = await asyncio.start_unix_server(on_conn, sock_path, limit=2**22)
+    log.info("pubsub broker listening", socket=sock_path)
+    async with server:
+        await server.serve_forever()
+
+
+def start_broker(sock_path, timeout=10.0):
+    """Launch `python pubsub.py --socket sock_path` and wait until it accepts. Returns the Popen."""
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--socket", sock_path])
+    deadline = time.time() + timeout
+    while True:
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(sock_path)
+            s.close()
+            return proc
+        except OSError:
+            if proc.poll() is not None or time.time() > deadline:
+                proc.kill()
+                raise RuntimeError("pubsub broker did not start")
+            time.sleep(0.05)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Signaling pub/sub broker")
+    ap.add_argument("--socket", default=os.environ.get("SIGNAL_BROKER_SOCKET", "/tmp/signaling_broker.sock"))
+    args = ap.parse_args()
+    try:
+        asyncio.run(serve_broker(args.socket))
+    except KeyboardInterrupt:
+        log.info("pubsub broker stopped by user (Ctrl+C)")
@@ -0,0 +1,281 @@
+# quantize_model.py
+import os, sys, json, math, time, base64, shutil, argparse
+
+import numpy as np
+
+"""
+Offline quantization of the background-segmentation model (TF.js graph model).
+
+  python quantize_model.py static/tfjs_unet/model.json
+  python quantize_model.py static/tfjs_unet/model.json --images my_photos/ --dtypes float16,uint8
+  python quantize_model.py static/tfjs_unet/model.json --no-iou   # sizes and weight error only
+
+Reads model.json and its weight shards and writes one variant per dtype next
+to it (static/tfjs_unet/float16/, static/tfjs_unet/uint8/): the same graph
+with a rewritten weightsManifest whose float32 weights carry a TF.js
+"quantization" entry, in 4 MB shards. TF.js dequantizes them to float32 at
+load, so what shrinks is the download (and the HTTP cache); inference runs
+as before. app.py picks a variant per client (BG_MODEL_VARIANTS).
+
+For every variant it reports the size reduction and the largest weight
+error. It also runs the float32 model and each variant here, with numpy, on
+the images in --images (default eval_images/, committed; any files Pillow
+can open) resized to the model input like filters_bg.js does, and reports
+the IoU of each variant's person mask (logit > 0, i.e. sigmoid > 0.5)
+against the float32 one. A variant whose mean IoU is below --min-iou is
+removed again and the exit status is 1, so a build that runs this never
+ships a variant that segments differently; app.py then serves float32.
+
+The Docker build runs it (with --skip-missing: a tree without the float32
+shards has no model to quantize, and says so).
+"""
+
+SHARD_BYTES = 4 * 1024 * 1024  # what the TF.js converter writes
+VARIANTS = ("float16", "uint8")
+DTYPES = {"float32": np.float32, "int32": np.int32, "bool": np.bool_}
+QUANT_DTYPES = {"float16": np.float16, "uint8": np.uint8, "uint16": np.uint16}
+EVAL_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "eval_images")
+MIN_IOU = 0.95
+
+
+# ----------------- weights -----------------
+def load_model(model_path):
+    """-> (model.json dict, {weight name: ndarray}), dequantizing weights that are already quantized."""
+    with open(model_path, "r", encoding="utf-8") as f:
+        model = json.load(f)
+    base = os.path.dirname(model_path)
+    weights = {}
+    for group in model["weightsManifest"]:
+        chunks = []
+        for p in group["paths"]:
+            with open(os.path.join(base, p), "rb") as f:
+                chunks.append(f.read())
+        buf = b"".join(chunks)
+        offset = 0
+        for spec in group["weights"]:
+            count = math.prod(spec["shape"])
+            quant = spec.get("quantization")
+            dtype = QUANT_DTYPES[quant["dtype"]] if quant else DTYPES[spec["dtype"]]
+            size = count * np.dtype(dtype).itemsize
+            if offset + size > len(buf):
+                sys.exit(f"{model_path}: shards end inside {spec['name']} (missing or truncated .bin?)")
+            arr = np.frombuffer(buf, dtype, count, offset).reshape(spec["shape"])
+            offset += size
+            if quant and quant["dtype"] != "float16":
+                arr = arr * np.float32(quant["scale"]) + np.float32(quant["min"])
+            weights[spec["name"]] = arr.astype(DTYPES[spec["dtype"]])
+    return model, weights
+
+
+def quantize(arr, dtype):
+    """-> (bytes, quantization entry, dequantized copy). TF.js's affine uint8 scheme, with 0 kept exact."""
+    if dtype == "float16":
+        q = arr.astype(np.float16)
+        return q.tobytes(), {"dtype": "float16", "original_dtype": "float32"}, q.astype(np.float32)
+    lo, hi = min(float(arr.min()), 0.0), max(float(arr.max()), 0.0)
+    scale = (hi - lo) / 255 or 1.0
+    lo = -round(-lo / scale) * scale  # nudge so that 0.0 is a code point (zero padding, zero biases)
+    q = np.clip(np.round((arr - lo) / scale), 0, 255).astype(np.uint8)
+    entry = {"dtype": "uint8", "min": lo, "scale": scale, "original_dtype": "float32"}
+    return q.tobytes(), entry, (q * np.float32(scale) + np.float32(lo)).astype(np.float32)
+
+
+def write_variant(model, weights, dtype, out_dir):
+    """Write model.json + shards for one dtype. -> (bytes written, {name: dequantized weight}, max abs error)."""
+    os.makedirs(out_dir, exist_ok=True)
+    specs, chunks, deq, max_err = [], [], {}, 0.0
+    for group in model["weightsManifest"]:
+        for spec in group["weights"]:
+            arr = weights[spec["name"]]
+            spec = {k: v for k, v in spec.items() if k != "quantization"}
+            if arr.dtype == np.float32 and arr.size:
+                data, spec["quantization"], deq[spec["name"]] = quantize(arr, dtype)
+                max_err = max(max_err, float(np.abs(deq[spec["name"]] - arr).max()))
+            else:
+                data, deq[spec["name"]] = arr.tobytes(), arr
+            specs.append(spec)
+            chunks.append(data)
+    blob = b"".join(chunks)
+    n = max(1, math.ceil(len(blob) / SHARD_BYTES))
+    paths = [f"group1-shard{i + 1}of{n}.bin" for i in range(n)]
+    for i, p in enumerate(paths):
+        with open(os.path.join(out_dir, p), "wb") as f:
+            f.write(blob[i * SHARD_BYTES:(i + 1) * SHARD_BYTES])
+    out = dict(model, weightsManifest=[{"paths": paths, "weights": specs}])
+    with open(os.path.join(out_dir, "model.json"), "w", encoding="utf-8") as f:
+        json.dump(out, f)
+    size = len(blob) + os.path.getsize(os.path.join(out_dir, "model.json"))
+    return size, deq, max_err
+
+
+# ----------------- numpy executor (the ops this UNet uses) -----------------
+def _attr(node, key, default=None):
+    a = node.get("attr", {}).get(key)
+    if a is None:
+        return default
+    if "s" in a:
+        return base64.b64decode(a["s"]).decode()
+    if "list" in a:
+        lst = a["list"]
+        if "s" in lst:
+            return [base64.b64decode(x).decode() for x in lst["s"]]
+        return [int(x) for x in lst.get("i", [])]
+    if "i" in a:
+        return int(a["i"])
+    return a.get("f", a.get("b", default))
+
+
+def _conv2d(x, w, padding):
+    kh, kw = w.shape[:2]
+    if padding == "SAME":
+        ph, pw = kh - 1, kw - 1
+        x = np.pad(x, ((0, 0), (ph // 2, ph - ph // 2), (pw // 2, pw - pw // 2), (0, 0)))
+    patches = np.lib.stride_tricks.sliding_window_view(x, (kh, kw), axis=(1, 2))  # N,H,W,C,kh,kw
+    return np.einsum("nhwcij,ijco->nhwo", patches, w, optimize=True)
+
+
+def _strided_slice(node, x, begin, end, strides):
+    bm, em, sm = _attr(node, "begin_mask", 0), _attr(node, "end_mask", 0), _attr(node, "shrink_axis_mask", 0)
+    if _attr(node, "ellipsis_mask", 0) or _attr(node, "new_axis_mask", 0):
+        raise NotImplementedError("StridedSlice with ellipsis/new_axis masks")
+    index = []
+    for i, (b, e, s) in enumerate(zip(begin, end, strides)):
+        if sm >> i & 1:
+            index.append(int(b))
+        else:
+            index.append(slice(None if bm >> i & 1 else int(b), None if em >> i & 1 else int(e), int(s)))
+    return x[tuple(index)]
+
+
+def run_graph(model, weights, image):
+    """Logits for one NHWC float32 batch, evaluated node by node."""
+    nodes = {n["name"]: n for n in model["modelTopology"]["node"]}
+    values = {}
+
+    def ev(name):
+        name = name.split(":")[0].lstrip("^")
+        if name in values:
+            return values[name]
+        n = nodes[name]
+        op, args = n["op"], [ev(i) for i in n.get("input", []) if not i.startswith("^")]
+        if op == "Const":
+            v = weights[name]
+        elif op == "Placeholder":
+            v = image
+        elif op == "Identity":
+            v = args[0]
+        elif op == "_FusedConv2D":
+            v = _conv2d(args[0], args[1], _attr(n, "padding")) + args[2]
+            for fused in _attr(n, "fused_ops")[1:]:
+                if fused != "Relu":
+                    raise NotImplementedError(f"_FusedConv2D {fused}")
+                v = np.maximum(v, 0)
+        elif op == "MaxPool":
+            k, s = _attr(n, "ksize")[1], _attr(n, "strides")[1]
+            if k != s or _attr(n, "padding") != "VALID":
+                raise NotImplementedError("MaxPool other than non-overlapping VALID")
+            b, h, w, c = args[0].shape
+            v = args[0][:, :h // k * k, :w // k * k].reshape(b, h // k, k, w // k, k, c).max(axis=(2, 4))
+        elif op == "ExpandDims":
+            v = np.expand_dims(args[0], int(args[1]))
+        elif op == "Shape":
+            v = np.array(args[0].shape, np.int32)
+        elif op == "Tile":
+            v = np.tile(args[0], args[1])
+        elif op == "Reshape":
+            v = args[0].reshape(args[1])
+        elif op == "Mul":
+            v = args[0] * args[1]
+        elif op == "ConcatV2":
+            v = np.concatenate(args[:-1], axis=int(args[-1]))
+        elif op == "StridedSlice":
+            v = _strided_slice(n, *args)
+        else:
+            raise NotImplementedError(op)
+        values[name] = v
+        return v
+
+    out = model["signature"]["outputs"]
+    return ev(next(iter(out.values()))["name"])
+
+
+def load_images(folder, size):
+    from PIL import Image  # only needed for --images
+
+    out = []
+    for name in sorted(os.listdir(folder)):
+        try:
+            with Image.open(os.path.join(folder, name)) as f:
+                img = f.convert("RGB").resize((size, size), Image.BILINEAR)
+        except OSError:
+            continue
+        out.append((name, np.asarray(img, np.float32)[None] / 255.0))  # fromPixels().div(255)
+    return out
+
+
+def iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return float(np.logical_and(a, b).sum() / union) if union else 1.0
+
+
+# ----------------- main -----------------
+def main():
+    ap = argparse.ArgumentParser(description="Write float16/uint8 variants of a TF.js graph model")
+    ap.add_argument("model", help="path to model.json")
+    ap.add_argument("--dtypes", default=",".join(VARIANTS), help="comma-separated subset of float16,uint8")
+    ap.add_argument("--out", default=None, help="parent folder of the variants (default: the model's folder)")
+    ap.add_argument("--images", default=EVAL_IMAGES, help="folder of test images for the mask-IoU check")
+    ap.add_argument("--no-iou", action="store_true", help="skip the mask-IoU check")
+    ap.add_argument("--min-iou", type=float, default=MIN_IOU, help="mean IoU a variant must reach")
+    ap.add_argument("--skip-missing", action="store_true", help="exit 0 if the model's shards are not there")
+    args = ap.parse_args()
+
+    dtypes = [d for d in args.dtypes.split(",") if d]
+    if any(d not in VARIANTS for d in dtypes):
+        ap.error(f"--dtypes: choose from {', '.join(VARIANTS)}")
+    base = os.path.dirname(args.model)
+    with open(args.model, "r", encoding="utf-8") as f:
+        missing = [p for g in json.load(f)["weightsManifest"] for p in g["paths"]
+                   if not os.path.isfile(os.path.join(base, p))]
+    if missing:
+        print(f"{args.model}: missing {', '.join(missing)}; no variants written", file=sys.stderr)
+        sys.exit(0 if args.skip_missing else 1)
+    model, weights = load_model(args.model)
+    src_bytes = os.path.getsize(args.model) + sum(
+        os.path.getsize(os.path.join(base, p)) for g in model["weightsManifest"] for p in g["paths"])
+
+    images = []
+    if not args.no_iou:
+        size = int(model["signature"]["inputs"][next(iter(model["signature"]["inputs"]))]
+                   ["tensorShape"]["dim"][1]["size"])
+        images = load_images(args.images, size)
+        if not images:
+            sys.exit(f"--images: nothing readable in {args.images}")
+    refs = []
+    for name, img in images:
+        t = time.perf_counter()
+        refs.append(run_graph(model, weights, img) > 0)
+        print(f"  float32 {name}: {refs[-1].mean() * 100:.1f}% person, {time.perf_counter() - t:.1f} s")
+
+    print(f"{'variant':8} {'bytes':>11} {'vs float32':>10} {'max |dw|':>10} {'IoU mean':>9} {'IoU min':>8}")
+    print(f"{'float32':8} {src_bytes:11d} {'':>10} {'':>10}")
+    failed = []
+    for dtype in dtypes:
+        out_dir = os.path.join(args.out or base, dtype)
+        size, deq, max_err = write_variant(model, weights, dtype, out_dir)
+        ious = [iou(run_graph(model, deq, img) > 0, ref) for (_, img), ref in zip(images, refs)]
+        line = f"{dtype:8} {size:11d} {100 * (size / src_bytes - 1):+9.1f}% {max_err:10.2e}"
+        if ious:
+            line += f" {sum(ious) / len(ious):9.4f} {min(ious):8.4f}"
+        if ious and sum(ious) / len(ious) < args.min_iou:
+            shutil.rmtree(out_dir)
+            failed.append(dtype)
+            print(line + f"   below --min-iou {args.min_iou}: removed")
+        else:
+            print(line + f"   -> {out_dir}")
+    if failed:
+        sys.exit(f"variants off the float32 masks: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
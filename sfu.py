@@ -0,0 +1,535 @@
+# sfu.py
+import os, time, queue, asyncio, threading, fractions, collections
+
+import av
+import aiortc
+from av.video.frame import PictureType
+from aiortc import (RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer,
+                    RTCBundlePolicy, RTCRtpSender, MediaStreamTrack)
+from aiortc.exceptions import InvalidStateError
+from aiortc.mediastreams import MediaStreamError
+from aiortc.sdp import candidate_from_sdp
+
+import jsonlog
+
+"""
+Selective forwarding for rooms too big for a browser mesh.
+
+In the mesh every browser uploads its camera once per peer. Here each
+browser keeps one RTCPeerConnection to the server instead, sends its camera
+(and screen) up once and gets everyone else's down the same connection.
+signaling.py decides per room when to switch (SIGNAL_SFU_AT) and carries
+the negotiation as {type:"sfu", data:{...}} messages; this module is the
+media side:
+
+  room = Room(send)               # send(user, data) delivers {type:"sfu", data}
+  await room.handle(user, data)   # join / answer / candidate / screen from a client
+  room.remove(user)               # user left (with a reason: client must join again)
+  await room.close()              # room went back to the mesh
+
+Only the server makes offers, so there is no glare. Every offer carries
+`slots`, mid -> what that m-line carries:
+  {kind, up:"camera"|"screen"}      the client's own track goes up here
+  {kind, user, source}              someone else's track comes down here
+  {kind}                            unused (kept for reuse, inactive)
+and the client answers, attaching its tracks to the "up" slots. Screen
+sharing is a replaceTrack on the client plus {type:"screen", on:bool}.
+
+aiortc is not a bit-exact RTP forwarder either: its receiver reassembles
+frames and its sender packetizes them again. A Publication taps the
+receiver's frame queue ahead of the decoder, so each VP8 / Opus frame a
+client sends is handed, still encoded, to every subscriber's sender, which
+only packetizes and encrypts it. Downstream m-lines are pinned to VP8 and
+Opus (and upstream ones too, so those frames fit every sender). Should the
+tap not find aiortc's internals, a Publication falls back to decoding and
+encoding once per published track (counters["transcoded_tracks"]). A new
+(or lagging) subscriber waits for a keyframe, asked of the publisher with a
+PLI as soon as someone subscribes or a subscriber's browser asks for one.
+"""
+
+VIDEO_BITRATE = int(os.environ.get("SIGNAL_SFU_VIDEO_BITRATE", "600000"))        # bps per published camera
+# The encoded-frame tap, PLIs to publishers and keyframe requests from
+# subscribers reach into aiortc private members of this release (pinned in
+# requirements-sfu.txt). Any other version only gets the public API: transcoding,
+# with keyframes every KEYFRAME_INTERVAL.
+AIORTC_VERSION = "1.15.0"
+INTERNALS = aiortc.__version__ == AIORTC_VERSION
+KEYFRAME_INTERVAL = float(os.environ.get("SIGNAL_SFU_KEYFRAME_INTERVAL", "2"))  # seconds, when transcoding
+ICE_SERVERS = [u for u in os.environ.get("SIGNAL_SFU_STUN", "").split(",") if u]  # none: host candidates
+PLI_INTERVAL = 0.5       # seconds between keyframe requests to one publisher
+QUEUE_MAX = 30           # packets waiting for one subscriber before it is resynced at a keyframe
+NEGOTIATE_TIMEOUT = 10.0
+UP_SLOTS = (("audio", "camera"), ("video", "camera"), ("video", "screen"))
+AUDIO_RATE = 48000
+
+log = jsonlog.get_logger("signaling.sfu")
+
+counters = collections.Counter()
+
+
+def _codecs(kind):
+    name = "video/VP8" if kind == "video" else "audio/opus"
+    caps = RTCRtpSender.getCapabilities(kind).codecs
+    return [c for c in caps if c.mimeType == name or (kind == "video" and c.mimeType == "video/rtx")]
+
+
+# ----------------- encoders -----------------
+class VideoEncoder:
+    """libvpx with aiortc's realtime settings, returning packets rather than RTP payloads."""
+
+    def __init__(self, bitrate=VIDEO_BITRATE):
+        self.bitrate = bitrate
+        self.codec = None
+
+    def _open(self, frame):
+        codec = av.CodecContext.create("libvpx", "w")
+        codec.width = frame.width
+        codec.height = frame.height
+        codec.pix_fmt = "yuv420p"
+        codec.time_base = frame.time_base
+        codec.bit_rate = self.bitrate
+        codec.gop_size = 3000  # keyframes are forced instead
+        codec.qmin = 2
+        codec.qmax = 56
+        codec.options = {
+            "bufsize": str(self.bitrate), "cpu-used": "-6", "deadline": "realtime",
+            "lag-in-frames": "0", "minrate": str(self.bitrate), "maxrate": str(self.bitrate),
+            "noise-sensitivity": "4", "overshoot-pct": "15", "partitions": "0",
+            "static-thresh": "1", "undershoot-pct": "100",
+        }
+        codec.thread_count = 2 if frame.width * frame.height > 640 * 480 else 1
+        return codec
+
+    def encode(self, frame, keyframe):
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        if self.codec is None or (frame.width, frame.height) != (self.codec.width, self.codec.height):
+            self.codec = self._open(frame)
+            keyframe = True
+        # a decoded keyframe still says I: only force one when asked to
+        frame.pict_type = PictureType.I if keyframe else PictureType.NONE
+        packets = self.codec.encode(frame)
+        for p in packets:
+            p.time_base = frame.time_base
+        return packets
+
+
+class AudioEncoder:
+    """Opus at 48 kHz in 20 ms frames, like aiortc's own encoder."""
+
+    def __init__(self):
+        self.codec = av.CodecContext.create("libopus", "w")
+        self.codec.bit_rate = 64000
+        self.codec.format = "s16"
+        self.codec.layout = "stereo"
+        self.codec.sample_rate = AUDIO_RATE
+        self.codec.time_base = fractions.Fraction(1, AUDIO_RATE)
+        self.codec.options = {"application": "voip"}
+        self.resampler = av.AudioResampler(format="s16", layout="stereo", rate=AUDIO_RATE, frame_size=960)
+
+    def encode(self, frame, keyframe=False):
+        packets = []
+        for f in self.resampler.resample(frame):
+            packets += self.codec.encode(f)
+        for p in packets:
+            p.time_base = self.codec.time_base
+        return packets
+
+
+# ----------------- forwarding -----------------
+class _Tap:
+    """Stands in for an aiortc receiver's decoder queue: its reassembled,
+    still encoded frames go to a Publication and the decoder thread only
+    waits for the stop sentinel."""
+
+    def __init__(self, pub):
+        self.pub = pub
+        self.stopped = threading.Event()
+
+    def put(self, item):
+        if item is None:
+            self.stopped.set()
+        else:
+            codec, frame = item
+            self.pub.feed(frame.data, frame.timestamp, codec.clockRate)
+
+    def get(self):
+        self.stopped.wait()
+        return None
+
+
+def _tap(receiver, pub):
+    """Route receiver's encoded frames to pub. False if this aiortc does not
+    look like the one it was written against (the caller transcodes then)."""
+    if not INTERNALS or getattr(receiver, "_RTCRtpReceiver__started", True) or \
+            not isinstance(getattr(receiver, "_RTCRtpReceiver__decoder_queue", None), queue.Queue):
+        return False
+    receiver._RTCRtpReceiver__decoder_queue = _Tap(pub)
+    return True
+
+
+class Publication:
+    """One track a client sends up, fanned out to all of its subscribers."""
+
+    def __init__(self, owner, source, track, receiver):
+        self.owner = owner
+        self.source = source          # "camera" | "screen"
+        self.kind = track.kind
+        self.track = track
+        self.receiver = receiver
+        self.subscribers = set()      # Forwarded
+        self.forwarding = False       # True: encoded frames as received; False: transcoding
+        self.encoder = None
+        self.next_key = 0.0           # monotonic: next forced keyframe (transcoding) / PLI allowed
+        self.frames = 0
+        self.task = None
+
+    def start(self):
+        self.forwarding = _tap(self.receiver, self)
+        if not self.forwarding:
+            counters["transcoded_tracks"] += 1
+            self.encoder = VideoEncoder() if self.kind == "video" else AudioEncoder()
+            self.task = asyncio.ensure_future(self.run())
+
+    def want_key(self):
+        if not self.forwarding:
+            self.next_key = 0.0
+            return
+        now = time.monotonic()
+        if now < self.next_key:
+            return  # one PLI in flight is enough
+        self.next_key = now + PLI_INTERVAL
+        for s in self.receiver.getSynchronizationSources():
+            counters["pli_sent"] += 1
+            asyncio.ensure_future(self.receiver._send_rtcp_pli(s.source))
+
+    def feed(self, data, timestamp, clock):
+        """A complete encoded frame from the publisher (aiortc's jitter buffer)."""
+        self.frames += 1
+        if not self.subscribers:
+            return
+        packet = av.Packet(data)
+        packet.pts = timestamp
+        packet.time_base = fractions.Fraction(1, clock)
+        # VP8 frame tag: bit 0 clear on a keyframe; every Opus frame stands alone
+        keyframe = self.kind == "audio" or (bool(data) and not data[0] & 1)
+        counters["frames_forwarded"] += 1
+        for sub in list(self.subscribers):
+            sub.push((packet,), keyframe)
+
+    async def run(self):
+        """Transcoding fallback: decode (aiortc does) and encode once for everyone."""
+        loop = asyncio.get_running_loop()
+        backlog = getattr(self.track, "_queue", None) if INTERNALS else None  # aiortc's decoded frames not read yet
+        while True:
+            try:
+                frame = await self.track.recv()
+            except MediaStreamError:
+                break
+            self.frames += 1
+            if not self.subscribers:
+                continue
+            keyframe = False
+            if self.kind == "video":
+                # behind (encoder slower than the camera): skip to the newest frame
+                while backlog is not None and backlog.qsize() > 1:
+                    frame = backlog.get_nowait()
+                    counters["frames_skipped"] += 1
+                    if frame is None:
+                        return
+                now = time.monotonic()
+                if now >= self.next_key:
+                    keyframe = True
+                    self.next_key = now + KEYFRAME_INTERVAL
+            packets = await loop.run_in_executor(None, self.encoder.encode, frame, keyframe)
+            counters["frames_encoded"] += 1
+            if packets:
+                for sub in list(self.subscribers):
+                    sub.push(packets, self.kind == "audio" or packets[0].is_keyframe)
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        for sub in list(self.subscribers):
+            sub.detach()
+
+
+class Forwarded(MediaStreamTrack):
+    """The track behind one downstream m-line. It outlives the publications it
+    is attached to in turn: aiortc's sender stops for good once its track ends."""
+
+    def __init__(self, kind, sender):
+        super().__init__()
+        self.kind = kind
+        self.sender = sender
+        self.pub = None
+        self.queue = collections.deque()
+        self.ready = asyncio.Event()
+        self.waiting_key = False
+
+    def attach(self, pub):
+        self.detach()
+        self.pub = pub
+        pub.subscribers.add(self)
+        if self.kind == "video":
+            self.waiting_key = True
+            pub.want_key()
+
+    def detach(self):
+        if self.pub is not None:
+            self.pub.subscribers.discard(self)
+            self.pub = None
+        self.queue.clear()
+
+    def push(self, packets, keyframe):
+        if self.waiting_key:
+            if not keyframe:
+                return
+            self.waiting_key = False
+        if len(self.queue) >= QUEUE_MAX:
+            # the sender cannot keep up (congested socket): start over at a keyframe
+            counters["subscriber_resyncs"] += 1
+            self.queue.clear()
+            if self.kind == "video":
+                self.waiting_key = True
+                self.pub.want_key()
+                return
+        self.queue.extend(packets)
+        self.ready.set()
+
+    async def recv(self):
+        # the subscriber's PLI / FIR only sets a flag for aiortc's own encoder: pass it upstream
+        if INTERNALS and getattr(self.sender, "_RTCRtpSender__force_keyframe", False):
+            self.sender._RTCRtpSender__force_keyframe = False
+            if self.pub is not None:
+                self.pub.want_key()
+        while not self.queue:
+            if self.readyState != "live":
+                raise MediaStreamError
+            self.ready.clear()
+            await self.ready.wait()
+        counters["packets_forwarded"] += 1
+        return self.queue.popleft()
+
+    def stop(self):
+        super().stop()
+        self.detach()
+        self.ready.set()
+
+
+# ----------------- sessions -----------------
+class Session:
+    """One client's connection to the server: its up slots and everyone else's tracks down."""
+
+    def __init__(self, room, user):
+        self.room = room
+        self.user = user
+        # max-bundle: with the default policy, m-lines added before the first answer
+        # stay on a transport that the answer then discards
+        self.pc = RTCPeerConnection(RTCConfiguration([RTCIceServer(u) for u in ICE_SERVERS],
+                                                     bundlePolicy=RTCBundlePolicy.MAX_BUNDLE))
+        self.up = {}          # transceiver -> source, for the client's own tracks
+        self.down = {}        # transceiver -> Forwarded
+        self.published = {}   # (source, kind) -> Publication
+        self.screen = False   # the client says it is sharing its screen
+        self.answer = None    # future while an offer is out
+        self.negotiating = False
+        self.again = False
+        self.closed = False
+        for kind, source in UP_SLOTS:
+            t = self.pc.addTransceiver(kind, direction="recvonly")
+            t.setCodecPreferences(_codecs(kind))  # what every subscriber's sender can take as-is
+            self.up[t] = source
+        self.pc.on("track", self.on_track)
+        self.pc.on("connectionstatechange", self.on_state)
+
+    def on_track(self, track):
+        for t, source in self.up.items():
+            if t.receiver.track is track:
+                break
+        else:
+            return
+        pub = Publication(self.user, source, track, t.receiver)
+        pub.start()
+        self.published[(source, track.kind)] = pub
+        if source == "camera" or self.screen:
+            self.room.share(pub)
+
+    async def on_state(self):
+        if self.pc.connectionState == "failed" and not self.closed:
+            log.warning("sfu connection failed", user=self.user)
+            self.room.remove(self.user, "failed")
+
+    def shared(self):
+        return [p for (source, _), p in self.published.items() if source == "camera" or self.screen]
+
+    def subscribe(self, pub):
+        free = [t for t, fwd in self.down.items() if fwd.pub is None and t.kind == pub.kind]
+        if free:
+            t = free[0]
+        else:
+            t = self.pc.addTransceiver(pub.kind, direction="sendonly")
+            t.setCodecPreferences(_codecs(pub.kind))
+            self.down[t] = Forwarded(pub.kind, t.sender)
+            t.sender.replaceTrack(self.down[t])
+        t.direction = "sendonly"
+        self.down[t].attach(pub)
+        self.renegotiate()
+
+    def unsubscribe(self, pub):
+        for t, fwd in self.down.items():
+            if fwd.pub is pub:
+                fwd.detach()
+                t.direction = "inactive"
+                self.renegotiate()
+
+    def slots(self):
+        slots = {}
+        for t in self.pc.getTransceivers():
+            if t.mid is None:
+                continue
+            if t in self.up:
+                slots[t.mid] = {"kind": t.kind, "up": self.up[t]}
+            elif self.down[t].pub is not None:
+                pub = self.down[t].pub
+                slots[t.mid] = {"kind": t.kind, "user": pub.owner, "source": pub.source}
+            else:
+                slots[t.mid] = {"kind": t.kind}
+        return slots
+
+    def renegotiate(self):
+        if self.negotiating:
+            self.again = True  # folded into the offer after the current one
+        else:
+            self.negotiating = True
+            self.room.spawn(self.negotiate())
+
+    async def negotiate(self):
+        try:
+            while not self.closed:
+                self.again = False
+                await self.pc.setLocalDescription(await self.pc.createOffer())
+                self.answer = asyncio.get_running_loop().create_future()
+                self.room.send(self.user, {"type": "offer", "sdp": self.pc.localDescription.sdp,
+                                           "slots": self.slots()})
+                try:
+                    sdp = await asyncio.wait_for(self.answer, NEGOTIATE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    log.warning("sfu answer timed out", user=self.user)
+                    self.room.remove(self.user, "timeout")
+                    return
+                try:
+                    await self.pc.setRemoteDescription(RTCSessionDescription(sdp, "answer"))
+                except ValueError as e:
+                    log.warning("sfu answer rejected", user=self.user, error=str(e))
+                    self.room.remove(self.user, "rejected")
+                    return
+                counters["negotiations"] += 1
+                if not self.again:
+                    return
+        except InvalidStateError:
+            pass  # closed meanwhile
+        finally:
+            self.answer = None
+            self.negotiating = False
+
+    def on_answer(self, sdp):
+        if self.answer is not None and not self.answer.done() and isinstance(sdp, str):
+            self.answer.set_result(sdp)
+
+    async def add_candidate(self, c):
+        if not isinstance(c, dict) or not c.get("candidate") or self.pc.remoteDescription is None:
+            return
+        try:
+            cand = candidate_from_sdp(c["candidate"].split(":", 1)[1])
+        except (IndexError, ValueError):
+            return
+        cand.sdpMid = c.get("sdpMid")
+        cand.sdpMLineIndex = c.get("sdpMLineIndex")
+        try:
+            await self.pc.addIceCandidate(cand)
+        except ValueError:
+            pass  # names no m-line of ours
+
+    async def close(self):
+        self.closed = True
+        if self.answer is not None and not self.answer.done():
+            self.answer.cancel()
+        for pub in self.published.values():
+            pub.close()
+        for fwd in self.down.values():
+            fwd.stop()
+        await self.pc.close()
+
+
+class Room:
+    """SFU state of one signaling room."""
+
+    def __init__(self, send, spawn=asyncio.ensure_future):
+        self.send = send          # send(user, data)
+        self.spawn = spawn        # keeps a reference to background negotiations
+        self.sessions = {}        # username -> Session
+
+    async def handle(self, user, data):
+        kind = data.get("type")
+        session = self.sessions.get(user)
+        if kind == "join":
+            # (re)connect: a reload or a browser whose connection failed starts over
+            if session is not None:
+                self.remove(user)
+            session = self.sessions[user] = Session(self, user)
+            for other in self.sessions.values():
+                if other is not session:
+                    for pub in other.shared():
+                        session.subscribe(pub)
+            session.renegotiate()
+            counters["sessions_started"] += 1
+        elif session is None:
+            return
+        elif kind == "answer":
+            session.on_answer(data.get("sdp"))
+        elif kind == "candidate":
+            await session.add_candidate(data.get("candidate"))
+        elif kind == "screen":
+            session.screen = data.get("on") is True
+            pub = session.published.get(("screen", "video"))
+            if pub is not None:
+                if session.screen:
+                    self.share(pub)
+                else:
+                    self.unshare(pub)
+
+    def share(self, pub):
+        for session in self.sessions.values():
+            if session.user != pub.owner and not any(f.pub is pub for f in session.down.values()):
+                session.subscribe(pub)
+
+    def unshare(self, pub):
+        for session in self.sessions.values():
+            session.unsubscribe(pub)
+
+    def remove(self, user, reason=None):
+        """Drop user's session. With a reason the user is still here: the client
+        is told {type:"closed", reason} and joins again with a new connection."""
+        session = self.sessions.pop(user, None)
+        if session is None:
+            return
+        if reason is not None:
+            counters["sessions_" + reason] += 1
+            self.send(user, {"type": "closed", "reason": reason})
+        for pub in session.published.values():
+            self.unshare(pub)
+        self.spawn(session.close())
+
+    async def close(self):
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        await asyncio.gather(*(s.close() for s in sessions), return_exceptions=True)
+
+    def report(self):
+        pubs = [p for s in self.sessions.values() for p in s.published.values()]
+        return {
+            "sessions": len(self.sessions),
+            "published": sum(1 for p in pubs if p.subscribers),
+            "forwarded": sum(len(p.subscribers) for p in pubs),
+        }
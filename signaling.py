@@ -3,7 +3,20 @@ import asyncio
 import websockets
 import json
 import ssl
+import socket
+import signal
+import random
+import os
+import re
+import time
+import http
+import secrets
+import collections
+from array import array
 from urllib.parse import urlparse, parse_qs
+import jsonlog
+import jointoken
+import pubsub
 
 """
 Protocol (messages are JSON):
@@ -14,66 +27,1407 @@ Client -> Server
   {type:"host_kick", target:"username"}               # host only
   {type:"transfer_host", to:"username"}               # host only
   {type:"introduce_pair", a:"userA", b:"userB"}       # host only
+  {type:"intro_ack", peer:"username", ok:true|false}  # WebRTC to peer connected (or failed)
+  {type:"roster_sync", since:v}                       # ask for roster changes after version v
   {type:"signal", to:"username", data:{...}}          # directed relay (opaque payload)
+                                                      # data ending in ,"ice":1 marks a trickled candidate
+  {type:"sfu", data:{type:"join"|"answer"|"candidate"|"screen", ...}}  # SFU rooms only, see sfu.py
+  {type:"uplink", kbps:N|null}                        # send-side bandwidth estimate while it limits
+                                                      # our video, null once it no longer does
 
 Server -> Client
-  {type:"peer_list", users:[...], host:"username"|null}
-  {type:"peer_joined", user:"username"}
-  {type:"peer_left",   user:"username"}
-  {type:"host_changed", host:"username"|null}
+  {type:"peer_list", users:[...], host:"username"|null, v:N, intros:"server"|"client", media:"mesh"|"sfu"}
+  {type:"peer_joined", user:"username", v:N}
+  {type:"peer_left",   user:"username", v:N}
+  {type:"host_changed", host:"username"|null, v:N}
+  {type:"roster_delta", since:v, v:N, ops:[["+","user"], ["-","user"], ["h","host"|null], ...]}
   {type:"host_mute"}                                  # received by non-hosts
   {type:"host_kick", to:"username"}                   # warning before close
+  {type:"session_replaced"}                           # same username joined again; this socket is closed
+  {type:"server_draining", retry_ms:N}                # server restarting; rejoin after N ms
+  {type:"session", resume:"token", grace:seconds}     # reconnect with ?resume=token within grace
+  {type:"resumed", lost:bool}                         # slot restored; lost=true: buffer overflowed,
+                                                      # a fresh peer_list follows
   {type:"signal", to:"username", from:"username", data:{...}}
+  {type:"signal_batch", to:"username", from:"username", items:[data, ...]}   # coalesced ICE candidates, in order
+  {type:"media_mode", mode:"mesh"|"sfu"}              # the room switched media topology
+  {type:"sfu", data:{type:"offer", sdp, slots:{...}}}  # from the server's forwarding side (sfu.py)
+  {type:"media_policy", max_kbps:N, height:N, fps:N, streams:N}  # cap for each outgoing camera stream
+  {type:"chat", from:"username", text:"...", ts:ms}
+  {type:"chat_history", items:[{type:"chat", ...}, ...]}  # on join: recent room-wide chat, oldest first
   # and directed intros:
   {type:"signal", to:"userA", from:"host", data:{type:"intro", other:"userB"}}
+
+Roster versions: every join, leave and host change bumps the room's roster
+version by one, and the message announcing it carries the new `v`. A client
+that sees a gap (v > last + 1), or reconnects with ?since=v, gets a
+roster_delta with just the missing changes, or a fresh peer_list if the
+server no longer remembers that far back (ROSTER_LOG_MAX changes).
+
+Introductions (SIGNAL_INTROS=server, the default): the server pairs every
+newcomer with each peer already in the room and sends both sides an intro
+signal, at most INTRO_RATE pairs/s per room and INTRO_PER_PEER unfinished
+pairs per peer. A pair is finished by an intro_ack from either side or after
+INTRO_TIMEOUT. Clients told intros:"server" in peer_list wait for intros
+instead of handshaking with everyone at once.
+
+Session resumption: a connection that drops without a normal close (code
+1000/1001) is parked for RESUME_GRACE seconds instead of leaving. Its name,
+host role and outbox are kept and frames for it are buffered (at most
+RESUME_BUFFER_MAX, oldest dropped). Reconnecting with
+?room=..&user=..&resume=<token> takes the slot back and flushes the buffer;
+the rest of the room sees neither a peer_left nor a peer_joined. When the
+grace runs out the peer leaves as usual. A resume whose old socket still
+looks open (the drop sent no FIN) takes that session over: the old socket
+is closed with 4000 and its outbox moves to the new one.
+
+Restarts: SIGTERM drains (see "drain" below). Peers get
+  {type:"server_draining", retry_ms:N}
+and are closed with code 1012; they rejoin (fresh session) after N ms. For a
+deploy without a reconnect stampede, run both processes with
+SIGNAL_REUSE_PORT=1, start the new one on the same port, then SIGTERM the
+old one.
+
+Media: a room starts as a browser mesh (every pair has its own
+RTCPeerConnection). With SIGNAL_SFU=on (opt-in: the server then terminates
+the media, so it is no longer end to end) and aiortc installed, a room that
+reaches SFU_AT peers switches to selective forwarding: every browser drops its mesh connections,
+sends {type:"sfu", data:{type:"join"}} and gets one connection to the server,
+which forwards each camera to everyone else. Below SFU_AT - 2 peers the room
+goes back to the mesh (the server re-introduces every pair).
+
+Joins: with SECRET_KEY set, connect with ?room=..&user=..&token=T, where T
+comes from app.py (room page, or GET /api/signal-token?room=.. for a fresh
+rejoin) and is single use; otherwise the upgrade is refused with 403.
+
+HTTP on the same port (no upgrade):
+  GET /healthz   200 {status:"ok", ready:true, ...}, 503 while draining
+  GET /metrics   JSON: rooms, peers-per-room histogram, messages/s by type,
+                 fan-out time, send failures, queue depths, event-loop lag
 """
 
 # rooms = {
 #   room_id: {
-#       "clients": { ws: "username", ... },
-#       "host": "username or None"
+#       "id": room_id,
+#       "clients": { ws: "username", ... },     # peers connected to this node
+#       "by_name": { "username": ws, ... },     # reverse index of "clients"
+#       "remote": { "username": node, ... },    # peers of the room on other nodes
+#       "host": "username or None",             # mirrored from the pub/sub hub
+#       "version": N,                           # roster version (see protocol above)
+#       "log": deque([(v, op, username), ...]), # recent roster changes, op in "+", "-", "h"
+#       "intros": IntroScheduler or None,       # pending introductions (created on demand)
+#       "chat": ChatHistory or None,            # recent room-wide chat (created on demand)
+#       "seen": monotonic,                      # last message from any local peer (liveness cadence)
+#       "media": "mesh" | "sfu",                # media topology (see "selective forwarding")
+#       "sfu": sfu.Room or None,                # forwarding state while media is "sfu"
+#       "uplink": { "username": kbps, ... },    # reported bandwidth limits of local peers
+#       "policy": { "username": {...}, ... },   # last media_policy sent to each local peer
 #   }
 # }
+#
+# Usernames are unique per room. If a username joins a room it is already in
+# (typically a reconnect racing the old socket's timeout), the newest
+# connection takes the name over and the old socket is told
+# "session_replaced" and closed. This also holds across nodes.
+#
+# Membership and the host are owned by the pub/sub hub (pubsub.py): joins,
+# leaves and host changes go through `bus`, and frames for peers on other
+# nodes are forwarded through it. With the default in-process backend there
+# are no other nodes and `remote` stays empty.
 rooms = {}
 
+log = jsonlog.get_logger("signaling")
+
+# Optional faster codec; SIGNAL_JSON=stdlib forces json. orjson refuses to
+# encode ints over 64 bits (we fall back per call) and decodes them as floats,
+# which no message in this protocol carries (the DH public is a string).
+try:
+    if os.environ.get("SIGNAL_JSON", "auto") == "stdlib":
+        raise ImportError
+    import orjson
+
+    def loads(raw):
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return json.loads(raw)
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj).decode()
+        except TypeError:
+            return json.dumps(obj, separators=(",", ":"))
+except ImportError:
+    loads = json.loads
+    dumps = lambda obj: json.dumps(obj, separators=(",", ":"))  # same compact shape as orjson
+
 
 # ----------------- helpers -----------------
+ROSTER_LOG_MAX = int(os.environ.get("SIGNAL_ROSTER_LOG_MAX", "256"))
+
+def new_room(room_id):
+    return {"id": room_id, "clients": {}, "by_name": {}, "remote": {}, "host": None,
+            "version": 0, "log": collections.deque(maxlen=ROSTER_LOG_MAX), "intros": None,
+            "chat": None, "seen": 0.0, "media": "mesh", "sfu": None, "uplink": {}, "policy": {}}
+
+def note_roster(room, v, op, username):
+    """Record roster change number v. Returns False for a repeat (e.g. a same-node rejoin)."""
+    if v <= room["version"]:
+        return False
+    room["version"] = v
+    room["log"].append((v, op, username))
+    return True
+
+def roster_since(room, since):
+    """Roster changes after version `since`, or None if the log no longer covers them."""
+    if since == room["version"]:
+        return []
+    if since > room["version"]:
+        return None
+    ops = [[op, name] for v, op, name in room["log"] if v > since]
+    return ops if len(ops) == room["version"] - since else None
+
+def roster_frame(room, since=None):
+    """roster_delta since `since` when possible, else the full peer_list."""
+    if since is not None:
+        ops = roster_since(room, since)
+        if ops is not None:
+            return dumps({"type": "roster_delta", "since": since, "v": room["version"], "ops": ops})
+    return dumps({"type": "peer_list", "users": usernames_in_room(room), "host": room["host"],
+                  "v": room["version"], "intros": INTROS, "media": room["media"]})
+
+def add_client(room, ws, username):
+    """Register ws as username. Returns the socket it displaced, if any."""
+    old = room["by_name"].get(username)
+    if old is ws:
+        return None
+    if old is not None:
+        room["clients"].pop(old, None)
+    room["clients"][ws] = username
+    room["by_name"][username] = ws
+    return old
+
+def remove_client(room, ws):
+    """Unregister ws. Returns its username, or None if it was not (or no longer) registered."""
+    username = room["clients"].pop(ws, None)
+    if username is not None and room["by_name"].get(username) is ws:
+        del room["by_name"][username]
+    return username
+
 def usernames_in_room(room):
-    return list(room["clients"].values())
+    if not room["remote"]:
+        return list(room["by_name"])
+    return list({**room["remote"], **room["by_name"]})
+
+def in_room(room, username):
+    return username in room["by_name"] or username in room["remote"]
 
 def ws_for_username(room, username):
-    for peer, uname in room["clients"].items():
-        if uname == username:
-            return peer
-    return None
+    return room["by_name"].get(username)
+
+_background = set()  # strong refs: the loop only keeps weak ones to tasks
+
+def summarize_ms(samples):
+    """count / p50 / p95 / max of a sample of milliseconds."""
+    vals = sorted(samples)
+    if not vals:
+        return {"count": 0}
+    pick = lambda p: vals[min(len(vals) - 1, int(p / 100.0 * len(vals)))]
+    return {"count": len(vals), "p50_ms": pick(50), "p95_ms": pick(95), "max_ms": vals[-1]}
+
+def spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+# ----------------- outbound queues -----------------
+# Every frame to a client goes through that client's Outbox: a bounded queue
+# drained by one writer task. Fan-out only appends to queues, so a slow
+# client never delays anyone else. When a queue is full, SLOW_POLICY decides:
+#   "drop"       discard the new frame
+#   "coalesce"   replace a queued frame with the same coalesce key (e.g. an
+#                older host_changed), else discard the oldest queued frame
+#   "disconnect" close the slow client
+OUTBOX_MAX = int(os.environ.get("SIGNAL_OUTBOX_MAX", "256"))
+SLOW_POLICY = os.environ.get("SIGNAL_SLOW_POLICY", "coalesce")
+
+_CLOSE = object()
+
+class Outbox:
+    __slots__ = ("ws", "frames", "wakeup", "task", "dropped", "closing", "token", "parked", "lost")
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.frames = collections.deque()  # (coalesce key or None, data)
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.closing = False                    # or the close code once close() was called
+        self.token = secrets.token_urlsafe(16)  # resume token for this session
+        self.parked = False                     # socket gone, waiting for a resume
+        self.lost = False                       # frames dropped while parked
+        self.task = spawn(self._drain())
+
+    def depth(self):
+        return len(self.frames)
+
+    def put(self, data, key=None):
+        if self.closing:
+            return False
+        frames = self.frames
+        if key is not None and frames:
+            for i, (k, _) in enumerate(frames):
+                if k == key:
+                    frames[i] = (key, data)
+                    return True
+        if self.parked:
+            if len(frames) >= RESUME_BUFFER_MAX:
+                frames.popleft()
+                self.dropped += 1
+                self.lost = True
+            frames.append((key, data))
+            return True
+        if len(frames) >= OUTBOX_MAX:
+            self.dropped += 1
+            if SLOW_POLICY == "disconnect":
+                self.close()
+                return False
+            if SLOW_POLICY != "coalesce":
+                return False
+            frames.popleft()
+        frames.append((key, data))
+        self.wakeup.set()
+        return True
+
+    def park(self):
+        """Stop writing; keep (a bounded tail of) what is queued for a resume."""
+        self.parked = True
+        self.task.cancel()
+        while len(self.frames) > RESUME_BUFFER_MAX:
+            self.frames.popleft()
+            self.lost = True
+
+    def attach(self, ws):
+        """Resume writing, to the reconnected socket."""
+        self.ws = ws
+        self.parked = False
+        self.lost = False
+        self.task = spawn(self._drain())
+        self.wakeup.set()
+
+    def close(self, code=1000):
+        """Flush what is queued, then close the socket."""
+        if not self.closing:
+            self.closing = code
+            self.frames.append((None, _CLOSE))
+            self.wakeup.set()
+
+    async def _drain(self):
+        frames = self.frames
+        while True:
+            while not frames:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            key, data = frames.popleft()
+            try:
+                if data is _CLOSE:
+                    await self.ws.close(self.closing)
+                    return
+                await self.ws.send(data)
+            except (Exception, asyncio.CancelledError) as e:
+                # socket is gone; handler()'s finally parks the session or does
+                # the room cleanup. Keep the frame in case it is resumed.
+                frames.appendleft((key, data))
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                counters["send_failed"] += 1
+                return
+
+outboxes = {}  # ws -> Outbox
+
+def enqueue(ws, data, key=None):
+    box = outboxes.get(ws)
+    if box is None or not (ws.open or box.parked):
+        return False
+    return box.put(data, key)
+
+def end_session(ws):
+    """Close ws once its queued frames are out; a parked session is released at once."""
+    box = outboxes.get(ws)
+    if box is None:
+        return
+    if box.parked:
+        slot = parked.pop(box.token, None)
+        if slot is not None:
+            slot["timer"].cancel()
+            spawn(release(slot["room_id"], slot["room"], ws))
+    else:
+        box.close()
+
+def queue_depths(room):
+    """Per-peer outbound queue depth (and frames dropped so far) for a room."""
+    out = {}
+    for ws, uname in room["clients"].items():
+        box = outboxes.get(ws)
+        if box is not None:
+            out[uname] = {"depth": box.depth(), "dropped": box.dropped}
+    return out
+
+def deliver_local(room, data, except_ws=None, key=None):
+    for peer in room["clients"]:
+        if peer is not except_ws:
+            enqueue(peer, data, key)
+
+def broadcast_frame(room, data, except_ws=None, key=None):
+    """Queue one pre-serialized frame for every client in room (optionally excluding one)."""
+    t0 = time.perf_counter()
+    deliver_local(room, data, except_ws, key)
+    bus.publish(room["id"], data, key)
+    fanout_ms.append(round(1000 * (time.perf_counter() - t0), 3))
 
 async def broadcast(room, payload, except_ws=None):
     """Send to all clients in room (optionally excluding one)."""
-    data = json.dumps(payload)
-    dead = []
-    for peer in list(room["clients"].keys()):
-        if peer is except_ws:
-            continue
-        try:
-            if peer.open:
-                await peer.send(data)
-        except Exception:
-            dead.append(peer)
-    # cleanup dead sockets if any
-    for peer in dead:
-        room["clients"].pop(peer, None)
+    key = "host" if isinstance(payload, dict) and payload.get("type") == "host_changed" else None
+    broadcast_frame(room, dumps(payload), except_ws, key)
 
 async def send_to_user(room, username, payload):
-    """Send to a specific username (if present)."""
+    """Send to a specific username (if present), on this node or another one."""
     peer = ws_for_username(room, username)
-    if peer and peer.open:
+    if peer is not None:
+        return enqueue(peer, dumps(payload))
+    if username in room["remote"]:
+        bus.send(room["id"], username, dumps(payload))
+        return True
+    return False
+
+
+# ----------------- pub/sub -----------------
+def on_bus_event(ev):
+    """Apply an event from the pub/sub hub to the local copy of the room."""
+    room = rooms.get(ev["room"])
+    if room is None:
+        return
+    kind = ev["ev"]
+    if kind == "msg":
+        if ev["data"].startswith(_CHAT_PREFIX) and is_chat_frame(ev["data"]):
+            remember_chat(room, ev["data"])
+        deliver_local(room, ev["data"], key=ev.get("key"))
+    elif kind == "to":
+        peer = room["by_name"].get(ev["user"])
+        if peer is not None:
+            enqueue(peer, ev["data"])
+            if ev.get("close"):
+                end_session(peer)
+    elif kind == "host":
+        room["host"] = ev["host"]
+        note_roster(room, ev["v"], "h", ev["host"])
+        deliver_local(room, dumps({"type": "host_changed", "host": ev["host"], "v": ev["v"]}), key="host")
+    elif kind == "join":
+        user = ev["user"]
+        note_roster(room, ev["v"], "+", user)
+        forget_intros(room, user)
+        if ev["node"] == bus.node:
+            # our own join: everyone here but the joiner hears about it
+            joiner = room["by_name"].get(user)
+        else:
+            room["remote"][user] = ev["node"]
+            joiner = None
+            old = room["by_name"].pop(user, None)
+            if old is not None:
+                # newest connection wins, even when it is on another node
+                room["clients"].pop(old, None)
+                enqueue(old, dumps({"type": "session_replaced"}))
+                end_session(old)
+        deliver_local(room, dumps({"type": "peer_joined", "user": user, "v": ev["v"]}), except_ws=joiner)
+        update_media(room)
+        room["policy"].pop(user, None)  # a new connection has not been told yet
+        push_policies(room)
+        if joiner is not None and INTROS == "server" and room["media"] == "mesh":
+            # the joiner's node pairs it with everyone already there
+            intro_scheduler(room).add_peer(user, usernames_in_room(room))
+    elif kind == "leave":
+        user = ev["user"]
+        note_roster(room, ev["v"], "-", user)
+        if room["remote"].get(user) == ev["node"]:
+            del room["remote"][user]
+        forget_intros(room, user)
+        if room["sfu"] is not None:
+            room["sfu"].remove(user)
+        deliver_local(room, dumps({"type": "peer_left", "user": user, "v": ev["v"]}))
+        update_media(room)
+        if user not in room["by_name"]:
+            room["uplink"].pop(user, None)
+            room["policy"].pop(user, None)
+        push_policies(room)
+
+# Replaced by setup_bus() when SIGNAL_PUBSUB names another backend.
+bus = pubsub.LocalBus(on_bus_event)
+
+async def setup_bus(spec=None):
+    global bus
+    spec = spec or os.environ.get("SIGNAL_PUBSUB", "local")
+    if spec != "local":
+        await bus.close()
+        bus = await pubsub.connect(spec, on_bus_event)
+    return bus
+
+
+# ----------------- signal fast path -----------------
+# Browsers send directed signals as JSON.stringify({type:"signal", to, from, data})
+# with an opaque (encrypted) payload in data. For that exact shape we read
+# the target off the prefix and relay the frame as received, never decoding
+# or re-encoding the payload. The browser's data objects are flat and last,
+# so the shape check stays cheap: the keys between "to" and "data" (a short,
+# bounded stretch) hold no other "to" and no escapes, and the first "}"
+# after data opens is the one closing it, just before the final one. Then
+# no second "to" key can follow, and what the target reads as "to" is what
+# we routed on. Anything else takes the full parse.
+_SIGNAL_ENVELOPE = re.compile(r'\{"type":"signal","to":"([^"\\]*)"')
+_DATA_OPEN = ',"data":{'
+_ENVELOPE_SCAN = 512  # chars after "to" searched for data (room for "from")
+
+def signal_target(raw):
+    """Target username of a browser-shaped signal frame, or None if it needs the full parse."""
+    if type(raw) is not str or not raw.endswith("}}"):
+        return None
+    m = _SIGNAL_ENVELOPE.match(raw)
+    if m is None:
+        return None
+    end = m.end()
+    d = raw.find(_DATA_OPEN, end, end + _ENVELOPE_SCAN)
+    if d == -1:
+        return None
+    keys = raw[end:d]
+    if '"to"' in keys or "\\" in keys or raw.find("}", d + len(_DATA_OPEN)) != len(raw) - 2:
+        return None
+    return m.group(1)
+
+def stamp_sender(raw, sender_json):
+    # The appended "from" wins: JSON.parse (and json.loads) keep the last of
+    # duplicate keys, so a client-supplied "from" cannot spoof the sender.
+    return raw[:-1] + ',"from":' + sender_json + "}"
+
+
+def relay_signal(room, target, frame):
+    peer = room["by_name"].get(target)
+    if peer is not None:
+        enqueue(peer, frame)
+    elif target in room["remote"]:
+        bus.send(room["id"], target, frame)
+
+
+# ----------------- flood control -----------------
+# Per-connection token buckets, one per budget. A message over budget is
+# dropped (and counted). Limits are "rate/burst" in messages per second,
+# e.g. SIGNAL_RATE_SIGNAL=100/300. A full-mesh join costs every peer about
+# a dozen signals per other peer, which the signal burst has to cover.
+def _rate(name, default):
+    rate, _, burst = os.environ.get(name, default).partition("/")
+    return float(rate), float(burst or rate)
+
+RATE_LIMITS = {
+    "signal": _rate("SIGNAL_RATE_SIGNAL", "100/300"),
+    "chat":   _rate("SIGNAL_RATE_CHAT", "5/20"),
+    "host":   _rate("SIGNAL_RATE_HOST", "20/200"),  # introduce_pair is n^2/2 on a host's join
+}
+
+HOST_COMMANDS = frozenset(("iam_host", "host_mute_all", "host_kick", "transfer_host", "introduce_pair"))
+
+counters = collections.Counter()  # rate_dropped_<budget>, ice_merged, ice_batches, intro_*, send_failed,
+                                  # liveness_*, join_refused
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+def new_limits():
+    return {budget: TokenBucket(rate, burst) for budget, (rate, burst) in RATE_LIMITS.items()}
+
+def budget_for(mtype):
+    if mtype == "signal" or mtype == "intro_ack" or mtype == "sfu" or mtype == "uplink":
+        return "signal"
+    if mtype in HOST_COMMANDS:
+        return "host"
+    return "chat"  # chat and anything else that fans out to the room
+
+
+# ----------------- ICE candidate coalescing -----------------
+# With SIGNAL_ICE_COALESCE_MS > 0, trickled candidates (fast-path frames whose
+# data ends in ,"ice":1) to the same target are held for that window and sent
+# as one signal_batch frame. Any other signal to that target flushes the held
+# ones first, so per-target order is kept.
+ICE_COALESCE_MS = float(os.environ.get("SIGNAL_ICE_COALESCE_MS", "0"))
+
+_ICE_HINT = ',"ice":1}}'
+_DATA_KEY = ',"data":'
+
+class IceCoalescer:
+    __slots__ = ("room", "sender_json", "window", "pending", "timers")
+
+    def __init__(self, room, sender_json, window):
+        self.room = room
+        self.sender_json = sender_json
+        self.window = window
+        self.pending = {}  # target -> [raw frames]
+        self.timers = {}   # target -> TimerHandle
+
+    def push(self, target, raw):
+        if not raw.endswith(_ICE_HINT) or _DATA_KEY not in raw:
+            self.flush(target)
+            relay_signal(self.room, target, stamp_sender(raw, self.sender_json))
+            return
+        items = self.pending.get(target)
+        if items is None:
+            items = self.pending[target] = []
+            self.timers[target] = asyncio.get_running_loop().call_later(self.window, self.flush, target)
+        items.append(raw)
+
+    def flush(self, target):
+        timer = self.timers.pop(target, None)
+        if timer is not None:
+            timer.cancel()
+        items = self.pending.pop(target, None)
+        if not items:
+            return
+        if len(items) == 1:
+            frame = stamp_sender(items[0], self.sender_json)
+        else:
+            datas = [raw[raw.index(_DATA_KEY) + len(_DATA_KEY):-1] for raw in items]
+            frame = ('{"type":"signal_batch","to":' + dumps(target) + ',"from":' + self.sender_json
+                     + ',"items":[' + ",".join(datas) + "]}")
+            counters["ice_merged"] += len(items) - 1
+            counters["ice_batches"] += 1
+        relay_signal(self.room, target, frame)
+
+    def flush_all(self):
+        for target in list(self.pending):
+            self.flush(target)
+
+
+# ----------------- introduction scheduler -----------------
+INTROS = os.environ.get("SIGNAL_INTROS", "server")  # "client": browsers handshake on their own
+INTRO_RATE = float(os.environ.get("SIGNAL_INTRO_RATE", "4"))        # pairs released per second per room
+INTRO_BURST = float(os.environ.get("SIGNAL_INTRO_BURST", "4"))
+INTRO_PER_PEER = int(os.environ.get("SIGNAL_INTRO_PER_PEER", "2"))  # unfinished pairs per username
+INTRO_TIMEOUT = float(os.environ.get("SIGNAL_INTRO_TIMEOUT", "20"))
+
+join_to_connected = collections.deque(maxlen=1000)  # ms, most recent newcomers
+
+class IntroScheduler:
+    """Queued (newcomer, peer) introductions of one room, released at INTRO_RATE
+    with at most INTRO_PER_PEER in flight per username."""
+
+    def __init__(self, room):
+        self.room = room
+        self.queue = collections.deque()   # (newcomer, peer) pairs waiting
+        self.inflight = {}                 # pair -> timeout TimerHandle
+        self.busy = collections.Counter()  # username -> pairs in flight
+        self.joins = {}                    # newcomer -> [joined at, pairs outstanding, failed]
+        self.bucket = TokenBucket(INTRO_RATE, INTRO_BURST)
+        self.timer = None
+
+    def add_peer(self, user, others):
+        others = [o for o in others if o != user]
+        if not others:
+            return
+        self.joins[user] = [time.monotonic(), len(others), 0]
+        self.queue.extend((user, o) for o in others)
+        self._later(0)  # after the joiner has its peer_list
+
+    def _later(self, delay):
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(delay, self.pump)
+
+    def pump(self):
+        self.timer = None
+        waiting = collections.deque()
+        queue = self.queue
+        while queue:
+            pair = queue.popleft()
+            if self.busy[pair[0]] >= INTRO_PER_PEER or self.busy[pair[1]] >= INTRO_PER_PEER:
+                waiting.append(pair)  # retried when one of them finishes a pair
+                continue
+            if not self.bucket.take():
+                waiting.append(pair)
+                waiting.extend(queue)
+                queue.clear()
+                self._later(1.0 / INTRO_RATE)
+                break
+            self._release(pair)
+        self.queue = waiting
+
+    def _release(self, pair):
+        a, b = pair
+        self.busy[a] += 1
+        self.busy[b] += 1
+        self.inflight[pair] = asyncio.get_running_loop().call_later(INTRO_TIMEOUT, self._timeout, pair)
+        counters["intro_released"] += 1
+        for target, other in ((a, b), (b, a)):
+            relay_signal(self.room, target, dumps({
+                "type": "signal", "to": target, "from": "host",
+                "data": {"type": "intro", "other": other}}))
+
+    def ack(self, user, peer, ok):
+        for pair in ((user, peer), (peer, user)):
+            if pair in self.inflight:
+                counters["intro_acked" if ok else "intro_failed"] += 1
+                self.done(pair, ok)
+                return
+
+    def _timeout(self, pair):
+        counters["intro_timeouts"] += 1
+        self.done(pair, False)
+
+    def done(self, pair, ok, gone=False):
+        timer = self.inflight.pop(pair, None)
+        if timer is None:
+            return
+        timer.cancel()
+        for name in pair:
+            self.busy[name] -= 1
+            if self.busy[name] <= 0:
+                del self.busy[name]
+        self._settle(pair[0], failed=not ok and not gone)
+        self._later(0)
+
+    def _settle(self, newcomer, failed=False):
+        j = self.joins.get(newcomer)
+        if j is None:
+            return
+        j[1] -= 1
+        j[2] += failed
+        if j[1] <= 0:
+            del self.joins[newcomer]
+            ms = round(1000 * (time.monotonic() - j[0]), 1)
+            join_to_connected.append(ms)
+            log.info("peer connected", room=self.room["id"], user=newcomer,
+                     join_to_connected_ms=ms, failed_pairs=j[2])
+
+    def forget(self, user):
+        """Drop every pair involving user (it left, or a new session took the name)."""
+        self.joins.pop(user, None)
+        kept = collections.deque()
+        for pair in self.queue:
+            if user in pair:
+                self._settle(pair[0])
+            else:
+                kept.append(pair)
+        self.queue = kept
+        for pair in [p for p in self.inflight if user in p]:
+            self.done(pair, False, gone=True)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        for timer in self.inflight.values():
+            timer.cancel()
+
+def intro_scheduler(room):
+    if room["intros"] is None:
+        room["intros"] = IntroScheduler(room)
+    return room["intros"]
+
+def forget_intros(room, user):
+    if room["intros"] is not None:
+        room["intros"].forget(user)
+
+def intro_summary():
+    return summarize_ms(join_to_connected)
+
+
+# ----------------- chat history -----------------
+# Room-wide chat is kept in a small per-room ring of the frames already sent,
+# so a late joiner gets recent context in one chat_history frame instead of
+# peers re-sending it. Capped by count and bytes; private messages are not kept.
+CHAT_HISTORY_MAX = int(os.environ.get("SIGNAL_CHAT_HISTORY", "50"))            # messages; 0 disables
+CHAT_HISTORY_BYTES = int(os.environ.get("SIGNAL_CHAT_HISTORY_BYTES", "32768"))  # encoded frames
+
+_CHAT_PREFIX = '{"type":"chat",'
+
+class ChatHistory:
+    """Fixed-size ring of encoded chat frames (oldest evicted first)."""
+    __slots__ = ("frames", "sizes", "start", "count", "bytes")
+
+    def __init__(self, size=CHAT_HISTORY_MAX):
+        self.frames = [None] * size          # preallocated: memory is bounded by `size`
+        self.sizes = array("I", bytes(4 * size))
+        self.start = 0
+        self.count = 0
+        self.bytes = 0
+
+    def _evict(self):
+        i = self.start
+        self.bytes -= self.sizes[i]
+        self.frames[i] = None
+        self.start = (i + 1) % len(self.frames)
+        self.count -= 1
+
+    def add(self, frame):
+        size = len(frame)
+        if size > CHAT_HISTORY_BYTES:
+            return
+        while self.count and (self.count == len(self.frames) or self.bytes + size > CHAT_HISTORY_BYTES):
+            self._evict()
+        i = (self.start + self.count) % len(self.frames)
+        self.frames[i] = frame
+        self.sizes[i] = size
+        self.count += 1
+        self.bytes += size
+
+    def frame(self):
+        """One chat_history frame with everything kept, oldest first; None if empty."""
+        if not self.count:
+            return None
+        n = len(self.frames)
+        items = ",".join(self.frames[(self.start + k) % n] for k in range(self.count))
+        return '{"type":"chat_history","items":[' + items + "]}"
+
+def is_chat_frame(data):
+    # a blind relay of a non-JSON message could share the prefix; only keep real chat
+    try:
+        return loads(data).get("type") == "chat"
+    except Exception:
+        return False
+
+def remember_chat(room, frame):
+    if CHAT_HISTORY_MAX <= 0:
+        return
+    if room["chat"] is None:
+        room["chat"] = ChatHistory()
+    room["chat"].add(frame)
+
+
+# ----------------- selective forwarding -----------------
+# A room of SFU_AT or more peers switches from the browser mesh (n-1 uploads
+# per browser) to sfu.py (one upload, forwarded by the server) and back once
+# it is down to SFU_AT - 3 or fewer. Clients hear it as {type:"media_mode"}
+# and in peer_list. Needs aiortc. A room with peers on other signaling nodes
+# stays a mesh: its media would have to be cascaded between the nodes.
+# Opt-in (SIGNAL_SFU=on): the server decrypts what it forwards, so an SFU
+# room is not end to end; the room page shows which mode a call is in.
+sfu = None
+if os.environ.get("SIGNAL_SFU", "off") == "on":
+    try:
+        import sfu
+    except ImportError as e:
+        log.warning("SIGNAL_SFU=on but sfu.py cannot load (pip install -r requirements-sfu.txt): "
+                    "rooms stay a mesh", error=str(e))
+
+SFU_AT = int(os.environ.get("SIGNAL_SFU_AT", "5")) if sfu is not None else 0  # 0: always a mesh
+SFU_KEEP = max(SFU_AT - 2, 1)  # an SFU room stays one down to this many peers
+
+def media_mode(room):
+    n = len(room["by_name"]) + len(room["remote"])
+    if not SFU_AT or room["remote"] or not n:
+        return "mesh"
+    return "sfu" if n >= (SFU_KEEP if room["media"] == "sfu" else SFU_AT) else "mesh"
+
+def sfu_send(room, user, data):
+    peer = room["by_name"].get(user)
+    if peer is not None:
+        enqueue(peer, dumps({"type": "sfu", "data": data}))
+
+def update_media(room):
+    """Switch the room between mesh and SFU if its size says so."""
+    mode = media_mode(room)
+    if mode == room["media"]:
+        return
+    room["media"] = mode
+    counters["media_" + mode] += 1
+    log.info("media mode", room=room["id"], mode=mode, peers=len(room["by_name"]))
+    if mode == "sfu":
+        room["sfu"] = sfu.Room(lambda user, data: sfu_send(room, user, data), spawn)
+        if room["intros"] is not None:
+            room["intros"].close()  # pairs not yet introduced never need to be
+            room["intros"] = None
+    else:
+        if room["sfu"] is not None:
+            spawn(room["sfu"].close())
+            room["sfu"] = None
+        if INTROS == "server":
+            # every remaining pair needs its mesh connection (back)
+            users = usernames_in_room(room)
+            scheduler = intro_scheduler(room)
+            for i, user in enumerate(users):
+                scheduler.add_peer(user, users[:i])
+    deliver_local(room, dumps({"type": "media_mode", "mode": mode}), key="media")
+
+def sfu_report():
+    report = {"enabled": bool(SFU_AT), "rooms": 0, "sessions": 0, "published": 0, "forwarded": 0}
+    for room in rooms.values():
+        if room["sfu"] is not None:
+            report["rooms"] += 1
+            for k, v in room["sfu"].report().items():
+                report[k] += v
+    if sfu is not None:
+        report.update(sfu.counters)
+    return report
+
+
+# ----------------- media policy -----------------
+# What each local peer may send per outgoing camera stream. In a mesh a peer
+# uploads one copy per other peer, so its uplink is split n-1 ways; through
+# the SFU it uploads one. The uplink is what the client reports while its
+# bandwidth estimate limits its video, else POLICY_UPLINK_KBPS. Recomputed on
+# joins, leaves (and so mode switches) and uplink reports; a peer only hears
+# {type:"media_policy"} when its policy changed.
+POLICY = os.environ.get("SIGNAL_MEDIA_POLICY", "on") != "off"
+POLICY_UPLINK_KBPS = int(os.environ.get("SIGNAL_POLICY_UPLINK_KBPS", "3000"))  # assumed uplink
+POLICY_STREAM_MAX_KBPS = int(os.environ.get("SIGNAL_POLICY_STREAM_MAX_KBPS", "2500"))
+POLICY_STREAM_MIN_KBPS = 100
+POLICY_LADDER = (  # (per-stream kbps from, height, fps)
+    (1500, 720, 30),
+    (800, 540, 30),
+    (450, 360, 24),
+    (250, 270, 20),
+    (0, 180, 15),
+)
+
+def media_policy(room, user):
+    n = len(room["by_name"]) + len(room["remote"])
+    streams = 1 if room["media"] == "sfu" else max(n - 1, 1)
+    uplink = room["uplink"].get(user, POLICY_UPLINK_KBPS)
+    kbps = max(min(uplink // streams, POLICY_STREAM_MAX_KBPS), POLICY_STREAM_MIN_KBPS)
+    height, fps = next((h, f) for floor, h, f in POLICY_LADDER if kbps >= floor)
+    return {"type": "media_policy", "max_kbps": kbps, "height": height, "fps": fps, "streams": streams}
+
+def push_policies(room, users=None):
+    if not POLICY:
+        return
+    for user in users if users is not None else list(room["by_name"]):
+        ws = room["by_name"].get(user)
+        if ws is None:
+            continue
+        policy = media_policy(room, user)
+        if room["policy"].get(user) != policy:
+            room["policy"][user] = policy
+            counters["media_policies"] += 1
+            enqueue(ws, dumps(policy), key="policy")
+
+def note_uplink(room, user, kbps):
+    if kbps is None:
+        room["uplink"].pop(user, None)
+    elif type(kbps) in (int, float) and kbps > 0:
+        room["uplink"][user] = int(min(kbps, 10**6))
+    else:
+        return
+    push_policies(room, [user])
+
+
+# ----------------- session resumption -----------------
+RESUME_GRACE = float(os.environ.get("SIGNAL_RESUME_GRACE", "20"))  # seconds; 0 disables
+RESUME_BUFFER_MAX = int(os.environ.get("SIGNAL_RESUME_BUFFER_MAX", "64"))
+NORMAL_CLOSE = (1000, 1001)  # the client meant to leave (hangup, page closed)
+SESSION_MOVED = 4000          # close code for a socket whose session a resume took over
+
+parked = {}  # resume token -> {"room_id", "room", "user", "ws", "timer"}
+
+def can_park(room, ws, user):
+    box = outboxes.get(ws)
+    return (RESUME_GRACE > 0 and box is not None and not box.closing
+            and ws.close_code is not None and ws.close_code not in NORMAL_CLOSE
+            and room["clients"].get(ws) == user)
+
+def park(room_id, room, ws, user):
+    box = outboxes[ws]
+    box.park()
+    timer = asyncio.get_running_loop().call_later(RESUME_GRACE, lambda: spawn(expire(box.token)))
+    parked[box.token] = {"room_id": room_id, "room": room, "user": user, "ws": ws, "timer": timer}
+
+async def expire(token):
+    slot = parked.pop(token, None)
+    if slot is not None:
+        log.info("resume grace expired", room=slot["room_id"], user=slot["user"])
+        await release(slot["room_id"], slot["room"], slot["ws"])
+
+def take_parked(token, room_id, user):
+    """The parked slot for token, if it really is this room's `user`."""
+    slot = parked.get(token)
+    if (slot is None or slot["room_id"] != room_id or slot["user"] != user
+            or rooms.get(room_id) is not slot["room"] or slot["room"]["clients"].get(slot["ws"]) != user):
+        return None
+    del parked[token]
+    slot["timer"].cancel()
+    return slot
+
+def live_session(token, room_id, user):
+    """The still-open socket holding session `token` as this room's `user`, if any.
+
+    A blip without a FIN leaves the old socket looking open until liveness
+    notices; the client's resume must not wait for that."""
+    room = rooms.get(room_id)
+    ws = room["by_name"].get(user) if room is not None else None
+    box = outboxes.get(ws)
+    if box is None or box.parked or box.closing or not secrets.compare_digest(box.token, token):
+        return None
+    return ws
+
+def take_live(token, room_id, user):
+    """Detach a still-open session for a resume; its socket is closed, its outbox kept."""
+    ws = live_session(token, room_id, user)
+    if ws is None:
+        return None
+    outboxes[ws].park()
+    spawn(ws.close(SESSION_MOVED, "session resumed elsewhere"))
+    return {"room_id": room_id, "room": rooms[room_id], "user": user, "ws": ws}
+
+def resume_client(room, old_ws, ws, user):
+    """Move a parked slot over to the reconnected socket. Returns True if frames were lost."""
+    box = outboxes.pop(old_ws)
+    del room["clients"][old_ws]
+    room["clients"][ws] = user
+    room["by_name"][user] = ws
+    outboxes[ws] = box
+    lost = box.lost
+    if lost:
+        # missed roster/signal frames cannot be replayed: start from a fresh list
+        box.frames.clear()
+        box.frames.append((None, roster_frame(room)))
+        if room["chat"] is not None and room["chat"].count:
+            box.frames.append((None, room["chat"].frame()))
+    box.frames.appendleft((None, dumps({"type": "resumed", "lost": lost})))
+    box.attach(ws)
+    return lost
+
+async def release(room_id, room, ws):
+    """Take ws out of the room for good. Returns its username if it was still registered."""
+    user_left = remove_client(room, ws)
+    box = outboxes.pop(ws, None)
+    if box is not None:
+        box.task.cancel()
+
+    # The hub tells the others (a replaced session has already handed its
+    # name over). If the host left, it promotes deterministically
+    # (alphabetical) and announces host_changed.
+    if user_left is not None:
         try:
-            await peer.send(json.dumps(payload))
-            return True
-        except Exception:
+            await bus.leave(room_id, user_left)
+        except ConnectionError:
             pass
-    return False
-    
+
+    if not room["clients"] and rooms.get(room_id) is room:
+        rooms.pop(room_id, None)
+        if room["intros"] is not None:
+            room["intros"].close()
+        if room["sfu"] is not None:
+            spawn(room["sfu"].close())
+            room["sfu"] = None
+    return user_left
+
+
+async def join(ws, room_id, user, query):
+    """Register a new connection. Returns the room, or None if it was refused."""
+    # Create room if missing
+    if room_id not in rooms:
+        rooms[room_id] = new_room(room_id)
+    room = rooms[room_id]
+
+    # Register client (newest connection wins a duplicate username)
+    outboxes[ws] = Outbox(ws)
+    if RESUME_GRACE > 0:
+        # first, ahead of peer_list and media_mode: the client resets its
+        # per-session state (SFU connection) on it
+        enqueue(ws, dumps({"type": "session", "resume": outboxes[ws].token, "grace": RESUME_GRACE}))
+    replaced = add_client(room, ws, user)
+    log.info("peer joined", room=room_id, user=user, replaced=replaced is not None)
+    if replaced is not None:
+        enqueue(replaced, dumps({"type": "session_replaced"}))
+        end_session(replaced)
+
+    # Register with the hub; learn peers on other nodes and the current host.
+    # The hub announces peer_joined to the rest of the room.
+    try:
+        snapshot = await bus.join(room_id, user)
+    except ConnectionError:
+        log.error("pubsub unavailable; refusing peer", room=room_id, user=user)
+        remove_client(room, ws)
+        outboxes.pop(ws).task.cancel()
+        if not room["clients"] and rooms.get(room_id) is room:
+            rooms.pop(room_id, None)
+        await ws.close(1011, "signaling backend unavailable")
+        return None
+    for name, node in snapshot["members"].items():
+        if name not in room["by_name"] and node != bus.node:
+            room["remote"][name] = node
+    room["host"] = snapshot["host"]
+    if snapshot["version"] > room["version"]:
+        # first local peer of a room that already exists elsewhere: history starts here
+        room["version"] = snapshot["version"]
+        room["log"].clear()
+
+    # Initial host selection (first user becomes host); the hub announces it
+    # to all (including the new joiner)
+    if room["host"] is None:
+        await bus.claim_host(room_id, None, user)
+
+    # Send current peer list (and host) to the new client; a reconnecting
+    # client that passed ?since=v only gets what changed
+    since = query.get("since", [None])[0]
+    enqueue(ws, roster_frame(room, int(since) if since and since.isdigit() else None))
+    if room["chat"] is not None and room["chat"].count:
+        enqueue(ws, room["chat"].frame())
+    return room
+
+
+# ----------------- liveness -----------------
+# With SIGNAL_LIVENESS=wheel (the default) websockets' keepalive task per
+# connection is off and one task watches every socket instead. A connection
+# only records when it last spoke; a hierarchical timing wheel wakes it when
+# it may have gone quiet, and only then is it pinged. No pong (and no
+# message) within LIVENESS_TIMEOUT makes it a ghost, and ghosts are aborted
+# at most LIVENESS_EVICT_BATCH per tick. Peers of rooms that were busy in the
+# last LIVENESS_BUSY_WINDOW seconds are checked sooner than idle ones.
+# SIGNAL_LIVENESS=websockets restores the built-in 20 s pings.
+LIVENESS = os.environ.get("SIGNAL_LIVENESS", "wheel")
+LIVENESS_ACTIVE = float(os.environ.get("SIGNAL_LIVENESS_ACTIVE", "15"))  # silence before a ping, busy room
+LIVENESS_IDLE = float(os.environ.get("SIGNAL_LIVENESS_IDLE", "60"))      # same, quiet room
+LIVENESS_BUSY_WINDOW = 60.0
+LIVENESS_TIMEOUT = float(os.environ.get("SIGNAL_LIVENESS_TIMEOUT", "20"))
+LIVENESS_EVICT_BATCH = int(os.environ.get("SIGNAL_LIVENESS_EVICT_BATCH", "500"))
+
+class TimingWheel:
+    """Two-level hashed timing wheel: `slots` ticks in the inner wheel, then
+    `slots` ticks per slot in the outer one (1 s x 64 x 64 is about 68 min).
+    Adding is O(1); advancing costs one slot per elapsed tick."""
+
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = slots
+        self.inner = [[] for _ in range(slots)]
+        self.outer = [[] for _ in range(slots)]
+        self.now = int(time.monotonic() / tick)  # current tick
+        self.size = 0
+
+    def add(self, item, when):
+        t = min(max(int(when / self.tick), self.now + 1), self.now + self.slots * self.slots - 1)
+        self._place(t, item)
+        self.size += 1
+
+    def _place(self, t, item):
+        if t - self.now < self.slots:
+            self.inner[t % self.slots].append(item)
+        else:
+            self.outer[(t // self.slots) % self.slots].append((t, item))
+
+    def advance(self, when):
+        """Items whose tick has come, up to monotonic time `when`."""
+        due = []
+        target = int(when / self.tick)
+        while self.now < target:
+            self.now += 1
+            i = self.now % self.slots
+            if i == 0:
+                # a full turn: the next outer slot now fits in the inner wheel
+                j = (self.now // self.slots) % self.slots
+                bucket, self.outer[j] = self.outer[j], []
+                for t, item in bucket:
+                    self._place(t, item)
+            if self.inner[i]:
+                due.extend(self.inner[i])
+                self.inner[i] = []
+        self.size -= len(due)
+        return due
+
+class Alive:
+    __slots__ = ("ws", "room", "seen", "pinged")
+
+    def __init__(self, ws, room, now):
+        self.ws = ws          # None once the connection is gone
+        self.room = room
+        self.seen = now       # last message or pong (monotonic)
+        self.pinged = 0.0     # when the pending ping went out, 0 if none
+
+class Liveness:
+    def __init__(self):
+        self.wheel = TimingWheel()
+        self.ghosts = collections.deque()
+        self.tracked = 0
+
+    def interval(self, alive, now):
+        return LIVENESS_ACTIVE if now - alive.room["seen"] < LIVENESS_BUSY_WINDOW else LIVENESS_IDLE
+
+    def add(self, ws, room):
+        now = time.monotonic()
+        alive = Alive(ws, room, now)
+        self.wheel.add(alive, now + self.interval(alive, now))
+        self.tracked += 1
+        return alive
+
+    def discard(self, alive):
+        # the wheel entry is dropped lazily when its tick comes
+        if alive.ws is not None:
+            alive.ws = None
+            self.tracked -= 1
+
+    def check(self, now):
+        """One tick: reschedule the live, collect who to ping, queue the ghosts."""
+        pings = []
+        for alive in self.wheel.advance(now):
+            if alive.ws is None:
+                continue
+            if alive.pinged:
+                if alive.seen >= alive.pinged:
+                    alive.pinged = 0.0  # answered
+                elif now - alive.pinged >= LIVENESS_TIMEOUT:
+                    self.ghosts.append(alive)
+                    continue
+                else:
+                    self.wheel.add(alive, alive.pinged + LIVENESS_TIMEOUT)
+                    continue
+            due = alive.seen + self.interval(alive, now)
+            if due > now:
+                self.wheel.add(alive, due)
+            else:
+                alive.pinged = now
+                pings.append(alive)
+                self.wheel.add(alive, now + LIVENESS_TIMEOUT)
+        return pings
+
+    def evict(self):
+        n = 0
+        while self.ghosts and n < LIVENESS_EVICT_BATCH:
+            alive = self.ghosts.popleft()
+            ws = alive.ws
+            if ws is not None and ws.open:
+                # a ghost will not answer a close handshake either; handler()'s finally parks it
+                ws.transport.abort()
+                n += 1
+        if n:
+            counters["liveness_evicted"] += n
+            log.info("ghost connections evicted", count=n, waiting=len(self.ghosts))
+
+    async def _ping(self, alive):
+        ws = alive.ws
+        if ws is None or not ws.open:
+            return
+        pong = await ws.ping()
+        pong.add_done_callback(lambda f: self._pong(alive, f))
+
+    @staticmethod
+    def _pong(alive, fut):
+        if not fut.cancelled() and fut.exception() is None:
+            alive.seen = time.monotonic()
+
+    async def _ping_all(self, batch):
+        counters["liveness_pings"] += len(batch)
+        await asyncio.gather(*(self._ping(a) for a in batch), return_exceptions=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            pings = self.check(time.monotonic())
+            if pings:
+                spawn(self._ping_all(pings))
+            self.evict()
+
+    def report(self):
+        return {"mode": LIVENESS, "tracked": self.tracked, "scheduled": self.wheel.size,
+                "ghosts_waiting": len(self.ghosts)}
+
+liveness = Liveness()
+
+
+# ----------------- join tokens -----------------
+# With SECRET_KEY set (the same one app.py uses), an upgrade must carry
+# ?token= issued by app.py for exactly this room and user (jointoken.py), or
+# a ?resume= token of a session parked here. Both checks are in memory and
+# happen in process_request, before the websocket handshake.
+JOIN_SECRET = os.environ.get("SECRET_KEY")
+join_verifier = jointoken.Verifier(JOIN_SECRET) if JOIN_SECRET else None
+
+def set_join_secret(secret):
+    global join_verifier
+    join_verifier = jointoken.Verifier(secret) if secret else None
+
+def join_allowed(query):
+    room_id = query.get("room", ["default"])[0]
+    user = query.get("user", ["anon"])[0]
+    resume = query.get("resume", [None])[0]
+    if resume:
+        slot = parked.get(resume)
+        if slot is not None and slot["room_id"] == room_id and slot["user"] == user:
+            return True
+        if live_session(resume, room_id, user) is not None:
+            return True
+    token = query.get("token", [None])[0]
+    return token is not None and join_verifier.check(token, room_id, user)
+
+
+# ----------------- introspection -----------------
+# GET /healthz and GET /metrics are answered on the websocket port itself
+# (process_request), so probes and dashboards need no second listener.
+METRICS_WINDOW = float(os.environ.get("SIGNAL_METRICS_WINDOW", "10"))  # seconds behind msgs_per_s
+LAG_INTERVAL = 0.5
+MSG_TYPES = {"hello", "iam_host", "host_mute_all", "host_kick", "transfer_host", "introduce_pair",
+             "intro_ack", "roster_sync", "signal", "chat", "sfu", "uplink"}
+PEER_BUCKETS = (1, 2, 4, 8, 16, 32)  # peers-per-room histogram upper bounds; the rest is "+inf"
+
+ready = True                           # False while draining: /healthz answers 503
+started = time.time()
+msg_counts = collections.Counter()     # inbound messages by type since start
+fanout_ms = collections.deque(maxlen=1000)
+loop_lag_ms = collections.deque(maxlen=120)
+_rate_marks = collections.deque()      # (monotonic, copy of msg_counts)
+
+def count_msg(mtype):
+    msg_counts[mtype if mtype in MSG_TYPES else "other"] += 1
+
+async def monitor():
+    """Sample event-loop lag and keep the marks behind the message rates."""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        now = loop.time()
+        loop_lag_ms.append(round(1000 * (now - t0 - LAG_INTERVAL), 3))
+        _rate_marks.append((now, collections.Counter(msg_counts)))
+        while len(_rate_marks) > 1 and now - _rate_marks[0][0] > METRICS_WINDOW:
+            _rate_marks.popleft()
+
+def start_monitor():
+    """Background tasks of a serving process: loop-lag sampling and liveness."""
+    if LIVENESS == "wheel":
+        spawn(liveness.run())
+    return spawn(monitor())
+
+def msg_rates():
+    if not _rate_marks:
+        return {}
+    t0, then = _rate_marks[0]
+    dt = asyncio.get_running_loop().time() - t0
+    if dt <= 0:
+        return {}
+    return {k: round((n - then[k]) / dt, 2) for k, n in sorted(msg_counts.items()) if n > then[k]}
+
+def peers_histogram():
+    hist = dict.fromkeys([str(b) for b in PEER_BUCKETS] + ["+inf"], 0)
+    for room in rooms.values():
+        n = len(room["clients"])
+        hist[next((str(b) for b in PEER_BUCKETS if n <= b), "+inf")] += 1
+    return hist
+
+def queue_report(top=10):
+    # /metrics is unauthenticated: depths only, never room ids or usernames
+    depths = []
+    for room in rooms.values():
+        for q in queue_depths(room).values():
+            depths.append((q["depth"], q["dropped"]))
+    depths.sort(reverse=True)
+    return {
+        "total": sum(d[0] for d in depths),
+        "max": depths[0][0] if depths else 0,
+        "dropped": sum(d[1] for d in depths),
+        "deepest": [{"depth": d, "dropped": x} for d, x in depths[:top] if d],
+    }
+
+def metrics():
+    return {
+        "ts": round(time.time(), 3),
+        "uptime_s": round(time.time() - started, 1),
+        "ready": ready,
+        "node": bus.node,
+        "rooms": len(rooms),
+        "peers": sum(len(r["clients"]) for r in rooms.values()),
+        "parked": len(parked),
+        "peers_per_room": peers_histogram(),
+        "msgs_total": dict(msg_counts),
+        "msgs_per_s": msg_rates(),
+        "fanout": summarize_ms(fanout_ms),
+        "send_failed": counters["send_failed"],
+        "queues": queue_report(),
+        "loop_lag": summarize_ms(loop_lag_ms),
+        "liveness": liveness.report(),
+        "intros": intro_summary(),
+        "sfu": sfu_report(),
+        "counters": dict(counters),
+    }
+
+def _json_response(status, obj):
+    body = dumps(obj).encode()
+    headers = [("Content-Type", "application/json"), ("Cache-Control", "no-store"),
+               ("Content-Length", str(len(body)))]
+    return status, headers, body
+
+async def process_request(path, request_headers):
+    """Plain HTTP on the websocket port: /healthz for load balancers, /metrics for people."""
+    route = urlparse(path).path
+    if route == "/healthz":
+        status = http.HTTPStatus.OK if ready else http.HTTPStatus.SERVICE_UNAVAILABLE
+        return _json_response(status, {"status": "ok" if ready else "draining", "ready": ready,
+                                       "rooms": len(rooms), "uptime_s": round(time.time() - started, 1)})
+    if route == "/metrics":
+        return _json_response(http.HTTPStatus.OK, metrics())
+    if not ready:
+        # upgrades that were already queued when we stopped listening
+        return _json_response(http.HTTPStatus.SERVICE_UNAVAILABLE, {"status": "draining"})
+    if join_verifier is not None and not join_allowed(parse_qs(urlparse(path).query)):
+        counters["join_refused"] += 1
+        return _json_response(http.HTTPStatus.FORBIDDEN, {"error": "invalid join token"})
+    return None
+
+
+# ----------------- drain -----------------
+# SIGTERM starts a drain instead of dropping every room at once: stop
+# listening (a successor bound to the same port with SO_REUSEPORT takes the
+# new connections), then close rooms one by one over DRAIN_SECONDS. Each
+# peer is told server_draining with its own random retry delay first, so
+# reconnects reach the new process spread out rather than all together.
+# WebRTC media is peer to peer and keeps flowing meanwhile.
+DRAIN_SECONDS = float(os.environ.get("SIGNAL_DRAIN_SECONDS", "30"))      # spread room closes over this
+DRAIN_JITTER_MS = int(os.environ.get("SIGNAL_DRAIN_JITTER_MS", "5000"))  # max client retry delay
+DRAIN_CLOSE_CODE = 1012  # service restart
+# Off by default: two servers sharing a port by accident would split rooms.
+REUSE_PORT = os.environ.get("SIGNAL_REUSE_PORT", "0") == "1" and hasattr(socket, "SO_REUSEPORT")
+
+def drain_room(room):
+    for ws in list(room["clients"]):
+        enqueue(ws, dumps({"type": "server_draining", "retry_ms": random.randint(0, DRAIN_JITTER_MS)}))
+        box = outboxes.get(ws)
+        if box is not None and box.parked:
+            end_session(ws)
+        elif box is not None:
+            box.close(DRAIN_CLOSE_CODE)
+
+async def drain(server):
+    """Stop taking peers and close rooms gradually. Returns once every room is gone."""
+    global ready
+    if not ready:
+        return
+    ready = False
+    log.warning("draining", rooms=len(rooms), peers=sum(len(r["clients"]) for r in rooms.values()),
+                seconds=DRAIN_SECONDS)
+    server.server.close()  # listening sockets only; open connections stay up
+
+    room_ids = list(rooms)
+    step = DRAIN_SECONDS / len(room_ids) if room_ids else 0
+    for room_id in room_ids:
+        room = rooms.get(room_id)
+        if room is not None:
+            drain_room(room)
+        await asyncio.sleep(step)
+
+    # rooms opened meanwhile (resumes) and sockets still flushing
+    deadline = time.monotonic() + 10
+    while rooms and time.monotonic() < deadline:
+        for room in list(rooms.values()):
+            drain_room(room)
+        await asyncio.sleep(0.2)
+    log.warning("drained", rooms_left=len(rooms))
 
 
 # ----------------- core handler -----------------
@@ -82,58 +1436,116 @@ async def handler(ws, path):
     query = parse_qs(urlparse(path).query)
     room_id = query.get("room", ["default"])[0]
     user    = query.get("user", ["anon"])[0]
+    jsonlog.set_request_id()  # one id per connection, carried by every log line below
 
-    # Create room if missing
-    if room_id not in rooms:
-        rooms[room_id] = {"clients": {}, "host": None}
-    room = rooms[room_id]
+    resume = query.get("resume", [None])[0]
+    slot = take_parked(resume, room_id, user) if resume else None
+    took_over = False
+    if slot is None and resume:
+        slot = take_live(resume, room_id, user)
+        took_over = slot is not None
+    if slot is not None:
+        # Same identity, host role and queued frames; the room sees nothing.
+        # A taken-over socket's own handler finds neither its outbox nor its
+        # slot, so its cleanup releases nothing.
+        room = slot["room"]
+        lost = resume_client(room, slot["ws"], ws, user)
+        log.info("peer resumed", room=room_id, user=user, lost=lost, took_over=took_over)
+    elif resume and join_verifier is not None:
+        # admitted on the strength of a slot that has since gone (expired or
+        # taken by a racing reconnect); the token was not checked, so no join
+        counters["join_refused"] += 1
+        log.info("resume slot gone", room=room_id, user=user)
+        await ws.close(1008, "resume slot gone")
+        return
+    else:
+        room = await join(ws, room_id, user, query)
+        if room is None:
+            return
 
-    # Register client
-    room["clients"][ws] = user
-    print(f"[INFO] {user} joined {room_id}")
-
-    # Initial host selection (first user becomes host)
-    if room["host"] is None:
-        room["host"] = user
-        # Announce host to all (including the new joiner)
-        await broadcast(room, {"type": "host_changed", "host": user})
+    sender_json = dumps(user)
 
-    # Send current peer list (and host) to the new client
-    users = usernames_in_room(room)
-    await ws.send(json.dumps({"type": "peer_list", "users": users, "host": room["host"]}))
+    limits = new_limits()
+    dropped = collections.Counter()
+    coalescer = IceCoalescer(room, sender_json, ICE_COALESCE_MS / 1000.0) if ICE_COALESCE_MS > 0 else None
+    alive = liveness.add(ws, room) if LIVENESS == "wheel" else None
 
-    # Notify others someone joined
-    await broadcast(room, {"type": "peer_joined", "user": user}, except_ws=ws)
+    def over_budget(budget):
+        if limits[budget].take():
+            return False
+        if not dropped:
+            log.warning("peer rate limited", room=room_id, user=user, budget=budget)
+        dropped[budget] += 1
+        counters["rate_dropped_" + budget] += 1
+        return True
 
     try:
         async for raw in ws:
+            if alive is not None:
+                alive.seen = room["seen"] = time.monotonic()
+
+            # ---- Directed signaling relay (fast path) ----
+            target = signal_target(raw)
+            if target is not None and room["clients"].get(ws) == user:
+                msg_counts["signal"] += 1
+                if over_budget("signal"):
+                    continue
+                if coalescer is not None:
+                    coalescer.push(target, raw)
+                else:
+                    relay_signal(room, target, stamp_sender(raw, sender_json))
+                continue
+
             # Try to parse JSON; if not JSON → blind relay to others
             try:
-                msg = json.loads(raw)
+                msg = loads(raw)
             except Exception:
-                await broadcast(room, raw, except_ws=ws)
+                msg_counts["raw"] += 1
+                if not over_budget("chat"):
+                    await broadcast(room, raw, except_ws=ws)
+                continue
+
+            count_msg(msg.get("type") if isinstance(msg, dict) else None)
+            if not isinstance(msg, dict) or over_budget(budget_for(msg.get("type"))):
                 continue
 
             sender_name = room["clients"].get(ws, "anon")
 
+            # ---- Roster catch-up after a version gap ----
+            if msg.get("type") == "roster_sync":
+                since = msg.get("since")
+                enqueue(ws, roster_frame(room, since if type(since) is int and since >= 0 else None))
+                continue
+
+            # ---- Introduction finished (WebRTC connected or failed) ----
+            if msg.get("type") == "intro_ack":
+                if room["intros"] is not None:
+                    room["intros"].ack(sender_name, msg.get("peer"), msg.get("ok", True) is not False)
+                continue
+
+            # ---- Selective forwarding: negotiation with the server's side ----
+            if msg.get("type") == "sfu":
+                data = msg.get("data")
+                if room["sfu"] is not None and isinstance(data, dict):
+                    await room["sfu"].handle(sender_name, data)
+                continue
+
+            # ---- Uplink estimate (media policy) ----
+            if msg.get("type") == "uplink":
+                note_uplink(room, sender_name, msg.get("kbps"))
+                continue
+
             # ---- Host designation (only if no host yet) ----
             if msg.get("type") == "iam_host":
-                if room["host"] is None:
-                    room["host"] = sender_name
-                    print(f"[HOST] {sender_name} is host of {room_id}")
-                    await broadcast(room, {"type": "host_changed", "host": sender_name})
+                if room["host"] is None and await bus.claim_host(room_id, None, sender_name):
+                    log.info("host claimed", room=room_id, host=sender_name)
                 continue
 
             # ---- Host: mute all ----
             if msg.get("type") == "host_mute_all":
                 if sender_name == room.get("host"):
-                    # broadcast only to non-hosts
-                    for peer, uname in list(room["clients"].items()):
-                        if peer.open and uname != sender_name:
-                            try:
-                                await peer.send(json.dumps({"type": "host_mute"}))
-                            except Exception:
-                                pass
+                    # broadcast only to non-hosts (serialized once)
+                    broadcast_frame(room, dumps({"type": "host_mute"}), except_ws=ws, key="mute")
                 continue
 
             # ---- Host: kick specific user ----
@@ -143,24 +1555,19 @@ async def handler(ws, path):
                     if not target:
                         continue
                     target_ws = ws_for_username(room, target)
-                    if target_ws and target_ws.open:
-                        try:
-                            await target_ws.send(json.dumps({"type": "host_kick", "to": target}))
-                        except Exception:
-                            pass
-                        # Close their socket
-                        try:
-                            await target_ws.close()
-                        except Exception:
-                            pass
+                    if target_ws is not None:
+                        enqueue(target_ws, dumps({"type": "host_kick", "to": target}))
+                        # Close their socket once the warning is out
+                        end_session(target_ws)
+                    elif target in room["remote"]:
+                        bus.send(room_id, target, dumps({"type": "host_kick", "to": target}), close=True)
                 continue
 
             # ---- Host: transfer host role ----
             if msg.get("type") == "transfer_host":
                 target = msg.get("to")
-                if sender_name == room.get("host") and target in usernames_in_room(room):
-                    room["host"] = target
-                    await broadcast(room, {"type": "host_changed", "host": target})
+                if sender_name == room.get("host") and in_room(room, target):
+                    await bus.claim_host(room_id, sender_name, target)
                 continue
 
             # ---- Host: introduce two peers (A <-> B) ----
@@ -179,6 +1586,8 @@ async def handler(ws, path):
             # ---- Directed signaling relay ----
             if msg.get("type") == "signal" and "to" in msg:
                 target = msg["to"]
+                if coalescer is not None:
+                    coalescer.flush(target)
                 # enforce 'from' sender name
                 msg["from"] = sender_name
                 await send_to_user(room, target, msg)
@@ -195,6 +1604,7 @@ async def handler(ws, path):
                     "type": "chat",
                     "from": sender_name,
                     "text": txt,
+                    "ts": int(time.time() * 1000),
                 }
 
                 if target and target != "*":
@@ -206,8 +1616,10 @@ async def handler(ws, path):
                         {**payload, "private": True, "to": target},
                     )
                 else:
-                    # room-wide message
-                    await broadcast(room, payload)
+                    # room-wide message, kept for late joiners
+                    frame = dumps(payload)
+                    remember_chat(room, frame)
+                    broadcast_frame(room, frame)
                 continue
 
 
@@ -218,46 +1630,57 @@ async def handler(ws, path):
         pass
     finally:
         # Cleanup on disconnect
-        user_left = room["clients"].pop(ws, None)
-        print(f"[INFO] {user_left} left {room_id}")
-
-        # Notify others
-        await broadcast(room, {"type": "peer_left", "user": user_left})
-
-        # If host left, promote deterministically (alphabetical)
-        if user_left and room.get("host") == user_left:
-            remaining = usernames_in_room(room)
-            new_host = min(remaining) if remaining else None
-            room["host"] = new_host
-            await broadcast(room, {"type": "host_changed", "host": new_host})
-
-        if not room["clients"]:
-            rooms.pop(room_id, None)
+        if alive is not None:
+            liveness.discard(alive)
+        if coalescer is not None:
+            coalescer.flush_all()
+        if can_park(room, ws, user):
+            park(room_id, room, ws, user)
+            log.info("peer parked", room=room_id, user=user, close_code=ws.close_code,
+                     grace=RESUME_GRACE, rate_dropped=dict(dropped) or None)
+        else:
+            user_left = await release(room_id, room, ws)
+            log.info("peer left", room=room_id, user=user_left, rate_dropped=dict(dropped) or None)
 
 
 # ----------------- entrypoint -----------------
-async def main():
+# websockets options shared by main() and the shard workers (signaling_shards.py)
+SERVE_OPTS = dict(
+    ping_interval=None if LIVENESS == "wheel" else 20,  # the wheel pings silent sockets itself
+    ping_timeout=20,
+    max_size=2**20,
+    max_queue=64,
+    process_request=process_request,  # /healthz, /metrics
+)
+
+async def main(host="0.0.0.0", port=8000, certfile="crt/server.crt", keyfile="crt/server.key"):
     # TLS context
     ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    ssl_ctx.load_cert_chain("crt/server.crt", "crt/server.key")
-
-    print("🔒 Secure WebSocket signaling server on wss://0.0.0.0:8000")
-
-    async with websockets.serve(
-        handler,
-        "0.0.0.0",
-        8000,
-        ssl=ssl_ctx,
-        ping_interval=20,
-        ping_timeout=20,
-        max_size=2**20,
-        max_queue=64
-    ):
+    ssl_ctx.load_cert_chain(certfile, keyfile)
+
+    await setup_bus()
+    start_monitor()
+    log.info("secure websocket signaling server", url=f"wss://{host}:{port}",
+             pubsub=type(bus).__name__, node=bus.node, join_tokens=join_verifier is not None)
+    if join_verifier is None:
+        log.warning("SECRET_KEY not set: room and user of joins are not verified")
+
+    async with websockets.serve(handler, host, port, ssl=ssl_ctx, reuse_port=REUSE_PORT, **SERVE_OPTS) as server:
+        drained = asyncio.Event()
+
+        async def drain_and_stop():
+            await drain(server)
+            drained.set()
+
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: spawn(drain_and_stop()))
+        except NotImplementedError:
+            pass  # no signal handlers on this platform; SIGTERM just stops the process
         try:
-            await asyncio.Future()  # run forever
+            await drained.wait()  # run until drained
         except asyncio.CancelledError:
             # Normal shutdown (Ctrl+C / loop stop)
-            print("[INFO] Signaling server is shutting down...")
+            log.info("signaling server is shutting down")
             # let the context manager exit cleanly
             raise
 
@@ -267,5 +1690,5 @@ if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n[INFO] Signaling server stopped by user (Ctrl+C)")
+        log.info("signaling server stopped by user (Ctrl+C)")
 
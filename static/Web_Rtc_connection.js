@@ -1,41 +1,47 @@
-// ---------- Crypto: DH + AES (per-peer) ----------
-const PRIME = (2n ** 2048n) - 159n;
-const GENERATOR = 2n;
-
-function modPow(base, exponent, modulus) {
-  if (modulus === 1n) return 0n;
-  let result = 1n;
-  base %= modulus;
-  while (exponent > 0n) {
-    if (exponent & 1n) result = (result * base) % modulus;
-    exponent >>= 1n;
-    base = (base * base) % modulus;
-  }
-  return result;
-}
-function sha256(s) { return crypto.subtle.digest("SHA-256", new TextEncoder().encode(s)); }
-async function deriveKey(sharedSecretBigInt) {
-  const digest = await sha256(sharedSecretBigInt.toString());
-  const keyBytes = new Uint8Array(digest).slice(0, 16); // AES-128
-  return crypto.subtle.importKey("raw", keyBytes, { name: "AES-CBC" }, false, ["encrypt","decrypt"]);
-}
-async function aesEncrypt(key, text) {
-  const iv = crypto.getRandomValues(new Uint8Array(16));
-  const data = new TextEncoder().encode(text);
-  const padLen = 16 - (data.length % 16);
-  const padded = new Uint8Array([...data, ...new Array(padLen).fill(padLen)]);
-  const ct = await crypto.subtle.encrypt({ name:"AES-CBC", iv }, key, padded);
-  const combined = new Uint8Array([...iv, ...new Uint8Array(ct)]);
-  return btoa(String.fromCharCode(...combined));
-}
-async function aesDecrypt(key, b64) {
-  const bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
-  const iv = bytes.slice(0, 16);
-  const ct = bytes.slice(16);
-  const pt = await crypto.subtle.decrypt({ name:"AES-CBC", iv }, key, ct);
-  const u8 = new Uint8Array(pt);
-  const pad = u8[u8.length - 1];
-  return new TextDecoder().decode(u8.slice(0, u8.length - pad));
+// ---------- Crypto: ECDH + AES-GCM (per-peer) ----------
+/*
+  Version 2 of the secure signaling handshake. Each side sends
+  {type:"ecdh_public", v:2, value:<raw P-256 point, base64>}; both derive an
+  AES-256-GCM key with HKDF-SHA-256 over the ECDH secret, bound to the two
+  user names. Every encrypted signal carries the sender->receiver pair as
+  additional data, so a payload cannot be replayed in the other direction.
+
+  Version 1 (BigInt 2048-bit DH + AES-CBC) is gone: a peer that sends
+  dh_public, or a different v, gets {type:"secure_unsupported", v} and the
+  pair is dropped instead of failing at decrypt.
+*/
+const SECURE_PROTO = 2;
+const ECDH = { name: "ECDH", namedCurve: "P-256" };
+const te = new TextEncoder();
+
+const b64encode = (buf) => btoa(String.fromCharCode(...new Uint8Array(buf)));
+const b64decode = (b64) => Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+
+// -> { keyPair, pub (base64 raw point) }
+async function ecdhKeyPair() {
+  const keyPair = await crypto.subtle.generateKey(ECDH, false, ["deriveBits"]);
+  return { keyPair, pub: b64encode(await crypto.subtle.exportKey("raw", keyPair.publicKey)) };
+}
+async function deriveKey(keyPair, peerPubB64, me, peer) {
+  const peerPub = await crypto.subtle.importKey("raw", b64decode(peerPubB64), ECDH, false, []);
+  const secret = await crypto.subtle.deriveBits({ name: "ECDH", public: peerPub }, keyPair.privateKey, 256);
+  const ikm = await crypto.subtle.importKey("raw", secret, "HKDF", false, ["deriveKey"]);
+  const info = te.encode(`webrtc-signal v${SECURE_PROTO} ${[me, peer].sort().join(" ")}`);
+  return crypto.subtle.deriveKey({ name: "HKDF", hash: "SHA-256", salt: new Uint8Array(32), info },
+                                 ikm, { name: "AES-GCM", length: 256 }, false, ["encrypt", "decrypt"]);
+}
+async function aesEncrypt(key, text, aad) {
+  const iv = crypto.getRandomValues(new Uint8Array(12));
+  const ct = await crypto.subtle.encrypt({ name: "AES-GCM", iv, additionalData: te.encode(aad) }, key, te.encode(text));
+  const combined = new Uint8Array(12 + ct.byteLength);
+  combined.set(iv); combined.set(new Uint8Array(ct), 12);
+  return b64encode(combined);
+}
+async function aesDecrypt(key, b64, aad) {
+  const bytes = b64decode(b64);
+  const pt = await crypto.subtle.decrypt({ name: "AES-GCM", iv: bytes.slice(0, 12), additionalData: te.encode(aad) },
+                                         key, bytes.slice(12));
+  return new TextDecoder().decode(pt);
 }
 
 // ---------- DOM ----------
@@ -137,6 +143,13 @@ function attachAudioAnalyzer(peer, stream) {
   }
 }
 
+function detachAudioAnalyzer(peer) {
+  try { audioContexts[peer]?.close(); } catch {}
+  delete audioContexts[peer];
+  delete audioAnalysers[peer];
+  delete audioVolumes[peer];
+}
+
 // ----------- DEVICE ENUMERATION -----------
 async function refreshDeviceLists() {
   if (!navigator.mediaDevices || !navigator.mediaDevices.enumerateDevices) {
@@ -256,6 +269,30 @@ function getRemoteVideoEl(peer) {
   return el;
 }
 
+function getRemoteScreenEl(peer) {
+  let el = document.getElementById(`screen-${peer}`);
+  if (!el) {
+    el = document.createElement("video");
+    el.id = `screen-${peer}`;
+    el.autoplay = true;
+    el.playsInline = true;
+    el.style.width = "640px";
+    el.style.maxWidth = "100%";
+    el.style.background = "#000";
+    el.style.border = "2px solid #0af";
+    el.style.borderRadius = "10px";
+
+    const box = document.createElement("div");
+    const pill = document.createElement("div");
+    pill.textContent = `${peer} (screen)`;
+    pill.className = "pill";
+    box.appendChild(pill);
+    box.appendChild(el);
+    (screensWrap || remotesWrap || document.body).appendChild(box);
+  }
+  return el;
+}
+
 
 // ---------- WebSocket (STAR) ----------
 /*
@@ -265,8 +302,46 @@ function getRemoteVideoEl(peer) {
   - Relay signaling: messages with {to, from, type:'signal', data:{...}} (opaque)
   - Relay host controls: {type:'host_mute', to:'*' | username}, {type:'host_kick', to:username}
 */
-const socket = new WebSocket(`wss://${location.hostname}:8000?room=${encodeURIComponent(roomId)}&user=${encodeURIComponent(username)}`);
+// combined.py serves the page and the websocket on one port; otherwise signaling.py listens on :8000
+const SIGNAL_BASE = window.signalSameOrigin ? `wss://${location.host}/` : `wss://${location.hostname}:8000`;
+const SIGNAL_URL = `${SIGNAL_BASE}?room=${encodeURIComponent(roomId)}&user=${encodeURIComponent(username)}`;
+let socket = null;
+let resumeToken = null;    // from {type:"session"}; lets a dropped socket take its slot back
+let resumeGraceMs = 0;
+let resumeDeadline = 0;    // set by the first drop; the server frees our slot after that
+let resumeDelay = 250;
+let resumeFailures = 0;    // resume attempts in a row that never opened
+const RESUME_MAX_FAILURES = 3;
+let leaving = false;       // hangup / kicked / replaced: do not reconnect
+let drainRetryMs = null;   // server_draining: rejoin (fresh session) after this long
+
+let joinToken = window.signalToken || "";  // signed by app.py; single use, refetched for a fresh rejoin
+
+async function freshJoinToken() {
+  try {
+    const r = await fetch(`/api/signal-token?room=${encodeURIComponent(roomId)}`, { credentials: "include" });
+    if (r.ok) return (await r.json()).token || "";
+  } catch (e) { console.warn("[WS] join token fetch failed:", e); }
+  return "";
+}
+
+async function connectSignaling(resume) {
+  let url = SIGNAL_URL;
+  if (resume) {
+    url += `&resume=${encodeURIComponent(resumeToken)}`;
+  } else {
+    const token = joinToken || await freshJoinToken();
+    joinToken = "";
+    if (token) url += `&token=${encodeURIComponent(token)}`;
+  }
+  socket = new WebSocket(url);
+  socket.onopen = onSocketOpen;
+  socket.onmessage = onSocketMessage;
+  socket.onclose = onSocketClose;
+}
+
 const sendPlain = (obj) => socket.send(JSON.stringify({ ...obj, from: username }));
+connectSignaling(false);
 
 // ---------- ICE/STUN/TURN ----------
 
@@ -293,6 +368,9 @@ let filteredStream = null;
 let filteredVideoTrack = null;
 let filterStopFn = null;
 
+let screenStream = null, screenTrack = null;
+const screenSenders = {};  // user -> mesh senders carrying our screen
+
 (async function initLocalMedia() {
   const autoCam = !!(window.prefs && window.prefs.autoCam);
   const autoMic = !!(window.prefs && window.prefs.autoMic);
@@ -360,7 +438,9 @@ let filterStopFn = null;
 
       const engine = await window.FilterEngine.createBgStream({
         inputStream: localStream,
-        modelUrl: "/static/tfjs_unet/model.json",
+        modelUrl: window.assets?.model || "/static/tfjs_unet/model.json",
+        weightUrls: window.assets?.weights || null,
+        tfjsUrl: window.assets?.tfjs,
         fps: 20,
         workW: 640,
         workH: 480,
@@ -376,13 +456,15 @@ let filterStopFn = null;
       filteredVideoTrack = filteredStream.getVideoTracks()[0] || null;
       filterStopFn = engine.stop || null;
 
-      for (const u in peers) {
-        const s = peers[u].pc.getSenders().find(x => x.track?.kind === "video");
+      for (const pc of allPCs()) {
+        const s = pc.getSenders().find(x => x.track?.kind === "video");
         if (s && filteredVideoTrack) {
           try { await s.replaceTrack(filteredVideoTrack); } catch(e) {}
         }
       }
 
+      await applyMediaPolicy();
+
       // local preview
       if (localVideo) {
         localVideo.srcObject = filteredStream;
@@ -411,7 +493,7 @@ function getCurrentVideoTrack() {
 /*
   peers[user] = {
     pc,
-    dhPrivate, dhPublic, sharedKey,
+    keys (Promise of ecdhKeyPair()), sharedKey,
     sendQueue: [],
     incomingCandidates: [],
     readyFromPeer: false,
@@ -421,6 +503,9 @@ function getCurrentVideoTrack() {
 */
 const peers = {};
 const participants = new Set([username]);
+let rosterVersion = null;  // last roster version applied (server "v")
+let serverIntros = false;  // server paces introductions (peer_list intros:"server")
+let lastChatTs = 0;        // newest chat timestamp shown (dedups chat_history)
 
 function ensurePeer(user) {
   if (user === username) return null;
@@ -528,26 +613,7 @@ function ensurePeer(user) {
 
       } else {
         // -------- SCREEN SHARE VIDEO --------
-        let el = document.getElementById(`screen-${user}`);
-        if (!el) {
-          el = document.createElement("video");
-          el.id = `screen-${user}`;
-          el.autoplay = true;
-          el.playsInline = true;
-          el.style.width = "640px";
-          el.style.maxWidth = "100%";
-          el.style.background = "#000";
-          el.style.border = "2px solid #0af";
-          el.style.borderRadius = "10px";
-
-          const box = document.createElement("div");
-          const pill = document.createElement("div");
-          pill.textContent = `${user} (screen)`;
-          pill.className = "pill";
-          box.appendChild(pill);
-          box.appendChild(el);
-          (screensWrap || remotesWrap || document.body).appendChild(box);
-        }
+        const el = getRemoteScreenEl(user);
 
         if (stream) {
           if (el.srcObject !== stream) {
@@ -610,8 +676,7 @@ function ensurePeer(user) {
 
   peers[user] = {
     pc,
-    dhPrivate: null,
-    dhPublic: null,
+    keys: null,
     sharedKey: null,
     sendQueue: [],
     incomingCandidates: [],
@@ -686,8 +751,11 @@ async function flushSendQueue(user) {
 async function sendSecure(user, obj) {
   const p = peers[user];
   if (!p || !p.sharedKey) { if (p) p.sendQueue.push(obj); return; }
-  const enc = await aesEncrypt(p.sharedKey, JSON.stringify(obj));
-  socket.send(JSON.stringify({ type: "signal", to: user, from: username, data: { type: "encrypted", b64: enc } }));
+  const enc = await aesEncrypt(p.sharedKey, JSON.stringify(obj), `${username}>${user}`);
+  const data = { type: "encrypted", b64: enc };
+  // plaintext hint (must stay the last key): lets the server batch trickled candidates
+  if (obj.type === "candidate") data.ice = 1;
+  socket.send(JSON.stringify({ type: "signal", to: user, from: username, data }));
 }
 
 function sendPlainSignal(user, payload) {
@@ -702,25 +770,35 @@ async function handleSignalFrom(user, payload) {
   if (payload.type === "encrypted") {
     if (!p.sharedKey) { console.warn(`[SEC] Encrypted before key from ${user}`); return; }
     let data;
-    try { data = JSON.parse(await aesDecrypt(p.sharedKey, payload.b64)); }
+    try { data = JSON.parse(await aesDecrypt(p.sharedKey, payload.b64, `${user}>${username}`)); }
     catch (e) { console.error("[SEC] Decrypt failed:", e); return; }
     await handleDecrypted(user, data);
     return;
   }
 
-  // Unencrypted control (DH, READY)
-  if (payload.type === "dh_public") {
-    if (!p.dhPrivate) {
-      const privBytes = crypto.getRandomValues(new Uint8Array(32));
-      p.dhPrivate = BigInt("0x" + Array.from(privBytes).map(b => b.toString(16).padStart(2,"0")).join(""));
-      p.dhPublic  = modPow(GENERATOR, p.dhPrivate, PRIME);
+  // Unencrypted control (key exchange, READY)
+  if (payload.type === "dh_public" || (payload.type === "ecdh_public" && payload.v !== SECURE_PROTO)) {
+    rejectPeerProtocol(user, payload.v || 1);
+    return;
+  }
+  if (payload.type === "secure_unsupported") {
+    console.warn(`[SEC] ${user} does not speak secure signaling v${SECURE_PROTO} (has v${payload.v})`);
+    dropPeerPair(user);
+    return;
+  }
+
+  if (payload.type === "ecdh_public") {
+    if (!p.keys) p.keys = ecdhKeyPair();
+    const { keyPair, pub } = await p.keys;
+    try {
+      p.sharedKey = await deriveKey(keyPair, payload.value, username, user);
+    } catch (e) {
+      console.error(`[SEC] Bad public key from ${user}:`, e);
+      return;
     }
-    const peerPub = BigInt(payload.value);
-    const sharedSecret = modPow(peerPub, p.dhPrivate, PRIME);
-    p.sharedKey = await deriveKey(sharedSecret);
     // respond with our pub if we haven't sent one yet
     if (!payload.seen_us) {
-      sendPlainSignal(user, { type: "dh_public", value: p.dhPublic.toString(), seen_us: true });
+      sendPlainSignal(user, { type: "ecdh_public", v: SECURE_PROTO, value: pub, seen_us: true });
     }
     // announce ready
     sendPlainSignal(user, { type: "ready" });
@@ -817,18 +895,21 @@ async function flushIncomingCandidates(user) {
 
 function closePeer(user) {
   const p = peers[user];
-  if (!p) return;
-  try { p.pc.getSenders().forEach(s => { try { p.pc.removeTrack(s); } catch(e){} }); } catch(e){}
-  try { p.pc.close(); } catch(e){}
+  if (p) {
+    try { p.pc.getSenders().forEach(s => { try { p.pc.removeTrack(s); } catch(e){} }); } catch(e){}
+    try { p.pc.close(); } catch(e){}
+    delete peers[user];
+  }
 
-  // Remove camera video box
-  if (p.videoEl && p.videoEl.parentElement) p.videoEl.parentElement.remove();
+  // Remove camera video box (SFU mode has tiles without a peer entry)
+  const videoEl = document.getElementById(`video-${user}`);
+  if (videoEl && videoEl.parentElement) videoEl.parentElement.remove();
 
   // Remove screen video box
   const screenEl = document.getElementById(`screen-${user}`);
   if (screenEl && screenEl.parentElement) screenEl.parentElement.remove();
 
-  delete peers[user];
+  detachAudioAnalyzer(user);
   participants.delete(user);
   screenSenders[user] = [];   // clear per-peer screen senders
   refreshKickList();
@@ -837,6 +918,281 @@ function closePeer(user) {
   updateRemoteLayout();
 }
 
+// ---------- Selective forwarding (big rooms, see sfu.py) ----------
+/*
+  From SIGNAL_SFU_AT peers on, the server switches the room to "sfu": we drop
+  the mesh and keep a single RTCPeerConnection to the server, which sends our
+  camera on to everyone. The server makes every offer; its `slots` say what
+  each m-line carries (mid -> {kind, up} | {kind, user, source} | {kind}).
+*/
+let mediaMode = "mesh";
+let sfu = null;  // { pc, bound: {mid: {user, source, track}}, screenMid } while mediaMode is "sfu"
+
+function sendSfu(data) {
+  sendPlain({ type: "sfu", data });
+}
+
+function allPCs() {
+  const list = Object.values(peers).map(p => p.pc);
+  if (sfu) list.push(sfu.pc);
+  return list;
+}
+
+// Mesh -> SFU: close the pair connection but keep the tile for the SFU's tracks
+function dropMeshPeer(user) {
+  const p = peers[user];
+  if (!p) return;
+  try { p.pc.close(); } catch {}
+  delete peers[user];
+  screenSenders[user] = [];
+  if (p.videoEl) p.videoEl.srcObject = null;
+  const screenEl = document.getElementById(`screen-${user}`);
+  if (screenEl && screenEl.parentElement) screenEl.parentElement.remove();
+  detachAudioAnalyzer(user);
+}
+
+function applyMediaMode(mode) {
+  mediaMode = mode === "sfu" ? "sfu" : "mesh";
+  showMediaMode();
+  if (mediaMode === "sfu") {
+    for (const u of Object.keys(peers)) dropMeshPeer(u);
+    if (!sfu) sfuJoin();
+  } else if (sfu) {
+    sfuLeave();
+  }
+}
+
+// The SFU terminates DTLS-SRTP: media is decrypted on the server. Say so.
+function showMediaMode() {
+  const pill = document.getElementById("mediaModePill");
+  if (!pill) return;
+  if (mediaMode === "sfu") {
+    pill.textContent = "🖥️ Via server";
+    pill.title = "This room is large: audio and video are relayed (and decrypted) by the server, not end to end";
+  } else {
+    pill.textContent = "🔒 End-to-end";
+    pill.title = "Calls are encrypted end to end between browsers";
+  }
+}
+
+function sfuJoin() {
+  if (sfu) sfuLeave();
+  const pc = new RTCPeerConnection({ iceServers: ICE_SERVERS || [], bundlePolicy: "max-bundle" });
+  sfu = { pc, bound: {}, screenMid: null };
+  pc.onicecandidate = (e) => {
+    if (e.candidate) sendSfu({ type: "candidate", candidate: e.candidate });
+  };
+  pc.onconnectionstatechange = () => {
+    console.log(`[SFU] connectionState = ${pc.connectionState}`);
+  };
+  sendSfu({ type: "join" });
+  if (screenTrack) sendSfu({ type: "screen", on: true });
+  console.log("[SFU] joining");
+}
+
+function sfuLeave() {
+  if (!sfu) return;
+  for (const mid in sfu.bound) unbindSfuSlot(mid);
+  try { sfu.pc.close(); } catch {}
+  sfu = null;
+}
+
+function unbindSfuSlot(mid) {
+  const b = sfu.bound[mid];
+  if (!b) return;
+  delete sfu.bound[mid];
+  const el = document.getElementById(`${b.source === "screen" ? "screen" : "video"}-${b.user}`);
+  if (!el) return;
+  if (b.source === "screen") {
+    if (el.parentElement) el.parentElement.remove();
+  } else if (el.srcObject) {
+    el.srcObject.removeTrack(b.track);
+    if (b.track.kind === "audio") detachAudioAnalyzer(b.user);
+  }
+}
+
+async function bindSfuSlot(mid, slot, track) {
+  const b = sfu.bound[mid];
+  if (b && b.user === slot.user && b.source === slot.source) return;
+  unbindSfuSlot(mid);
+  if (!participants.has(slot.user)) return;  // left meanwhile; the next offer drops the slot
+  sfu.bound[mid] = { user: slot.user, source: slot.source, track };
+  const el = slot.source === "screen" ? getRemoteScreenEl(slot.user) : getRemoteVideoEl(slot.user);
+  if (!el.srcObject) el.srcObject = new MediaStream();
+  el.srcObject.getTracks().filter(t => t.kind === track.kind).forEach(t => el.srcObject.removeTrack(t));
+  el.srcObject.addTrack(track);
+  if (track.kind === "audio") attachAudioAnalyzer(slot.user, el.srcObject);
+  try { await el.play(); } catch {}
+  console.log(`[SFU] ${slot.user} ${slot.source} ${track.kind} bound to mid ${mid}`);
+}
+
+function upTrack(slot) {
+  if (slot.kind === "audio") return localStream.getAudioTracks()[0] || null;
+  if (slot.up === "screen") return screenTrack;
+  return getCurrentVideoTrack();
+}
+
+// Screen sharing rides the "screen" up slot; the server forwards it while we say it is on
+function setSfuScreen(track) {
+  if (!sfu) return;
+  const t = sfu.pc.getTransceivers().find(x => x.mid !== null && x.mid === sfu.screenMid);
+  if (t) t.sender.replaceTrack(track).catch(e => console.warn("[SFU] replaceTrack failed:", e));
+  sendSfu({ type: "screen", on: !!track });
+}
+
+async function handleSfuMessage(data) {
+  if (!sfu || !data) return;
+  if (data.type === "closed") {
+    // the server dropped our connection (failed / timed out): start over
+    console.warn("[SFU] connection closed by server:", data.reason);
+    if (mediaMode === "sfu") sfuJoin();
+    return;
+  }
+  if (data.type !== "offer") return;
+  const { pc } = sfu;
+  await waitLocalMedia();
+  try {
+    await pc.setRemoteDescription({ type: "offer", sdp: data.sdp });
+  } catch (e) {
+    console.warn("[SFU] setRemoteDescription(offer) failed:", e);
+    return;
+  }
+  if (sfu?.pc !== pc) return;  // left or rejoined meanwhile
+  const slots = data.slots || {};
+  for (const t of pc.getTransceivers()) {
+    const slot = slots[t.mid];
+    if (!slot) continue;
+    if (slot.up) {
+      if (slot.up === "screen") sfu.screenMid = t.mid;
+      t.direction = "sendonly";
+      try { await t.sender.replaceTrack(upTrack(slot)); } catch (e) { console.warn("[SFU] replaceTrack failed:", e); }
+    } else if (slot.user) {
+      t.direction = "recvonly";
+      await bindSfuSlot(t.mid, slot, t.receiver.track);
+    } else {
+      t.direction = "inactive";
+      unbindSfuSlot(t.mid);
+    }
+  }
+  await pc.setLocalDescription(await pc.createAnswer());
+  sendSfu({ type: "answer", sdp: pc.localDescription.sdp });
+  updateRemoteLayout();
+  applyMediaPolicy();
+}
+
+// ---------- Media policy (per outgoing camera stream, from the server) ----------
+/*
+  {type:"media_policy", max_kbps, height, fps, streams}: the server splits our
+  uplink over the copies of the camera we send (n-1 in the mesh, 1 via the
+  SFU). We report the uplink only while the browser's bandwidth estimate is
+  what limits our video.
+*/
+const UPLINK_REPORT_MS = 5000;
+let mediaPolicy = null;
+let uplinkReported = null;  // last kbps sent; null: not limited (the server assumes a default)
+
+async function applyMediaPolicy() {
+  if (!mediaPolicy) return;
+  for (const pc of allPCs()) {
+    for (const s of pc.getSenders()) {
+      if (s.track?.kind !== "video" || s.track === screenTrack) continue;
+      const params = s.getParameters();
+      if (!params.encodings || !params.encodings.length) continue;  // not negotiated yet
+      const h = s.track.getSettings().height || mediaPolicy.height;
+      for (const enc of params.encodings) {
+        enc.maxBitrate = mediaPolicy.max_kbps * 1000;
+        enc.maxFramerate = mediaPolicy.fps;
+        enc.scaleResolutionDownBy = Math.max(1, h / mediaPolicy.height);
+      }
+      try { await s.setParameters(params); } catch (e) { console.warn("[POLICY] setParameters failed:", e); }
+    }
+  }
+}
+
+async function reportUplink() {
+  if (!socket || socket.readyState !== WebSocket.OPEN) return;
+  let bps = 0, limited = false;
+  for (const pc of allPCs()) {
+    let stats;
+    try { stats = await pc.getStats(); } catch { continue; }
+    stats.forEach(r => {
+      if (r.type === "candidate-pair" && r.nominated && r.state === "succeeded") bps += r.availableOutgoingBitrate || 0;
+      if (r.type === "outbound-rtp" && r.kind === "video" && r.qualityLimitationReason === "bandwidth") limited = true;
+    });
+  }
+  const kbps = limited && bps ? Math.round(bps / 1000) : null;
+  if (kbps === null ? uplinkReported === null
+                    : uplinkReported !== null && Math.abs(kbps - uplinkReported) < uplinkReported * 0.2) return;
+  uplinkReported = kbps;
+  sendPlain({ type: "uplink", kbps });
+}
+
+setInterval(() => { reportUplink().catch(() => {}); }, UPLINK_REPORT_MS);
+
+// ---------- Call quality telemetry ----------
+/*
+  Every TELEMETRY_SAMPLE_MS each connection's getStats() becomes one compact
+  sample {t, peer, rtt, jitter, lost, recv, fps, out_kbps, in_kbps} (deltas
+  since the previous sample); batches go to POST /api/telemetry every
+  TELEMETRY_POST_MS and on pagehide. Nothing is retried: a lost batch is
+  just a gap in the graphs.
+*/
+const TELEMETRY_SAMPLE_MS = 5000;
+const TELEMETRY_POST_MS = 30000;
+const TELEMETRY_MAX_SAMPLES = 200;  // telemetry.MAX_SAMPLES
+let telemetrySamples = [];
+const telemetryPrev = new WeakMap();  // pc -> {t, lost, recv, sent, got}
+
+async function sampleConnection(peer, pc) {
+  let stats;
+  try { stats = await pc.getStats(); } catch { return; }
+  let rtt = null, jitter = null, fps = null, lost = 0, recv = 0, sent = 0, got = 0;
+  stats.forEach(r => {
+    if (r.type === "candidate-pair" && r.nominated && r.state === "succeeded" && r.currentRoundTripTime != null) {
+      rtt = r.currentRoundTripTime * 1000;
+    } else if (r.type === "inbound-rtp") {
+      lost += r.packetsLost || 0;
+      recv += r.packetsReceived || 0;
+      got += r.bytesReceived || 0;
+      if (r.jitter != null) jitter = Math.max(jitter ?? 0, r.jitter * 1000);
+      if (r.kind === "video" && r.framesPerSecond != null) fps = Math.max(fps ?? 0, r.framesPerSecond);
+    } else if (r.type === "outbound-rtp") {
+      sent += r.bytesSent || 0;
+    }
+  });
+  const now = Date.now(), prev = telemetryPrev.get(pc);
+  telemetryPrev.set(pc, { t: now, lost, recv, sent, got });
+  if (!prev) return;  // first look: no deltas yet
+  const secs = (now - prev.t) / 1000, kbps = b => Math.max(0, Math.round(b * 8 / 1000 / secs));
+  telemetrySamples.push({
+    t: Math.round(now / 1000), peer, rtt, jitter, fps,
+    lost: Math.max(0, lost - prev.lost), recv: Math.max(0, recv - prev.recv),
+    out_kbps: kbps(sent - prev.sent), in_kbps: kbps(got - prev.got),
+  });
+  if (telemetrySamples.length > TELEMETRY_MAX_SAMPLES) telemetrySamples.shift();
+}
+
+async function sampleTelemetry() {
+  const conns = Object.entries(peers).map(([user, p]) => [user, p.pc]);
+  if (sfu) conns.push(["sfu", sfu.pc]);
+  for (const [peer, pc] of conns) {
+    if (pc.connectionState === "connected") await sampleConnection(peer, pc);
+  }
+}
+
+function postTelemetry(beacon = false) {
+  if (!telemetrySamples.length || !roomId) return;
+  const body = JSON.stringify({ room: roomId, samples: telemetrySamples });
+  telemetrySamples = [];
+  if (beacon && navigator.sendBeacon) { navigator.sendBeacon("/api/telemetry", body); return; }
+  fetch("/api/telemetry", { method: "POST", body, credentials: "include",
+                            headers: { "Content-Type": "application/json" } }).catch(() => {});
+}
+
+setInterval(() => { sampleTelemetry().catch(() => {}); }, TELEMETRY_SAMPLE_MS);
+setInterval(() => postTelemetry(), TELEMETRY_POST_MS);
+window.addEventListener("pagehide", () => postTelemetry(true));
+
 
 function setHostButtonsEnabled(enabled) {
   ["hostMuteAll","hostKick","copyLink","copyRoom","copyKey"].forEach(id => {
@@ -924,27 +1280,87 @@ function refreshKickList() {
 // ---------- Host-introduced handshakes ----------
 function startPeerHandshake(otherUser) {
   const p = ensurePeer(otherUser);
-  // Generate our DH keypair once
-  if (!p.dhPrivate) {
-    const privBytes = crypto.getRandomValues(new Uint8Array(32));
-    p.dhPrivate = BigInt("0x" + Array.from(privBytes).map(b => b.toString(16).padStart(2,"0")).join(""));
-    p.dhPublic  = modPow(GENERATOR, p.dhPrivate, PRIME);
-  }
-  // Start DH by sending our public
-  sendPlainSignal(otherUser, { type: "dh_public", value: p.dhPublic.toString() });
+  // Generate our key pair once, then start the exchange by sending our public
+  if (!p.keys) p.keys = ecdhKeyPair();
+  p.keys.then(({ pub }) => {
+    if (peers[otherUser] !== p) return;  // closed meanwhile
+    sendPlainSignal(otherUser, { type: "ecdh_public", v: SECURE_PROTO, value: pub });
+  });
+}
+
+// A peer on another handshake version: tell it once, drop the pair and let
+// the intro scheduler move on.
+function rejectPeerProtocol(user, v) {
+  console.warn(`[SEC] ${user} uses secure signaling v${v}, need v${SECURE_PROTO}: not connecting`);
+  sendPlainSignal(user, { type: "secure_unsupported", v: SECURE_PROTO });
+  dropPeerPair(user);
+}
+
+function dropPeerPair(user) {
+  closePeer(user);
+  participants.add(user);  // still in the room (host can kick), just no media with us
+  refreshKickList();
+  try { sendPlain({ type: "intro_ack", peer: user, ok: false }); } catch {}
 }
 
 // ---------- WebSocket lifecycle ----------
-socket.onopen = async () => {
+async function onSocketOpen() {
   console.log("[WS] open");
+  resumeFailures = 0;
   await initIceServers();
   sendPlain({ type: "hello" });
-};
+}
+
+// Network blip: reconnect with the resume token while the server holds our
+// slot, so peers see no leave/join and WebRTC sessions stay up.
+function onSocketClose(ev) {
+  console.log("[WS] closed", ev.code);
+  if (ev.target !== socket) return;  // a socket a resume already replaced (closed with 4000)
+  if (leaving) return;
+  if (drainRetryMs !== null) {
+    // server restart: rejoin after the delay it picked for us (back off if the
+    // successor is not up yet); peer connections stay up meanwhile
+    setTimeout(() => connectSignaling(false), drainRetryMs);
+    drainRetryMs = Math.min(Math.max(drainRetryMs, 250) * 2, 8000);
+    return;
+  }
+  if (ev.code === 1000) return;
+  if (!resumeToken) {
+    // no slot to take back (the server runs without resumption, or a fresh
+    // join did not get through): keep trying fresh joins
+    setTimeout(() => connectSignaling(false), resumeDelay);
+    resumeDelay = Math.min(resumeDelay * 2, 4000);
+    return;
+  }
+  if (!resumeDeadline) resumeDeadline = Date.now() + resumeGraceMs;
+  // A refused resume handshake shows up as 1006 (the browser never sees the
+  // 403); 1008 is a slot that went away after the handshake. Either way, or
+  // once the grace is over, the slot is gone: rejoin as a fresh session.
+  if (ev.code === 1008 || resumeFailures >= RESUME_MAX_FAILURES || Date.now() > resumeDeadline) {
+    console.warn("[WS] could not resume; rejoining as a new session");
+    resumeToken = null;
+    resumeDeadline = 0;
+    resumeFailures = 0;
+    setTimeout(() => connectSignaling(false), resumeDelay);
+    return;
+  }
+  resumeFailures += 1;  // reset by onSocketOpen if this attempt gets through
+  setTimeout(() => connectSignaling(true), resumeDelay);
+  resumeDelay = Math.min(resumeDelay * 2, 4000);
+}
 
 
 function watchPC(user, pc) {
+  let acked = false;
   pc.onconnectionstatechange = () => {
     console.log(`[RTC] ${user} connectionState = ${pc.connectionState}`);
+    // tell the intro scheduler this pair is done, so it can release the next one
+    const state = pc.connectionState;
+    if (state === "connected") applyMediaPolicy();
+    if (!acked && (state === "connected" || state === "failed")) {
+      acked = true;
+      try { sendPlain({ type: "intro_ack", peer: user, ok: state === "connected" }); } catch {}
+    }
   };
   pc.oniceconnectionstatechange = () => {
     console.log(`[ICE] ${user} iceConnectionState = ${pc.iceConnectionState}`);
@@ -953,17 +1369,66 @@ function watchPC(user, pc) {
 
 
 
-socket.onmessage = async (ev) => {
+async function onSocketMessage(ev) {
   const msg = JSON.parse(ev.data);
+  await handleServerMessage(msg);
+}
+
+// ---- Roster versions: peer_joined/peer_left/host_changed carry v; on a gap
+// ask for what we missed and let the roster_delta replay it ----
+async function handleServerMessage(msg) {
+  if (msg.type === "session" || msg.type === "resumed") {
+    if (msg.type === "session") {
+      drainRetryMs = null;
+      resumeToken = msg.resume;
+      resumeGraceMs = (msg.grace || 0) * 1000;
+      // a fresh session has no SFU connection. The server sends this first,
+      // so the peer_list / media_mode that follow decide whether to join again
+      sfuLeave();
+      uplinkReported = null;
+    } else {
+      // back in our old slot; queued frames follow (or a fresh peer_list if some were lost)
+      console.log("[WS] session resumed", msg.lost ? "(resyncing roster)" : "");
+    }
+    resumeDeadline = 0;
+    resumeDelay = 250;
+    return;
+  }
+  if (msg.type === "session_replaced") { leaving = true; return; }
+  if (msg.type === "server_draining") {
+    drainRetryMs = msg.retry_ms || 0;
+    resumeToken = null;  // the next process does not know our slot
+    return;
+  }
+  if (msg.type === "roster_delta") {
+    rosterVersion = msg.v;
+    for (const [op, u] of msg.ops || []) {
+      if (op === "+") await handleServerMessage({ type: "peer_joined", user: u });
+      else if (op === "-") await handleServerMessage({ type: "peer_left", user: u });
+      else if (op === "h") await handleServerMessage({ type: "host_changed", host: u });
+    }
+    return;
+  }
+  if (typeof msg.v === "number") {
+    if (msg.type === "peer_list") {
+      rosterVersion = msg.v;
+    } else if (rosterVersion !== null && msg.v > rosterVersion + 1) {
+      sendPlain({ type: "roster_sync", since: rosterVersion });
+      return;
+    } else if (rosterVersion === null || msg.v > rosterVersion) {
+      rosterVersion = msg.v;
+    }
+  }
 
   // Host controls
   if (msg.type === "host_mute") {
     if (localStream) localStream.getAudioTracks().forEach(t => t.enabled = false);
-    for (const u in peers) peers[u].pc.getSenders().forEach(s => { if (s.track?.kind === "audio") s.track.enabled = false; });
+    for (const pc of allPCs()) pc.getSenders().forEach(s => { if (s.track?.kind === "audio") s.track.enabled = false; });
     isMuted = true; updateButtonsUI();
     const el = document.getElementById("banner"); if (el) el.textContent = "The host muted your microphone."; return;
   }
   if (msg.type === "host_kick" && msg.to === username) {
+    leaving = true;
     alert("You have been removed by the host."); await hangup(false); return;
   }
 
@@ -975,6 +1440,8 @@ socket.onmessage = async (ev) => {
     appendChatLine(`${u} joined the room`, { system: true });
     window.playNotify && window.playNotify();
 
+    if (serverIntros) return;  // the server will introduce us
+    if (mediaMode === "sfu") return;  // the newcomer's media comes through the server
 
     if (window.isHost) {
       // Introduce newcomer to everyone else
@@ -990,6 +1457,7 @@ socket.onmessage = async (ev) => {
   }
 
   if (msg.type === "peer_left") {
+    if (drainRetryMs !== null) return;  // others are being drained too; the rejoin's peer_list settles it
     const u = msg.user;
     participants.delete(u);
     refreshKickList();
@@ -1023,20 +1491,39 @@ socket.onmessage = async (ev) => {
     const from = msg.from || "Unknown";
     const text = msg.text || "";
     const isSelf = from === username;
+    if (msg.ts) lastChatTs = Math.max(lastChatTs, msg.ts);
     appendChatLine(text, { from, self: isSelf, system: false });
     if (!isSelf) window.playNotify && window.playNotify();
     return;
   }
 
+  // ---- Recent chat, replayed on join (skip what a reconnect already showed) ----
+  if (msg.type === "chat_history") {
+    for (const item of msg.items || []) {
+      if (!item || (item.ts && item.ts <= lastChatTs)) continue;
+      if (item.ts) lastChatTs = item.ts;
+      appendChatLine(item.text || "", { from: item.from || "Unknown", self: item.from === username, system: false });
+    }
+    return;
+  }
+
 
   if (msg.type === "peer_list") {
     const list = msg.users || [];
+    // a resync may drop people we missed leaving
+    for (const u of [...participants]) {
+      if (u !== username && !list.includes(u)) { participants.delete(u); closePeer(u); }
+    }
     list.forEach(u => { if (u !== username) participants.add(u); });
     refreshKickList();
 
     // <-- NEW: set initial host based on server’s answer
     setHostUI(msg.host === username);
 
+    serverIntros = msg.intros === "server";
+    applyMediaMode(msg.media);
+    if (serverIntros || mediaMode === "sfu") return;  // handshakes start when the server sends intros
+
     // Existing intro logic…
     if (window.isHost) {
       const others = list.filter(u => u !== username);
@@ -1052,6 +1539,28 @@ socket.onmessage = async (ev) => {
     return;
   }
 
+  if (msg.type === "media_mode") {
+    const wasSfu = mediaMode === "sfu";
+    applyMediaMode(msg.mode);
+    // back to the mesh: with server intros, the server re-introduces every pair
+    if (wasSfu && mediaMode === "mesh" && !serverIntros) {
+      for (const u of participants) if (u !== username) startPeerHandshake(u);
+    }
+    return;
+  }
+
+  if (msg.type === "sfu") {
+    await handleSfuMessage(msg.data);
+    return;
+  }
+
+  if (msg.type === "media_policy") {
+    mediaPolicy = msg;
+    console.log(`[POLICY] ${msg.max_kbps} kbps, ${msg.height}p, ${msg.fps} fps per stream (${msg.streams} streams)`);
+    await applyMediaPolicy();
+    return;
+  }
+
   if (msg.type === "host_changed") {
     const newHost = msg.host || null;
     // flip UI
@@ -1059,9 +1568,18 @@ socket.onmessage = async (ev) => {
     return;
   }
 
+  // mesh signaling from a peer that has not switched yet
+  if (mediaMode === "sfu") return;
+
   // Introductions (server should relay a 'signal' with {type:'intro', other:'name'})
   if (msg.type === "signal" && msg.data && msg.data.type === "intro" && msg.to === username) {
-    const other = msg.data.other; if (other && other !== username) startPeerHandshake(other);
+    const other = msg.data.other; if (!other || other === username) return;
+    if (peers[other]?.pc?.connectionState === "connected") {
+      // already connected (e.g. rejoined after a server restart): nothing to do
+      sendPlain({ type: "intro_ack", peer: other, ok: true });
+      return;
+    }
+    startPeerHandshake(other);
     return;
   }
 
@@ -1069,9 +1587,13 @@ socket.onmessage = async (ev) => {
   if (msg.type === "signal" && msg.to === username && msg.from) {
     await handleSignalFrom(msg.from, msg.data);
   }
-};
 
-socket.onclose = () => { console.log("[WS] closed"); };
+  // Several trickled candidates from one peer, coalesced by the server (in order)
+  if (msg.type === "signal_batch" && msg.to === username && msg.from) {
+    for (const data of msg.items || []) await handleSignalFrom(msg.from, data);
+  }
+}
+
 
 // ---------- Controls: Mute/Camera/Hangup ----------
 let isMuted = false;
@@ -1113,8 +1635,8 @@ async function switchMicrophone(deviceId) {
   if (localStream) localStream.addTrack(newTrack);
 
   // Replace in all peer senders
-  for (const u in peers) {
-    const s = peers[u].pc.getSenders().find(x => x.track && x.track.kind === "audio");
+  for (const pc of allPCs()) {
+    const s = pc.getSenders().find(x => x.track && x.track.kind === "audio");
     if (s) {
       try { await s.replaceTrack(newTrack); } catch (e) { console.warn("[DEVICES] replaceTrack mic failed:", e); }
     }
@@ -1164,13 +1686,14 @@ async function switchCamera(deviceId) {
   }
 
   // Replace in all peer senders
-  for (const u in peers) {
-    const s = peers[u].pc.getSenders().find(x => x.track && x.track.kind === "video");
+  for (const pc of allPCs()) {
+    const s = pc.getSenders().find(x => x.track && x.track.kind === "video");
     if (s) {
       try { await s.replaceTrack(newTrack); } catch (e) { console.warn("[DEVICES] replaceTrack camera failed:", e); }
     }
   }
 
+  await applyMediaPolicy();
   console.log("[DEVICES] Camera switched to", deviceId || "default");
 }
 
@@ -1208,7 +1731,7 @@ function toggleMute() {
   if (!tracks.length) return;
   const next = !tracks[0].enabled;
   tracks.forEach(t => t.enabled = next);
-  for (const u in peers) peers[u].pc.getSenders().forEach(s => { if (s.track?.kind === "audio") s.track.enabled = next; });
+  for (const pc of allPCs()) pc.getSenders().forEach(s => { if (s.track?.kind === "audio") s.track.enabled = next; });
   isMuted = !next; updateButtonsUI();
 }
 
@@ -1217,8 +1740,8 @@ async function toggleCamera() {
 
   if (!isVideoOff) {
     // OFF
-    for (const u in peers) {
-      const s = peers[u].pc.getSenders().find(x => x.track?.kind === "video");
+    for (const pc of allPCs()) {
+      const s = pc.getSenders().find(x => x.track?.kind === "video");
       if (s) await s.replaceTrack(blackTrack);
     }
     const preview = new MediaStream([blackTrack]);
@@ -1231,8 +1754,8 @@ async function toggleCamera() {
     isVideoOff = false;                     // flip first
     const onTrack = getCurrentVideoTrack(); // filtered/cam based on prefs
 
-    for (const u in peers) {
-      const s = peers[u].pc.getSenders().find(x => x.track?.kind === "video");
+    for (const pc of allPCs()) {
+      const s = pc.getSenders().find(x => x.track?.kind === "video");
       if (s) await s.replaceTrack(onTrack);
     }
 
@@ -1242,6 +1765,7 @@ async function toggleCamera() {
     }
   }
 
+  await applyMediaPolicy();
   updateButtonsUI();
 }
 
@@ -1258,6 +1782,8 @@ async function hangup(sendBye = true) {
   try { screenStream?.getTracks().forEach(t => t.stop()); } catch {}  // <--- NEW
 
   for (const u of Object.keys(peers)) closePeer(u);
+  sfuLeave();
+  leaving = true;
   try { socket.close(); } catch {}
   window.location.href = "/lobby";
 }
@@ -1287,6 +1813,7 @@ async function startScreenShare() {
       if (!screenSenders[u]) screenSenders[u] = [];
       screenSenders[u].push(sender);
     }
+    setSfuScreen(screenTrack);
 
     // If user stops via browser UI (Stop sharing button)
     screenTrack.addEventListener("ended", () => {
@@ -1328,6 +1855,7 @@ function stopScreenShare() {
 
   screenStream = null;
   screenTrack  = null;
+  setSfuScreen(null);
 
   // 👇 REMOVE MY OWN SCREEN TILE (THIS IS THE PART YOU ASKED “WHERE?”)
   const mine = document.getElementById(`screen-${username}`);
@@ -6,6 +6,8 @@
 export async function createBgStream({
   inputStream,
   modelUrl = "/static/tfjs_unet/model.json",
+  weightUrls = null,  // shard name in model.json -> URL (fingerprinted copies)
+  tfjsUrl = "/static/vendor/tf.min.js",  // vendored @tensorflow/tfjs 4.20.0 (fetch_vendor.py)
 
   // pipeline perf
   fps = 20,
@@ -29,14 +31,16 @@ export async function createBgStream({
   outFps = 25,
 } = {}) {
   if (!window.tf) {
-    await loadScript("https://cdn.jsdelivr.net/npm/@tensorflow/tfjs@4.20.0/dist/tf.min.js");
+    await loadScript(tfjsUrl);
   }
   const tf = window.tf;
 
   try { await tf.setBackend("webgl"); } catch {}
   await tf.ready();
 
-  const model = await tf.loadGraphModel(modelUrl);
+  const model = await tf.loadGraphModel(modelUrl, weightUrls
+    ? { weightUrlConverter: async (name) => weightUrls[name] || new URL(name, new URL(modelUrl, location.href)).href }
+    : undefined);
   const inputName = (model.inputs?.[0]?.name)
     ? model.inputs[0].name.split(":")[0]
     : null;
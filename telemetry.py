@@ -0,0 +1,295 @@
+# telemetry.py
+import os, time, queue, sqlite3, threading, collections
+
+import jsonlog
+
+"""
+Call-quality samples from the room page, stored in SQLite off the request path.
+
+The page posts batches of per-connection getStats() summaries to app.py
+(POST /api/telemetry); the handler only validates them and hands them to
+a Store, whose writer thread does the I/O:
+
+  store = Store(DB_PATH)
+  store.submit(room_id, user, samples)   # False if the queue is full (dropped)
+  store.summary(room_id, since)          # p95 RTT / loss etc. from the rollups
+
+A sample is {t, peer, rtt, jitter, lost, recv, fps, out_kbps, in_kbps}: t in
+epoch seconds, rtt and jitter in ms, lost/recv packets since the previous
+sample of that connection. The writer inserts raw rows with one
+executemany per batch and folds them into per-BUCKET_SECONDS rollups per
+(room, user): sums in telemetry_rollup, RTT and loss histograms (fixed
+bins) in telemetry_hist, so percentiles (reported as the upper bound of
+their bin) survive the pruning of raw rows (RAW_RETENTION_DAYS; rollups are
+kept ROLLUP_RETENTION_DAYS).
+"""
+
+BUCKET_SECONDS = int(os.environ.get("TELEMETRY_BUCKET_SECONDS", "300"))
+RAW_RETENTION_DAYS = float(os.environ.get("TELEMETRY_RAW_RETENTION_DAYS", "2"))
+ROLLUP_RETENTION_DAYS = float(os.environ.get("TELEMETRY_ROLLUP_RETENTION_DAYS", "90"))
+QUEUE_MAX = int(os.environ.get("TELEMETRY_QUEUE_MAX", "1000"))  # batches waiting for the writer
+FLUSH_INTERVAL = 1.0     # seconds the writer gathers batches into one transaction
+PRUNE_INTERVAL = 3600.0
+PRUNE_CHUNK = 5000       # rows per DELETE, so a big prune does not hold the write lock for long
+MAX_SAMPLES = 200        # per batch
+
+RTT_BINS = (10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 750, 1000, 1500, 2000)   # ms, upper bounds
+LOSS_BINS = (0.1, 0.5, 1, 2, 3, 5, 8, 12, 20, 35, 50)                              # %, upper bounds
+
+log = jsonlog.get_logger("app.telemetry")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS telemetry_samples (
+    ts REAL NOT NULL,
+    room TEXT NOT NULL,
+    user TEXT NOT NULL,
+    peer TEXT NOT NULL,
+    rtt_ms REAL,
+    jitter_ms REAL,
+    lost INTEGER,
+    received INTEGER,
+    fps REAL,
+    out_kbps REAL,
+    in_kbps REAL
+);
+CREATE INDEX IF NOT EXISTS telemetry_samples_ts ON telemetry_samples(ts);
+CREATE TABLE IF NOT EXISTS telemetry_rollup (
+    bucket INTEGER NOT NULL,
+    room TEXT NOT NULL,
+    user TEXT NOT NULL,
+    samples INTEGER NOT NULL,
+    rtt_n INTEGER NOT NULL,
+    rtt_sum REAL NOT NULL,
+    rtt_max REAL NOT NULL,
+    jitter_n INTEGER NOT NULL,
+    jitter_sum REAL NOT NULL,
+    lost INTEGER NOT NULL,
+    received INTEGER NOT NULL,
+    fps_n INTEGER NOT NULL,
+    fps_sum REAL NOT NULL,
+    PRIMARY KEY (room, bucket, user)
+);
+CREATE INDEX IF NOT EXISTS telemetry_rollup_bucket ON telemetry_rollup(bucket);
+CREATE TABLE IF NOT EXISTS telemetry_hist (
+    room TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bin INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (room, bucket, user, metric, bin)
+);
+CREATE INDEX IF NOT EXISTS telemetry_hist_bucket ON telemetry_hist(bucket);
+"""
+
+ROLLUP_UPSERT = """
+INSERT INTO telemetry_rollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (room, bucket, user) DO UPDATE SET
+    samples = samples + excluded.samples,
+    rtt_n = rtt_n + excluded.rtt_n,
+    rtt_sum = rtt_sum + excluded.rtt_sum,
+    rtt_max = MAX(rtt_max, excluded.rtt_max),
+    jitter_n = jitter_n + excluded.jitter_n,
+    jitter_sum = jitter_sum + excluded.jitter_sum,
+    lost = lost + excluded.lost,
+    received = received + excluded.received,
+    fps_n = fps_n + excluded.fps_n,
+    fps_sum = fps_sum + excluded.fps_sum
+"""
+
+HIST_UPSERT = """
+INSERT INTO telemetry_hist VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (room, bucket, user, metric, bin) DO UPDATE SET count = count + excluded.count
+"""
+
+
+def _num(v, lo=0.0, hi=1e7):
+    if type(v) not in (int, float) or v != v:  # NaN
+        return None
+    return min(max(float(v), lo), hi)
+
+
+def _bin(value, bins):
+    for i, upper in enumerate(bins):
+        if value <= upper:
+            return i
+    return len(bins)
+
+
+def _percentile(counts, bins, q):
+    """Upper bound of the bin holding the q-quantile (the last bin has none: its lower bound)."""
+    total = sum(counts.values())
+    if not total:
+        return None
+    seen = 0
+    for i in sorted(counts):
+        seen += counts[i]
+        if seen >= q * total:
+            return bins[i] if i < len(bins) else bins[-1]
+    return bins[-1]
+
+
+def clean_sample(s, now):
+    """The stored fields of one client sample, or None if it is unusable."""
+    if not isinstance(s, dict):
+        return None
+    t = _num(s.get("t"), now - 86400, now + 60)
+    if t is None:
+        t = now
+    peer = s.get("peer")
+    peer = peer[:64] if isinstance(peer, str) and peer else "?"
+    lost, recv = _num(s.get("lost"), 0, 1e6), _num(s.get("recv"), 0, 1e7)
+    metrics = (_num(s.get("rtt"), 0, 60000), _num(s.get("jitter"), 0, 60000),
+               None if lost is None else int(lost), None if recv is None else int(recv),
+               _num(s.get("fps"), 0, 240), _num(s.get("out_kbps")), _num(s.get("in_kbps")))
+    if all(m is None for m in metrics):
+        return None
+    return (t, peer) + metrics
+
+
+class Store:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.queue = queue.Queue(QUEUE_MAX)
+        self.counters = collections.Counter()
+        self.thread = None
+        self.lock = threading.Lock()
+        # the schema is created here, once; summary() reuses this connection
+        # (any request thread, one at a time), the writer thread has its own
+        self.reader = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self.reader.executescript(SCHEMA)
+        self.read_lock = threading.Lock()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    # ---- request path: no I/O ----
+    def submit(self, room_id, user, samples):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put_nowait((room_id, user, samples))
+        except queue.Full:
+            self.counters["batches_dropped"] += 1
+            return False
+        self.counters["batches"] += 1
+        return True
+
+    # ---- writer thread ----
+    def _run(self):
+        conn = self._connect()
+        next_prune = 0.0
+        while True:
+            batches = [self.queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batches.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # anything a batch raises (bad data as well as SQLite) costs that batch, never the thread
+            try:
+                self.write(conn, batches)
+            except Exception:
+                self.counters["write_errors"] += 1
+                log.exception("telemetry write failed", batches=len(batches))
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + PRUNE_INTERVAL
+                try:
+                    self.prune(conn, time.time())
+                except Exception:
+                    self.counters["prune_errors"] += 1
+                    log.exception("telemetry prune failed")
+
+    def write(self, conn, batches):
+        now = time.time()
+        raw = []
+        rollup = {}                       # (room, bucket, user) -> [samples, rtt_n, ...]
+        hist = collections.Counter()      # (room, bucket, user, metric, bin) -> count
+        for room_id, user, samples in batches:
+            for s in samples:
+                row = clean_sample(s, now)
+                if row is None:
+                    continue
+                t, peer, rtt, jitter, lost, recv, fps, out_kbps, in_kbps = row
+                raw.append((t, room_id, user) + row[1:])
+                bucket = int(t // BUCKET_SECONDS * BUCKET_SECONDS)
+                key = (room_id, bucket, user)
+                r = rollup.setdefault(key, [0, 0, 0.0, 0.0, 0, 0.0, 0, 0, 0, 0.0])
+                r[0] += 1
+                if rtt is not None:
+                    r[1] += 1; r[2] += rtt; r[3] = max(r[3], rtt)
+                    hist[key + ("rtt", _bin(rtt, RTT_BINS))] += 1
+                if jitter is not None:
+                    r[4] += 1; r[5] += jitter
+                if lost is not None and recv is not None:
+                    r[6] += lost; r[7] += recv
+                    if lost + recv:
+                        hist[key + ("loss", _bin(100.0 * lost / (lost + recv), LOSS_BINS))] += 1
+                if fps is not None:
+                    r[8] += 1; r[9] += fps
+        if not raw:
+            return
+        with conn:
+            conn.executemany("INSERT INTO telemetry_samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", raw)
+            conn.executemany(ROLLUP_UPSERT, [(b, room, u, *r) for (room, b, u), r in rollup.items()])
+            conn.executemany(HIST_UPSERT, [k + (n,) for k, n in hist.items()])
+        self.counters["samples"] += len(raw)
+
+    def prune(self, conn, now):
+        for table, column, days in (("telemetry_samples", "ts", RAW_RETENTION_DAYS),
+                                    ("telemetry_rollup", "bucket", ROLLUP_RETENTION_DAYS),
+                                    ("telemetry_hist", "bucket", ROLLUP_RETENTION_DAYS)):
+            cutoff = now - days * 86400
+            while True:
+                with conn:
+                    cur = conn.execute(f"DELETE FROM {table} WHERE rowid IN "
+                                       f"(SELECT rowid FROM {table} WHERE {column} < ? LIMIT ?)",
+                                       (cutoff, PRUNE_CHUNK))
+                self.counters["pruned_" + table] += cur.rowcount
+                if cur.rowcount < PRUNE_CHUNK:
+                    break
+
+    # ---- query API ----
+    def summary(self, room_id, since):
+        """Call quality of room_id from epoch `since` on, overall and per user."""
+        bucket = int(since // BUCKET_SECONDS * BUCKET_SECONDS)
+        with self.read_lock:
+            conn = self.reader
+            rows = conn.execute("SELECT user, SUM(samples), SUM(rtt_n), SUM(rtt_sum), MAX(rtt_max), "
+                                "SUM(jitter_n), SUM(jitter_sum), SUM(lost), SUM(received), SUM(fps_n), "
+                                "SUM(fps_sum) FROM telemetry_rollup WHERE room = ? AND bucket >= ? "
+                                "GROUP BY user", (room_id, bucket)).fetchall()
+            bins = conn.execute("SELECT user, metric, bin, SUM(count) FROM telemetry_hist "
+                                "WHERE room = ? AND bucket >= ? GROUP BY user, metric, bin",
+                                (room_id, bucket)).fetchall()
+
+        hists = collections.defaultdict(collections.Counter)  # (user or None, metric) -> bin -> count
+        for user, metric, b, n in bins:
+            hists[(user, metric)][b] += n
+            hists[(None, metric)][b] += n
+
+        def report(user, samples, rtt_n, rtt_sum, rtt_max, jitter_n, jitter_sum, lost, received, fps_n, fps_sum):
+            return {
+                "samples": samples,
+                "rtt_avg_ms": round(rtt_sum / rtt_n, 1) if rtt_n else None,
+                "rtt_p95_ms": min(_percentile(hists[(user, "rtt")], RTT_BINS, 0.95), rtt_max) if rtt_n else None,
+                "rtt_max_ms": rtt_max if rtt_n else None,
+                "jitter_avg_ms": round(jitter_sum / jitter_n, 1) if jitter_n else None,
+                "loss_pct": round(100.0 * lost / (lost + received), 2) if lost + received else None,
+                "loss_p95_pct": _percentile(hists[(user, "loss")], LOSS_BINS, 0.95),
+                "fps_avg": round(fps_sum / fps_n, 1) if fps_n else None,
+            }
+
+        users = {row[0]: report(*row) for row in rows}
+        totals = [sum(r[i] for r in rows) for i in range(1, 11)]
+        totals[3] = max((r[4] for r in rows), default=0)  # rtt_max is a max, not a sum
+        out = report(None, *totals)
+        out.update({"room": room_id, "since": bucket, "bucket_seconds": BUCKET_SECONDS, "users": users})
+        return out
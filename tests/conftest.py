@@ -0,0 +1,23 @@
+# tests/conftest.py
+import os, sys, tempfile
+
+import pytest
+
+# the modules under test are flat top-level files, imported as the servers import them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# app.py reads these at import and has no defaults for them
+os.environ.setdefault("SESSION_COOKIE_NAME", "sid")
+os.environ.setdefault("SESSION_TTL_SECONDS", "3600")
+os.environ.setdefault("CLOUDFLARE_TURN_TTL", "3600")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="webrtc-tests-"), "users.db"))
+
+
+@pytest.fixture
+def relayed(monkeypatch):
+    """(target, frame) of everything signaling.relay_signal() would send."""
+    import signaling
+
+    out = []
+    monkeypatch.setattr(signaling, "relay_signal", lambda room, target, frame: out.append((target, frame)))
+    return out
@@ -0,0 +1,85 @@
+# tests/test_app.py — app.py routes, driven through handle_request()
+import json
+import time
+
+import pytest
+
+import app
+import jointoken
+
+
+@pytest.fixture
+def session(monkeypatch):
+    """Log a session in: returns (sid, data); the room "r1" belongs to alice."""
+    monkeypatch.setattr(app, "SESSIONS", {})
+    monkeypatch.setattr(app, "ROOMS", {"r1": {"key": "k", "owner": "alice", "created_at": ""}})
+    data = {"user": "alice"}
+    app.SESSIONS["s1"] = {"data": data, "expires": int(time.time()) + 60}
+    return "s1", data
+
+
+def call(method, path, sid=None, headers=(), body=b""):
+    head = [f"{method} {path} HTTP/1.1", "Host: test"]
+    if sid:
+        head.append(f"Cookie: {app.SESSION_COOKIE_NAME}={sid}")
+    head += [f"{k}: {v}" for k, v in headers]
+    if body:
+        head.append(f"Content-Length: {len(body)}")
+    raw = app.handle_request(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+    status_line, _, rest = raw.partition(b"\r\n")
+    _, _, payload = rest.partition(b"\r\n\r\n")
+    return int(status_line.split()[1]), payload
+
+
+# ----------------- signaling join tokens -----------------
+def test_signal_token_is_signed_for_the_room_and_user(session):
+    status, body = call("GET", "/api/signal-token?room=r1", sid="s1")
+    assert status == 200
+    token = json.loads(body)["token"]
+    v = jointoken.Verifier(app.SECRET_KEY)
+    assert not v.check(token, "r1", "bob")
+    assert v.check(token, "r1", "alice")
+
+
+def test_signal_token_needs_a_login_and_the_room(session):
+    assert call("GET", "/api/signal-token?room=r1")[0] == 401
+    assert call("GET", "/api/signal-token?room=elsewhere", sid="s1")[0] == 403
+
+
+# ----------------- telemetry -----------------
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    import telemetry
+
+    s = telemetry.Store(str(tmp_path / "t.db"))
+    monkeypatch.setattr(app, "TELEMETRY", s)
+    yield s
+    s.reader.close()
+
+
+def test_telemetry_batches_are_queued_for_rooms_of_the_session(session, store, monkeypatch):
+    monkeypatch.setattr(store, "submit", lambda room, user, samples: store.queue.put((room, user, samples)) or True)
+    body = json.dumps({"room": "r1", "samples": [{"rtt": 30}]}).encode()
+    assert call("POST", "/api/telemetry", sid="s1", body=body)[0] == 204
+    assert store.queue.get_nowait() == ("r1", "alice", [{"rtt": 30}])
+    assert call("POST", "/api/telemetry", body=body)[0] == 401
+    assert call("POST", "/api/telemetry", sid="s1", body=b"{")[0] == 400
+    other = json.dumps({"room": "r2", "samples": []}).encode()
+    assert call("POST", "/api/telemetry", sid="s1", body=other)[0] == 403
+
+
+def test_telemetry_summary_for_members_or_the_api_token(session, store, monkeypatch):
+    monkeypatch.setattr(app, "TELEMETRY_API_TOKEN", "sekrit")
+    status, body = call("GET", "/api/telemetry/summary?room=r1", sid="s1")
+    assert status == 200 and json.loads(body)["room"] == "r1"
+    assert call("GET", "/api/telemetry/summary?room=r2", sid="s1")[0] == 403
+    bearer = [("Authorization", "Bearer sekrit")]
+    assert call("GET", "/api/telemetry/summary?room=r2", headers=bearer)[0] == 200
+    assert call("GET", "/api/telemetry/summary?room=r2", headers=[("Authorization", "Bearer nope")])[0] == 401
+
+
+def test_telemetry_summary_non_ascii_authorization_is_refused_not_an_error(session, store, monkeypatch):
+    monkeypatch.setattr(app, "TELEMETRY_API_TOKEN", "sekrit")
+    head = "GET /api/telemetry/summary?room=r1 HTTP/1.1\r\nAuthorization: Bearer sékrit\r\n\r\n"
+    raw = app.handle_request(head.encode("utf-8"))
+    assert raw.startswith(b"HTTP/1.1 401")
@@ -0,0 +1,25 @@
+# tests/test_chat_history.py
+import json
+
+import signaling
+
+
+def test_chat_history_keeps_the_newest_frames_in_order():
+    h = signaling.ChatHistory(size=3)
+    assert h.frame() is None
+    for i in range(5):
+        h.add('{"type":"chat","text":"%d"}' % i)
+    items = json.loads(h.frame())["items"]
+    assert [m["text"] for m in items] == ["2", "3", "4"]
+
+
+def test_chat_history_byte_cap(monkeypatch):
+    monkeypatch.setattr(signaling, "CHAT_HISTORY_BYTES", 60)
+    h = signaling.ChatHistory(size=10)
+    frame = '{"type":"chat","text":"%s"}'
+    h.add(frame % ("x" * 100))  # larger than the cap on its own: not kept
+    assert h.frame() is None
+    for i in range(4):
+        h.add(frame % i)  # 26 bytes each: two fit
+    assert [m["text"] for m in json.loads(h.frame())["items"]] == ["2", "3"]
+    assert h.bytes <= 60
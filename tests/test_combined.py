@@ -0,0 +1,101 @@
+# tests/test_combined.py — the single-port front (no TLS here: Runtime.handle
+# only ever sees a stream)
+import asyncio
+import json
+import time
+
+import app
+import combined
+import signaling
+
+
+def test_cookie_finds_and_unquotes_one_value():
+    header = "theme=dark; sid=a%2Bb; other=1"
+    assert combined._cookie(header, "sid") == "a+b"
+    assert combined._cookie(header, "missing") is None
+    assert combined._cookie(None, "sid") is None
+
+
+def test_sweep_drops_rooms_empty_for_the_ttl(monkeypatch):
+    monkeypatch.setattr(combined, "ROOM_TTL", 10)
+    monkeypatch.setattr(app, "ROOMS", {"busy": {}, "idle": {}})
+    monkeypatch.setattr(signaling, "rooms", {"busy": object()})
+    rt = combined.Runtime()
+    rt.sweep(100)
+    assert set(app.ROOMS) == {"busy", "idle"} and rt.empty_since == {"idle": 100}
+    rt.sweep(109)
+    assert "idle" in app.ROOMS
+    rt.sweep(110)
+    assert set(app.ROOMS) == {"busy"} and rt.empty_since == {}
+
+
+def test_sweep_forgets_rooms_that_come_back_or_go_away(monkeypatch):
+    monkeypatch.setattr(app, "ROOMS", {"a": {}, "b": {}})
+    monkeypatch.setattr(signaling, "rooms", {})
+    rt = combined.Runtime()
+    rt.sweep(0)
+    signaling.rooms["a"] = object()  # someone joined
+    del app.ROOMS["b"]               # deleted elsewhere
+    rt.sweep(1)
+    assert rt.empty_since == {}
+
+
+def test_authorize_checks_session_user_and_room(monkeypatch):
+    monkeypatch.setattr(app, "ROOMS", {"r1": {"owner": "alice", "key": "k"}})
+    monkeypatch.setattr(app, "SESSIONS", {"s1": {"data": {"user": "alice"}, "expires": time.time() + 60}})
+    rt = combined.Runtime()
+    cookie = {"Cookie": f"{app.SESSION_COOKIE_NAME}=s1"}
+
+    async def run():
+        return [await rt.authorize("/?room=r1&user=alice", cookie),
+                await rt.authorize("/?room=r1&user=mallory", cookie),
+                await rt.authorize("/?room=r2&user=alice", cookie),
+                await rt.authorize("/?room=r1&user=alice", {})]
+
+    ok, wrong_user, wrong_room, no_session = asyncio.run(run())
+    assert ok is None
+    assert all(r[0] == 403 for r in (wrong_user, wrong_room, no_session))
+
+
+def request(rt, raw):
+    async def run():
+        server = await asyncio.start_server(rt.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(raw)
+            await writer.drain()
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return data
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(run())
+
+
+def test_handle_answers_healthz_itself():
+    data = request(combined.Runtime(), b"GET /healthz HTTP/1.1\r\nHost: x\r\n\r\n")
+    head, _, body = data.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200")
+    assert json.loads(body)["ready"] is True
+
+
+def test_handle_refuses_oversized_bodies(monkeypatch):
+    monkeypatch.setattr(combined, "MAX_BODY", 10)
+    data = request(combined.Runtime(), b"POST /upload HTTP/1.1\r\nContent-Length: 11\r\n\r\n")
+    assert data.startswith(b"HTTP/1.1 413")
+
+
+def test_handle_routes_the_rest_to_app(monkeypatch):
+    seen = []
+
+    def handle_request(data):
+        seen.append(data)
+        return b"HTTP/1.1 204 No Content\r\nContent-Length: 0\r\n\r\n"
+
+    monkeypatch.setattr(app, "handle_request", handle_request)
+    data = request(combined.Runtime(), b"POST /x HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc")
+    assert data.startswith(b"HTTP/1.1 204")
+    assert seen == [b"POST /x HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"]
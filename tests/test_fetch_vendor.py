@@ -0,0 +1,28 @@
+# tests/test_fetch_vendor.py — checks only; nothing is downloaded
+import base64
+import hashlib
+
+import pytest
+
+import fetch_vendor
+
+
+def test_verify_integrity_takes_npm_sha512_only():
+    data = b"tarball"
+    good = "sha512-" + base64.b64encode(hashlib.sha512(data).digest()).decode()
+    fetch_vendor.verify_integrity(data, good)
+    with pytest.raises(ValueError):
+        fetch_vendor.verify_integrity(b"other", good)
+    with pytest.raises(ValueError):
+        fetch_vendor.verify_integrity(data, "sha1-" + base64.b64encode(hashlib.sha1(data).digest()).decode())
+
+
+def test_check_wants_the_file_and_a_matching_lock(tmp_path, monkeypatch):
+    monkeypatch.setattr(fetch_vendor, "VENDOR_DIR", str(tmp_path))
+    assert fetch_vendor.check("tf.min.js") == "missing"
+    (tmp_path / "tf.min.js").write_bytes(b"code")
+    assert fetch_vendor.check("tf.min.js") == "no checksum recorded"
+    (tmp_path / "tf.min.js.sha256").write_text(hashlib.sha256(b"code").hexdigest() + "  tf.min.js\n")
+    assert fetch_vendor.check("tf.min.js") is None
+    (tmp_path / "tf.min.js").write_bytes(b"changed")
+    assert fetch_vendor.check("tf.min.js") == "checksum mismatch"
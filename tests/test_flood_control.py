@@ -0,0 +1,68 @@
+# tests/test_flood_control.py
+import json, asyncio
+
+import signaling
+
+
+class Clock:
+    def __init__(self, t=1000.0):
+        self.t = t
+
+    def monotonic(self):
+        return self.t
+
+
+# ----------------- flood control -----------------
+def test_token_bucket_allows_the_burst_then_the_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(signaling, "time", clock)
+    bucket = signaling.TokenBucket(rate=2, burst=3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+    clock.t += 0.5  # one token back
+    assert [bucket.take() for _ in range(2)] == [True, False]
+    clock.t += 60  # refills to the burst, no further
+    assert sum(bucket.take() for _ in range(10)) == 3
+
+
+def test_message_types_map_to_budgets():
+    assert signaling.budget_for("signal") == signaling.budget_for("intro_ack") == "signal"
+    assert signaling.budget_for("host_kick") == "host"
+    assert signaling.budget_for("chat") == signaling.budget_for(None) == "chat"
+    assert set(signaling.new_limits()) == set(signaling.RATE_LIMITS)
+
+
+# ----------------- ICE candidate coalescing -----------------
+def ice(n):
+    return '{"type":"signal","to":"bob","from":"x","data":{"type":"encrypted","b64":"c%d","ice":1}}' % n
+
+
+def test_ice_coalescer_batches_candidates_and_keeps_order(relayed):
+    async def run():
+        co = signaling.IceCoalescer({"id": "r"}, '"alice"', window=10)
+        co.push("bob", ice(1))
+        co.push("bob", ice(2))
+        assert relayed == []
+        offer = '{"type":"signal","to":"bob","data":{"type":"encrypted","b64":"sdp"}}'
+        co.push("bob", offer)  # anything else flushes the held candidates first
+        return offer
+
+    offer = asyncio.run(run())
+    (t1, batch), (t2, frame) = relayed
+    assert t1 == t2 == "bob"
+    msg = json.loads(batch)
+    assert msg["type"] == "signal_batch" and msg["from"] == "alice"
+    assert [item["b64"] for item in msg["items"]] == ["c1", "c2"]
+    assert json.loads(frame)["from"] == "alice" and frame.startswith(offer[:-1])
+    assert signaling.counters["ice_batches"] >= 1
+
+
+def test_ice_coalescer_sends_a_lone_candidate_after_the_window(relayed):
+    async def run():
+        co = signaling.IceCoalescer({"id": "r"}, '"alice"', window=0.01)
+        co.push("bob", ice(1))
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+    assert len(relayed) == 1
+    msg = json.loads(relayed[0][1])
+    assert msg["type"] == "signal" and msg["from"] == "alice" and msg["data"]["b64"] == "c1"
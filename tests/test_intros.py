@@ -0,0 +1,57 @@
+# tests/test_intros.py — the server-side introduction scheduler
+import json, asyncio
+
+import signaling
+
+
+def intros(relayed):
+    return [(target, json.loads(frame)["data"]["other"]) for target, frame in relayed]
+
+
+def test_intro_scheduler_introduces_both_sides(relayed):
+    async def run():
+        s = signaling.IntroScheduler({"id": "r"})
+        s.add_peer("carol", ["alice", "bob", "carol"])
+        await asyncio.sleep(0.01)
+        s.close()
+        return s
+
+    s = asyncio.run(run())
+    assert sorted(intros(relayed)) == [("alice", "carol"), ("bob", "carol"),
+                                       ("carol", "alice"), ("carol", "bob")]
+    assert set(s.inflight) == {("carol", "alice"), ("carol", "bob")}
+
+
+def test_intro_scheduler_caps_pairs_in_flight_per_peer(relayed, monkeypatch):
+    monkeypatch.setattr(signaling, "INTRO_PER_PEER", 1)
+
+    async def run():
+        s = signaling.IntroScheduler({"id": "r"})
+        s.add_peer("dave", ["alice", "bob"])
+        await asyncio.sleep(0.01)
+        first = list(s.inflight)
+        assert len(first) == 1 and len(s.queue) == 1
+        s.ack(first[0][1], "dave", ok=True)  # either side may ack
+        await asyncio.sleep(0.01)
+        second = list(s.inflight)
+        s.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert len(second) == 1 and second != first
+
+
+def test_intro_scheduler_forget_drops_queued_and_inflight_pairs(relayed, monkeypatch):
+    monkeypatch.setattr(signaling, "INTRO_PER_PEER", 1)
+
+    async def run():
+        s = signaling.IntroScheduler({"id": "r"})
+        s.add_peer("erin", ["alice", "bob"])
+        await asyncio.sleep(0.01)
+        s.forget("erin")
+        await asyncio.sleep(0.01)
+        s.close()
+        return s
+
+    s = asyncio.run(run())
+    assert not s.inflight and not s.queue and not s.busy and "erin" not in s.joins
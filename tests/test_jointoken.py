@@ -0,0 +1,55 @@
+# tests/test_jointoken.py
+import time
+
+import jointoken
+
+SECRET = "test-secret"
+
+
+def test_token_accepted_once_for_its_room_and_user():
+    v = jointoken.Verifier(SECRET)
+    token = jointoken.issue(SECRET, "room1", "alice")
+    assert not v.check(token, "room2", "alice")
+    assert not v.check(token, "room1", "bob")
+    assert v.check(token, "room1", "alice")
+    assert not v.check(token, "room1", "alice")  # replay
+
+
+def test_rejects_expired_tampered_and_malformed_tokens():
+    v = jointoken.Verifier(SECRET)
+    token = jointoken.issue(SECRET, "r", "u", ttl=60)
+    assert not v.check(token, "r", "u", now=time.time() + 61)
+    exp, nonce, mac = token.split(".")
+    assert not v.check(f"{int(exp) + 600}.{nonce}.{mac}", "r", "u")
+    assert not v.check(jointoken.issue("other-secret", "r", "u"), "r", "u")
+    for junk in ("", "abc", "1.2", "x.y.z", None):
+        assert not v.check(junk, "r", "u")
+
+
+def test_full_replay_cache_refuses_instead_of_forgetting_live_nonces():
+    v = jointoken.Verifier(SECRET, replay_max=2)
+    now = time.time()
+    first, second, third = (jointoken.issue(SECRET, "r", "u", ttl=60) for _ in range(3))
+    assert v.check(first, "r", "u", now=now)
+    assert v.check(second, "r", "u", now=now)
+    assert not v.check(third, "r", "u", now=now)   # full: refused
+    assert not v.check(first, "r", "u", now=now)   # and first is still remembered
+    assert len(v.seen) == 2
+
+
+def test_expired_nonces_are_pruned():
+    v = jointoken.Verifier(SECRET, replay_max=1)
+    now = time.time()
+    assert v.check(jointoken.issue(SECRET, "r", "u", ttl=10), "r", "u", now=now)
+    later = now + 30
+    fresh = jointoken.issue(SECRET, "r", "u", ttl=60)
+    assert v.check(fresh, "r", "u", now=later)
+    assert len(v.seen) == 1
+
+
+def test_fields_cannot_bleed_into_each_other():
+    # "a\nb" + "c" and "a" + "b\nc" used to sign the same bytes
+    v = jointoken.Verifier(SECRET)
+    token = jointoken.issue(SECRET, "a\nb", "c")
+    assert not v.check(token, "a", "b\nc")
+    assert v.check(token, "a\nb", "c")
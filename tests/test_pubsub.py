@@ -0,0 +1,119 @@
+# tests/test_pubsub.py
+import asyncio
+
+import pubsub
+
+
+def make_hub(*nodes):
+    hub = pubsub.Hub()
+    events = {node: [] for node in nodes}
+    for node in nodes:
+        hub.attach(node, events[node].append)
+    return hub, events
+
+
+def test_join_and_leave_bump_the_roster_version_on_every_node():
+    hub, events = make_hub("n1", "n2")
+    assert hub.join("n1", "r", "alice") == {"members": {}, "host": None, "version": 1}
+    reply = hub.join("n2", "r", "bob")
+    assert reply["members"] == {"alice": "n1", "bob": "n2"} and reply["version"] == 2
+    hub.leave("n2", "r", "bob")
+    assert [(e["ev"], e["user"], e["v"]) for e in events["n1"]] == [
+        ("join", "alice", 1), ("join", "bob", 2), ("leave", "bob", 3)]
+    assert not events["n1"][-1]["lost"]
+    assert [e["v"] for e in events["n2"]] == [2]  # no longer in the room: its own leave is local
+
+
+def test_same_node_rejoin_is_announced_without_a_bump():
+    hub, events = make_hub("n1")
+    hub.join("n1", "r", "alice")
+    assert hub.join("n1", "r", "alice")["version"] == 1
+    assert [e["v"] for e in events["n1"]] == [1, 1]
+
+
+def test_leave_from_a_stale_node_is_ignored():
+    hub, _ = make_hub("n1", "n2")
+    hub.join("n1", "r", "alice")
+    hub.join("n2", "r", "alice")  # moved to n2
+    hub.leave("n1", "r", "alice")
+    assert hub.rooms["r"]["members"] == {"alice": "n2"}
+
+
+def test_claim_host_is_compare_and_set():
+    hub, events = make_hub("n1")
+    hub.join("n1", "r", "alice")
+    hub.join("n1", "r", "bob")
+    assert hub.claim_host("n1", "r", None, "bob")
+    assert not hub.claim_host("n1", "r", None, "alice")  # expect is stale
+    assert not hub.claim_host("n1", "r", "bob", "carol")  # not a member
+    assert hub.rooms["r"]["host"] == "bob"
+    assert events["n1"][-1] == {"ev": "host", "room": "r", "host": "bob", "v": 3}
+
+
+def test_host_leaving_hands_over_to_the_first_member_alphabetically():
+    hub, events = make_hub("n1")
+    for user in ("mia", "carl", "zoe"):
+        hub.join("n1", "r", user)
+    hub.claim_host("n1", "r", None, "mia")
+    hub.leave("n1", "r", "mia")
+    assert hub.rooms["r"]["host"] == "carl"
+    assert events["n1"][-1]["ev"] == "host"
+
+
+def test_detach_reports_the_node_peers_as_lost_and_drops_empty_rooms():
+    hub, events = make_hub("n1", "n2")
+    hub.join("n1", "r", "alice")
+    hub.join("n2", "r", "bob")
+    hub.join("n2", "solo", "carol")
+    hub.detach("n2")
+    lost = [e for e in events["n1"] if e["ev"] == "leave"]
+    assert [(e["user"], e["lost"]) for e in lost] == [("bob", True)]
+    assert "solo" not in hub.rooms
+
+
+def test_publish_reaches_other_nodes_only_and_send_reaches_the_member():
+    hub, events = make_hub("n1", "n2")
+    hub.join("n1", "r", "alice")
+    hub.publish("n1", "r", "single-node")  # nobody elsewhere: nothing to forward
+    hub.join("n2", "r", "bob")
+    hub.publish("n1", "r", "frame", key="k")
+    assert [e for e in events["n1"] if e["ev"] == "msg"] == []
+    assert [e for e in events["n2"] if e["ev"] == "msg"] == [
+        {"ev": "msg", "room": "r", "data": "frame", "key": "k"}]
+    assert hub.send("n1", "r", "bob", "hi", close=True)
+    assert events["n2"][-1] == {"ev": "to", "room": "r", "user": "bob", "data": "hi", "close": True}
+    assert not hub.send("n1", "r", "nobody", "hi")
+    assert not hub.send("n1", "missing", "bob", "hi")
+
+
+def test_broker_bus_relays_between_nodes(tmp_path):
+    sock_path = str(tmp_path / "broker.sock")
+    broker = pubsub.start_broker(sock_path)
+
+    async def run():
+        got1, got2 = [], []
+        n1 = await pubsub.BrokerBus(sock_path, got1.append, node="n1").start()
+        n2 = await pubsub.BrokerBus(sock_path, got2.append, node="n2").start()
+        await n1.join("r", "alice")
+        reply = await n2.join("r", "bob")
+        n1.publish("r", "to-everyone")
+        n1.send("r", "bob", "to-bob")
+        assert await n2.claim_host("r", None, "bob")
+        for _ in range(100):
+            if (len([e for e in got2 if e["ev"] in ("msg", "to")]) == 2
+                    and any(e["ev"] == "host" for e in got1)):
+                break
+            await asyncio.sleep(0.01)
+        await n1.close()
+        await n2.close()
+        return reply, got1, got2
+
+    try:
+        reply, got1, got2 = asyncio.run(run())
+    finally:
+        broker.terminate()
+        broker.wait(5)
+    assert reply["members"] == {"alice": "n1", "bob": "n2"}
+    assert [e["data"] for e in got2 if e["ev"] in ("msg", "to")] == ["to-everyone", "to-bob"]
+    assert not [e for e in got1 if e["ev"] in ("msg", "to")]
+    assert {"ev": "host", "room": "r", "host": "bob", "v": 3} in got1
@@ -0,0 +1,129 @@
+# tests/test_quantize_model.py — on a tiny graph model of the same shape
+# (input -> fused conv + relu -> 1x1 conv), written to a temp folder
+import base64
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import quantize_model
+
+SIZE = 8
+
+
+def b64(s):
+    return base64.b64encode(s.encode()).decode()
+
+
+def tiny_model(folder, seed=0):
+    """model.json + one shard; -> path of model.json."""
+    rng = np.random.default_rng(seed)
+    weights = {
+        "w1": rng.normal(0, 0.5, (3, 3, 3, 4)).astype(np.float32),
+        "b1": rng.normal(0, 0.1, (4,)).astype(np.float32),
+        "w2": rng.normal(0, 0.5, (1, 1, 4, 1)).astype(np.float32),
+        "b2": np.array([-0.2], np.float32),
+    }
+    conv = lambda name, x, w, b, ops: {
+        "name": name, "op": "_FusedConv2D", "input": [x, w, b],
+        "attr": {"padding": {"s": b64("SAME")}, "fused_ops": {"list": {"s": [b64(o) for o in ops]}}}}
+    nodes = [{"name": "input_layer", "op": "Placeholder"}]
+    nodes += [{"name": k, "op": "Const"} for k in weights]
+    nodes += [conv("c1", "input_layer", "w1", "b1", ["BiasAdd", "Relu"]),
+              conv("logits", "c1", "w2", "b2", ["BiasAdd"])]
+    model = {
+        "format": "graph-model",
+        "signature": {
+            "inputs": {"input_layer": {"name": "input_layer:0", "tensorShape": {
+                "dim": [{"size": "-1"}, {"size": str(SIZE)}, {"size": str(SIZE)}, {"size": "3"}]}}},
+            "outputs": {"out": {"name": "logits:0"}}},
+        "modelTopology": {"node": nodes},
+        "weightsManifest": [{"paths": ["group1-shard1of1.bin"], "weights": [
+            {"name": k, "shape": list(v.shape), "dtype": "float32"} for k, v in weights.items()]}],
+    }
+    with open(os.path.join(folder, "group1-shard1of1.bin"), "wb") as f:
+        f.write(b"".join(v.tobytes() for v in weights.values()))
+    path = os.path.join(folder, "model.json")
+    with open(path, "w") as f:
+        json.dump(model, f)
+    return path, weights
+
+
+def test_load_model_reads_the_shards(tmp_path):
+    path, weights = tiny_model(str(tmp_path))
+    _, loaded = quantize_model.load_model(path)
+    assert set(loaded) == set(weights)
+    assert all(np.array_equal(loaded[k], weights[k]) for k in weights)
+
+
+@pytest.mark.parametrize("dtype, tol", [("float16", 1e-3), ("uint8", 2e-2)])
+def test_variants_load_back_dequantized(tmp_path, dtype, tol):
+    path, weights = tiny_model(str(tmp_path))
+    model, loaded = quantize_model.load_model(path)
+    out = str(tmp_path / dtype)
+    size, deq, max_err = quantize_model.write_variant(model, loaded, dtype, out)
+    _, again = quantize_model.load_model(os.path.join(out, "model.json"))
+    for k in weights:
+        assert np.allclose(again[k], deq[k], atol=1e-6)
+        assert np.abs(again[k] - weights[k]).max() <= max_err + 1e-6
+    assert max_err < tol
+
+
+def test_uint8_keeps_zero_exact():
+    arr = np.array([-0.7, 0.0, 0.31, 1.9], np.float32)
+    _, entry, deq = quantize_model.quantize(arr, "uint8")
+    assert deq[1] == 0.0 and entry["dtype"] == "uint8"
+
+
+def test_run_graph_matches_a_direct_computation(tmp_path):
+    path, w = tiny_model(str(tmp_path))
+    model, weights = quantize_model.load_model(path)
+    img = np.random.default_rng(1).random((1, SIZE, SIZE, 3), np.float32)
+    out = quantize_model.run_graph(model, weights, img)
+    hidden = np.maximum(quantize_model._conv2d(img, w["w1"], "SAME") + w["b1"], 0)
+    assert np.allclose(out, hidden @ w["w2"][0, 0] + w["b2"], atol=1e-5)
+    assert out.shape == (1, SIZE, SIZE, 1)
+
+
+def test_iou():
+    a = np.array([1, 1, 0, 0], bool)
+    assert quantize_model.iou(a, np.array([1, 0, 1, 0], bool)) == pytest.approx(1 / 3)
+    assert quantize_model.iou(np.zeros(4, bool), np.zeros(4, bool)) == 1.0
+
+
+def main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["quantize_model.py", *argv])
+    quantize_model.main()
+
+
+def test_main_checks_the_committed_eval_images_by_default(tmp_path, monkeypatch, capsys):
+    path, _ = tiny_model(str(tmp_path))
+    main(monkeypatch, path)
+    out = capsys.readouterr().out
+    for name in os.listdir(quantize_model.EVAL_IMAGES):
+        if name.endswith(".jpg"):
+            assert f"float32 {name}" in out
+    assert os.path.isfile(tmp_path / "float16" / "model.json")
+    assert os.path.isfile(tmp_path / "uint8" / "model.json")
+
+
+def test_main_removes_a_variant_below_min_iou(tmp_path, monkeypatch):
+    path, _ = tiny_model(str(tmp_path))
+    monkeypatch.setattr(quantize_model, "iou", lambda a, b: 0.5)
+    with pytest.raises(SystemExit) as err:
+        main(monkeypatch, path, "--dtypes", "uint8")
+    assert "uint8" in str(err.value.code)
+    assert not os.path.exists(tmp_path / "uint8")
+
+
+def test_main_with_missing_shards(tmp_path, monkeypatch):
+    path, _ = tiny_model(str(tmp_path))
+    os.remove(tmp_path / "group1-shard1of1.bin")
+    with pytest.raises(SystemExit) as err:
+        main(monkeypatch, path, "--skip-missing")
+    assert err.value.code == 0
+    with pytest.raises(SystemExit) as err:
+        main(monkeypatch, path)
+    assert err.value.code == 1
@@ -0,0 +1,132 @@
+# tests/test_resume.py — join order and session resumption, end to end over
+# real (plain ws) sockets against signaling.handler in this process.
+import asyncio
+import json
+
+import pytest
+import websockets
+
+import signaling
+
+
+async def serve():
+    return await websockets.serve(signaling.handler, "127.0.0.1", 0,
+                                  process_request=signaling.process_request)
+
+
+def url(server, room, user, **extra):
+    port = server.sockets[0].getsockname()[1]
+    q = "".join(f"&{k}={v}" for k, v in extra.items())
+    return f"ws://127.0.0.1:{port}/?room={room}&user={user}{q}"
+
+
+async def frames_until(ws, kind, timeout=2):
+    """Every frame received up to and including the first of type `kind`."""
+    out = []
+    while not out or out[-1]["type"] != kind:
+        out.append(json.loads(await asyncio.wait_for(ws.recv(), timeout)))
+    return out
+
+
+async def quiet(ws, wait=0.2):
+    """Frames that arrive within `wait` seconds."""
+    out = []
+    try:
+        while True:
+            out.append(json.loads(await asyncio.wait_for(ws.recv(), wait)))
+    except asyncio.TimeoutError:
+        return out
+
+
+def test_fresh_join_gets_session_before_the_roster():
+    async def run():
+        server = await serve()
+        try:
+            async with websockets.connect(url(server, "order", "alice")) as ws:
+                return [f["type"] for f in await frames_until(ws, "peer_list")]
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    assert asyncio.run(run())[0] == "session"
+
+
+def test_dropped_socket_resumes_its_parked_slot():
+    async def run():
+        server = await serve()
+        try:
+            alice = await websockets.connect(url(server, "park", "alice"))
+            token = (await frames_until(alice, "session"))[-1]["resume"]
+            bob = await websockets.connect(url(server, "park", "bob"))
+            await frames_until(bob, "peer_list")
+            await quiet(alice)
+
+            alice.transport.abort()  # no close frame: the server parks the slot
+            for _ in range(50):
+                if token in signaling.parked:
+                    break
+                await asyncio.sleep(0.02)
+            assert token in signaling.parked
+
+            async with websockets.connect(url(server, "park", "alice", resume=token)) as again:
+                resumed = await frames_until(again, "resumed")
+                bob_saw = await quiet(bob)
+            await bob.close()
+            return resumed, bob_saw
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    resumed, bob_saw = asyncio.run(run())
+    assert resumed[-1] == {"type": "resumed", "lost": False}
+    assert not [f for f in bob_saw if f["type"] in ("peer_left", "peer_joined")]
+
+
+def test_resume_takes_over_a_session_whose_socket_still_looks_open():
+    async def run():
+        server = await serve()
+        try:
+            old = await websockets.connect(url(server, "blip", "alice"))
+            token = (await frames_until(old, "session"))[-1]["resume"]
+            bob = await websockets.connect(url(server, "blip", "bob"))
+            await frames_until(bob, "peer_list")
+            await quiet(old)
+
+            new = await websockets.connect(url(server, "blip", "alice", resume=token))
+            resumed = await frames_until(new, "resumed")
+            await asyncio.wait_for(old.wait_closed(), 2)
+            await bob.send(json.dumps({"type": "chat", "text": "still there?"}))
+            chat = await frames_until(new, "chat")
+            room = signaling.rooms["blip"]
+            members = sorted(room["clients"].values())
+            bob_saw = await quiet(bob)
+            await new.close()
+            await bob.close()
+            return resumed, old.close_code, chat, members, bob_saw
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    resumed, old_code, chat, members, bob_saw = asyncio.run(run())
+    assert resumed[-1]["type"] == "resumed"
+    assert old_code == signaling.SESSION_MOVED
+    assert chat[-1]["text"] == "still there?"
+    assert members == ["alice", "bob"]
+    assert not [f for f in bob_saw if f["type"] in ("peer_left", "peer_joined")]
+
+
+def test_unknown_resume_token_is_refused_when_joins_are_signed(monkeypatch):
+    monkeypatch.setattr(signaling, "join_verifier", None)
+    signaling.set_join_secret(b"k" * 32)
+
+    async def run():
+        server = await serve()
+        try:
+            with pytest.raises(websockets.InvalidStatusCode) as err:
+                await websockets.connect(url(server, "gone", "alice", resume="nope"))
+            return err.value.status_code
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    assert asyncio.run(run()) == 403
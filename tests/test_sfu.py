@@ -0,0 +1,108 @@
+# tests/test_sfu.py — sfu.py negotiation, and a joiner of an SFU room end to end
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("aiortc")
+
+import websockets
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+import sfu
+import signaling
+
+
+async def answer(offer):
+    """What a browser with nothing to send would answer."""
+    pc = RTCPeerConnection()
+    await pc.setRemoteDescription(RTCSessionDescription(offer["sdp"], "offer"))
+    await pc.setLocalDescription(await pc.createAnswer())
+    return pc, pc.localDescription.sdp
+
+
+async def next_sent(sent, n, timeout=5):
+    for _ in range(int(timeout / 0.01)):
+        if len(sent) >= n:
+            return sent[n - 1]
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"only {len(sent)} messages sent")
+
+
+def test_join_offers_the_up_slots_and_takes_the_answer():
+    async def run():
+        sent = []
+        room = sfu.Room(lambda user, data: sent.append((user, data)))
+        await room.handle("alice", {"type": "join"})
+        user, offer = await next_sent(sent, 1)
+        pc, sdp = await answer(offer)
+        before = sfu.counters["negotiations"]
+        await room.handle("alice", {"type": "answer", "sdp": sdp})
+        for _ in range(100):
+            if sfu.counters["negotiations"] > before:
+                break
+            await asyncio.sleep(0.01)
+        report = room.report()
+        await room.close()
+        await pc.close()
+        return user, offer, sfu.counters["negotiations"] - before, report
+
+    user, offer, negotiated, report = asyncio.run(run())
+    assert user == "alice" and offer["type"] == "offer"
+    assert sorted((s["kind"], s["up"]) for s in offer["slots"].values()) == sorted(
+        (kind, source) for kind, source in sfu.UP_SLOTS)
+    assert negotiated == 1
+    assert report == {"sessions": 1, "published": 0, "forwarded": 0}
+
+
+def test_messages_before_join_are_ignored_and_remove_tells_the_client():
+    async def run():
+        sent = []
+        room = sfu.Room(lambda user, data: sent.append((user, data)))
+        await room.handle("bob", {"type": "answer", "sdp": "v=0"})
+        assert room.sessions == {}
+        await room.handle("bob", {"type": "join"})
+        await next_sent(sent, 1)
+        room.remove("bob", "timeout")
+        await asyncio.sleep(0)
+        return sent, room.sessions
+
+    sent, sessions = asyncio.run(run())
+    assert sent[-1] == ("bob", {"type": "closed", "reason": "timeout"})
+    assert sessions == {}
+
+
+def test_a_joiner_of_an_sfu_room_gets_its_session_first_and_an_offer(monkeypatch):
+    monkeypatch.setattr(signaling, "sfu", sfu)
+    monkeypatch.setattr(signaling, "SFU_AT", 2)
+    monkeypatch.setattr(signaling, "SFU_KEEP", 1)
+
+    async def run():
+        server = await websockets.serve(signaling.handler, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        base = f"ws://127.0.0.1:{port}/?room=big&user="
+        try:
+            alice = await websockets.connect(base + "alice")
+            bob = await websockets.connect(base + "bob")
+            kinds = []
+            while not {"media_mode", "peer_list"} <= set(kinds):
+                kinds.append(json.loads(await asyncio.wait_for(bob.recv(), 2))["type"])
+            # what the room page does on media_mode sfu
+            await bob.send(json.dumps({"type": "sfu", "data": {"type": "join"}}))
+            while True:
+                msg = json.loads(await asyncio.wait_for(bob.recv(), 5))
+                if msg["type"] == "sfu":
+                    break
+            sessions = list(signaling.rooms["big"]["sfu"].sessions)
+            await alice.close()
+            await bob.close()
+            return kinds, msg["data"], sessions
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    kinds, offer, sessions = asyncio.run(run())
+    # session resets the client's SFU state, so it must come before what sets it up
+    assert kinds[0] == "session"
+    assert offer["type"] == "offer"
+    assert sessions == ["bob"]
@@ -0,0 +1,31 @@
+# tests/test_signal_fastpath.py
+import json
+
+import signaling
+
+BROWSER = '{"type":"signal","to":"bob","from":"alice","data":{"type":"encrypted","b64":"QUJD","ice":1}}'
+
+
+def test_browser_frames_take_the_fast_path():
+    assert signaling.signal_target(BROWSER) == "bob"
+    assert signaling.signal_target('{"type":"signal","to":"bob","data":{"type":"ready"}}') == "bob"
+
+
+def test_anything_that_could_carry_a_second_to_takes_the_full_parse():
+    for raw in (
+        '{"type":"signal","to":"bob","data":{"a":1},"to":"eve","z":{}}',   # key after data
+        '{"type":"signal","to":"bob","to":"eve","data":{"a":1}}',           # key before data
+        '{"type":"signal","to":"bob", "to" : "eve","data":{"a":1}}',
+        '{"type":"signal","to":"bob","\\u0074o":"eve","data":{"a":1}}',     # escaped key
+        '{"type":"signal","to":"bob","data":{"a":{"to":"eve"}}}',           # nested data
+        '{"type":"signal","to":"bob","data":{"a":"}"}}',
+        '{"type":"signal","to":"bob","data":"x"}',
+        '{"type":"chat","text":"hi"}',
+        b'{"type":"signal","to":"bob","data":{}}',
+    ):
+        assert signaling.signal_target(raw) is None, raw
+
+
+def test_stamp_sender_overrides_a_client_supplied_from():
+    msg = json.loads(signaling.stamp_sender(BROWSER, '"mallory-proof"'))
+    assert msg["from"] == "mallory-proof" and msg["to"] == "bob"
@@ -0,0 +1,114 @@
+# tests/test_signaling_shards.py
+import socket, asyncio
+
+import signaling_shards as shards
+
+
+def test_hash_ring_is_stable_and_moves_only_rooms_of_an_added_worker():
+    rooms = [f"room-{i}" for i in range(2000)]
+    ring3 = shards.HashRing(range(3))
+    assert [ring3.node_for(r) for r in rooms] == [shards.HashRing(range(3)).node_for(r) for r in rooms]
+    assert {ring3.node_for(r) for r in rooms} == {0, 1, 2}
+    ring4 = shards.HashRing(range(4))
+    moved = [r for r in rooms if ring3.node_for(r) != ring4.node_for(r)]
+    assert all(ring4.node_for(r) == 3 for r in moved)
+    assert 0.1 < len(moved) / len(rooms) < 0.4
+
+
+def test_room_from_path():
+    assert shards.room_from_path("/?room=abc&user=u") == "abc"
+    assert shards.room_from_path("/?user=u") == "default"
+
+
+class Writer:
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_front_drops_a_client_that_sends_no_head(monkeypatch):
+    monkeypatch.setattr(shards, "READ_TIMEOUT", 0.05)
+
+    async def run():
+        front = shards.Front(1, "/nonexistent")
+        writer = Writer()
+        await asyncio.wait_for(front.handle(asyncio.StreamReader(), writer), 2)
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.closed and writer.data == b""
+
+
+def test_front_drops_an_oversized_head():
+    async def run():
+        front = shards.Front(1, "/nonexistent")
+        reader = asyncio.StreamReader(limit=shards.MAX_HEAD)
+        reader.feed_data(b"GET /?room=" + b"x" * (2 * shards.MAX_HEAD))
+        writer = Writer()
+        await asyncio.wait_for(front.handle(reader, writer), 2)
+        return writer
+
+    assert asyncio.run(run()).closed
+
+
+def test_healthz_is_503_while_a_worker_is_down():
+    front = shards.Front(2, "/nonexistent")
+    assert front.http_response("/healthz").startswith(b"HTTP/1.1 503")
+    assert b'"mode": "proxy"' in front.http_response("/shards")
+
+
+def test_peek_head_leaves_the_request_for_the_worker():
+    async def run():
+        a, b = socket.socketpair()
+        a.setblocking(False)
+        b.sendall(b"GET /?room=r HTTP/1.1\r\nHost: x\r\n")
+        task = asyncio.ensure_future(shards._peek_head(a))
+        await asyncio.sleep(0.02)
+        assert not task.done()  # incomplete head: keeps peeking
+        b.sendall(b"\r\nbody")
+        head = await asyncio.wait_for(task, 1)
+        rest = a.recv(100)
+        a.close()
+        b.close()
+        return head, rest
+
+    head, rest = asyncio.run(run())
+    assert head == b"GET /?room=r HTTP/1.1\r\nHost: x\r\n\r\n"
+    assert rest == head + b"body"
+
+
+def test_pass_socket_hands_the_connection_to_the_worker(tmp_path):
+    fd_path = str(tmp_path / "shard.fd.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listener.bind(fd_path)
+    listener.listen()
+    shard = shards.Shard(0, str(tmp_path / "shard.sock"), fd_path)
+
+    client, front_side = socket.socketpair()
+    assert shard.pass_socket(front_side)
+    front_side.close()  # the front's copy goes; the worker's keeps the connection
+    conn, _ = listener.accept()
+    msg, fds, _, _ = socket.recv_fds(conn, 1, 1)
+    worker_side = socket.socket(fileno=fds[0])
+    client.sendall(b"hello")
+    assert worker_side.recv(5) == b"hello"
+    for s in (worker_side, conn, client, listener):
+        s.close()
+    shard.close_handoff()
+
+
+def test_pass_socket_fails_when_no_worker_listens(tmp_path):
+    shard = shards.Shard(0, str(tmp_path / "a.sock"), str(tmp_path / "missing.fd.sock"))
+    a, b = socket.socketpair()
+    assert not shard.pass_socket(a)
+    a.close()
+    b.close()
@@ -0,0 +1,76 @@
+# tests/test_telemetry.py — rollups and summaries (the writer thread is not
+# started: write() and prune() are called directly)
+import time
+
+import pytest
+
+import telemetry
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = telemetry.Store(str(tmp_path / "t.db"))
+    yield s
+    s.reader.close()
+
+
+def write(store, *batches):
+    conn = store._connect()
+    try:
+        store.write(conn, list(batches))
+    finally:
+        conn.close()
+
+
+def test_clean_sample_clamps_and_drops_empty_ones():
+    now = 1_000_000.0
+    row = telemetry.clean_sample({"t": now + 3600, "peer": "p" * 100, "rtt": -5, "fps": 1000}, now)
+    assert row[0] == now + 60 and row[1] == "p" * 64 and row[2] == 0.0 and row[6] == 240
+    assert telemetry.clean_sample({"peer": "x"}, now) is None
+    assert telemetry.clean_sample({"rtt": float("nan")}, now) is None
+    assert telemetry.clean_sample("junk", now) is None
+
+
+def test_summary_rolls_up_per_user_and_overall(store):
+    now = time.time()
+    write(store,
+          ("r", "alice", [{"t": now, "peer": "bob", "rtt": 40, "lost": 1, "recv": 99, "fps": 30}] * 19
+                         + [{"t": now, "peer": "bob", "rtt": 400, "lost": 0, "recv": 100, "fps": 30}]),
+          ("r", "bob", [{"t": now, "peer": "alice", "jitter": 4}]),
+          ("other", "carol", [{"t": now, "rtt": 1}]))
+    out = store.summary("r", now - 60)
+    assert out["samples"] == 21 and set(out["users"]) == {"alice", "bob"}
+    alice = out["users"]["alice"]
+    assert alice["rtt_avg_ms"] == 58.0 and alice["rtt_max_ms"] == 400
+    assert alice["rtt_p95_ms"] == 50  # the bin holding the 95th percentile, not the max
+    assert alice["loss_pct"] == 0.95 and alice["fps_avg"] == 30
+    assert out["users"]["bob"]["rtt_p95_ms"] is None and out["jitter_avg_ms"] == 4
+    assert out["rtt_max_ms"] == 400
+
+
+def test_a_zero_rtt_percentile_is_reported_not_dropped(store):
+    now = time.time()
+    write(store, ("r", "alice", [{"t": now, "rtt": 0}]))
+    out = store.summary("r", now - 60)
+    assert out["rtt_p95_ms"] == 0 and out["rtt_max_ms"] == 0
+
+
+def test_summary_only_counts_buckets_since(store):
+    now = time.time()
+    old = now - 10 * telemetry.BUCKET_SECONDS
+    write(store, ("r", "alice", [{"t": old, "rtt": 10}, {"t": now, "rtt": 20}]))
+    assert store.summary("r", now - 60)["samples"] == 1
+    assert store.summary("r", old)["samples"] == 2
+
+
+def test_prune_keeps_rollups_after_raw_rows_go(store):
+    now = time.time()
+    write(store, ("r", "alice", [{"t": now, "rtt": 20}]))
+    conn = store._connect()
+    try:
+        store.prune(conn, now + (telemetry.RAW_RETENTION_DAYS + 1) * 86400)
+        raw = conn.execute("SELECT COUNT(*) FROM telemetry_samples").fetchone()[0]
+    finally:
+        conn.close()
+    assert raw == 0
+    assert store.summary("r", now - 60)["rtt_avg_ms"] == 20
@@ -0,0 +1,35 @@
+# tests/test_timing_wheel.py — the liveness wheel
+import signaling
+
+
+def test_timing_wheel_fires_each_item_at_its_tick():
+    w = signaling.TimingWheel(tick=1.0, slots=4)
+    now = w.now
+    w.add("a", now + 2)
+    w.add("b", now + 3)
+    assert w.size == 2
+    assert w.advance(now + 1) == []
+    assert w.advance(now + 2) == ["a"]
+    assert w.advance(now + 3) == ["b"]
+    assert w.size == 0
+
+
+def test_timing_wheel_cascades_from_the_outer_wheel():
+    w = signaling.TimingWheel(tick=1.0, slots=4)
+    now = w.now
+    w.add("late", now + 10)  # beyond one inner turn
+    fired = {}
+    for t in range(now + 1, now + 16):
+        for item in w.advance(t):
+            fired[item] = t
+    assert fired == {"late": now + 10}
+
+
+def test_timing_wheel_clamps_past_and_far_deadlines():
+    w = signaling.TimingWheel(tick=1.0, slots=4)
+    now = w.now
+    w.add("past", now - 100)  # next tick at the earliest
+    w.add("far", now + 10_000)  # at most slots * slots - 1 ticks out
+    assert w.advance(now + 1) == ["past"]
+    assert w.advance(now + 14) == []
+    assert w.advance(now + 15) == ["far"]
@@ -0,0 +1,96 @@
+# tests/test_uploads.py
+import io
+import os
+import threading
+
+import pytest
+
+import uploads
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def encode(img, fmt, **kw):
+    out = io.BytesIO()
+    img.save(out, fmt, **kw)
+    return out.getvalue()
+
+
+def decode(data):
+    return Image.open(io.BytesIO(data))
+
+
+def test_large_photo_is_cropped_to_the_canvas_and_scaled_down():
+    data = encode(Image.new("RGB", (3000, 1000), (200, 10, 10)), "JPEG")
+    blob, ext = uploads.process_background(data)
+    with decode(blob) as img:
+        assert img.size == (uploads.BG_WIDTH, uploads.BG_HEIGHT)
+        assert ext == "." + img.format.lower().replace("jpeg", "jpg")
+
+
+def test_small_image_is_only_cropped():
+    blob, _ = uploads.process_background(encode(Image.new("RGB", (400, 400)), "PNG"))
+    with decode(blob) as img:
+        assert img.size == (400, 300)
+
+
+def test_exif_orientation_is_applied_and_metadata_dropped():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotate 90 degrees clockwise to display
+    data = encode(Image.new("RGB", (400, 300)), "JPEG", exif=exif.tobytes())
+    blob, _ = uploads.process_background(data)
+    with decode(blob) as img:
+        assert img.size == (300, 225)  # portrait once turned, then cropped to 4:3
+        assert not img.getexif()
+
+
+def test_transparency_is_flattened_on_black():
+    blob, _ = uploads.process_background(encode(Image.new("RGBA", (80, 60), (255, 255, 255, 0)), "PNG"))
+    with decode(blob) as img:
+        assert img.mode == "RGB" and max(img.convert("L").getextrema()) < 16
+
+
+def test_garbage_and_bombs_are_rejected(monkeypatch):
+    with pytest.raises(Exception):
+        uploads.process_background(b"not an image")
+    monkeypatch.setattr(uploads, "MAX_PIXELS", 100)
+    with pytest.raises(ValueError):
+        uploads.process_background(encode(Image.new("RGB", (20, 20)), "PNG"))
+
+
+def test_sniff_ext():
+    assert uploads._sniff_ext(b"\x89PNG....") == ".png"
+    assert uploads._sniff_ext(b"\xff\xd8\xff\xe0") == ".jpg"
+    assert uploads._sniff_ext(b"RIFF\0\0\0\0WEBPVP8 ") == ".webp"
+    assert uploads._sniff_ext(b"???") == ".png"
+
+
+def run(proc, data):
+    """Submit one upload and wait for its callback -> (submitted, path or None)."""
+    got, done = [], threading.Event()
+    ok = proc.submit("alice", data, lambda rel: (got.append(rel), done.set()))
+    if ok:
+        assert done.wait(10)
+    return ok, got[0] if got else None
+
+
+def test_processor_writes_under_the_user_and_always_answers(tmp_path):
+    proc = uploads.Processor(str(tmp_path), workers=1)
+    ok, rel = run(proc, encode(Image.new("RGB", (64, 48)), "PNG"))
+    assert ok and rel.startswith("uploads/alice/bg_")
+    assert os.path.isfile(tmp_path / rel)
+    assert run(proc, b"junk") == (True, None)
+    assert proc.counters["uploads"] == 1 and proc.counters["uploads_rejected"] == 1
+    proc.pool.shutdown()
+
+
+def test_processor_drops_uploads_beyond_the_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "QUEUE_MAX", 1)
+    proc = uploads.Processor(str(tmp_path), workers=1)
+    gate = threading.Event()
+    monkeypatch.setattr(uploads, "process_background", lambda data: gate.wait(10) and (data, ".png"))
+    assert proc.submit("alice", b"a", lambda rel: None)
+    assert not proc.submit("alice", b"b", lambda rel: None)
+    gate.set()
+    proc.pool.shutdown(wait=True)
+    assert proc.counters["uploads_dropped"] == 1 and proc.counters["uploads"] == 1
@@ -0,0 +1,124 @@
+# uploads.py
+import io, os, time, secrets, threading, collections, concurrent.futures
+
+import jsonlog
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # uploads are then stored as sent
+    Image = None
+
+"""
+Background-image uploads from /settings, processed off the request path.
+
+  proc = Processor(STATIC_DIR)
+  proc.submit(username, data, done)   # False if the queue is full
+  # later, on a worker thread: done("uploads/<user>/bg_<token>.webp") or done(None)
+
+A worker decodes the upload (honouring EXIF orientation), crops it to the
+aspect of the filter canvas and scales it down to BG_WIDTH x BG_HEIGHT (the
+workW x workH of filters_bg.js; smaller images are only cropped), then
+re-encodes it as WebP (JPEG if Pillow lacks WebP) without EXIF/ICC/XMP.
+The room page's drawCover() then blits it 1:1 instead of rescaling a
+multi-megapixel photo every frame. Files are written once under a new
+name, so app.py serves them by fingerprinted URL with immutable caching.
+
+Without Pillow the upload is written unchanged (with an extension matching
+its content), as before.
+"""
+
+BG_WIDTH = int(os.environ.get("UPLOAD_BG_WIDTH", "640"))
+BG_HEIGHT = int(os.environ.get("UPLOAD_BG_HEIGHT", "480"))
+WORKERS = int(os.environ.get("UPLOAD_WORKERS", "2"))
+QUEUE_MAX = int(os.environ.get("UPLOAD_QUEUE_MAX", "16"))  # uploads held in memory at once
+MAX_PIXELS = 50_000_000  # decoded size limit (decompression bombs)
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+
+log = jsonlog.get_logger("app.uploads")
+
+_MAGIC = ((b"\x89PNG", ".png"), (b"\xff\xd8\xff", ".jpg"), (b"GIF8", ".gif"))
+
+
+def _sniff_ext(data):
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return next((ext for magic, ext in _MAGIC if data.startswith(magic)), ".png")
+
+
+def process_background(data):
+    """Upload bytes -> (encoded bytes, extension). Raises for anything that is not a usable image."""
+    if Image is None:
+        return data, _sniff_ext(data)
+    with Image.open(io.BytesIO(data)) as img:
+        if img.width * img.height > MAX_PIXELS:
+            raise ValueError(f"{img.width}x{img.height} is too large")
+        img.draft("RGB", (BG_WIDTH, BG_HEIGHT))  # JPEG: decode at 1/2..1/8 scale right away
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            flat = Image.new("RGB", img.size, (0, 0, 0))
+            flat.paste(img, mask=img.getchannel("A"))
+            img = flat
+        else:
+            img = img.convert("RGB")
+    # crop to the canvas aspect, then scale down to the canvas (never up: drawCover does that)
+    ratio = BG_WIDTH / BG_HEIGHT
+    size = (min(img.width, round(img.height * ratio)), min(img.height, round(img.width / ratio)))
+    if size[0] > BG_WIDTH:
+        size = (BG_WIDTH, BG_HEIGHT)
+    img = ImageOps.fit(img, size, Image.LANCZOS)
+    out = io.BytesIO()
+    if features.check("webp"):
+        img.save(out, "WEBP", quality=WEBP_QUALITY, method=4)
+        return out.getvalue(), ".webp"
+    img.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), ".jpg"
+
+
+class Processor:
+    def __init__(self, static_dir, workers=WORKERS):
+        self.static_dir = static_dir
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="upload")
+        self.slots = threading.BoundedSemaphore(QUEUE_MAX)
+        self.counters = collections.Counter()
+
+    # ---- request path: no decoding ----
+    def submit(self, username, data, done):
+        """Queue one upload; done(path under static_dir, or None if it failed) runs on a worker, always."""
+        if not self.slots.acquire(blocking=False):
+            self.counters["uploads_dropped"] += 1
+            return False
+        self.pool.submit(self._run, username, data, done)
+        return True
+
+    # ---- workers ----
+    def _run(self, username, data, done):
+        rel = None
+        try:
+            t0 = time.perf_counter()
+            try:
+                blob, ext = process_background(data)
+            except Exception as e:  # Pillow raises all sorts of things for broken or hostile files
+                self.counters["uploads_rejected"] += 1
+                log.warning("background upload rejected", user=username, bytes=len(data), error=str(e))
+                return
+            path = os.path.join(self.static_dir, "uploads", username, f"bg_{secrets.token_hex(8)}{ext}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".part", "wb") as f:
+                f.write(blob)
+            os.replace(path + ".part", path)
+            rel = os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+            self.counters["uploads"] += 1
+            log.info("background processed", user=username, in_bytes=len(data), out_bytes=len(blob),
+                     ms=round((time.perf_counter() - t0) * 1000, 1))
+        except Exception:
+            self.counters["uploads_failed"] += 1
+            log.exception("background upload failed", user=username)
+        finally:
+            self.slots.release()
+            # always answered, so the caller can clear its pending state on failure too
+            try:
+                done(rel)
+            except Exception:
+                log.exception("background upload callback failed", user=username)